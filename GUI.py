@@ -1,5 +1,6 @@
 import copy
 import os
+import time
 
 import numpy as np
 import qimage2ndarray
@@ -75,6 +76,12 @@ class GUI(QtWidgets.QMainWindow):
         self.cameraExposureDoubleSpinBox.setMinimum(25)
         self.cameraExposureDoubleSpinBox.setSingleStep(20)
         self.cameraExposureDoubleSpinBox.setValue(200)
+        self.cameraBinningLabel = QtWidgets.QLabel('Binning:')
+        self.cameraBinningComboBox = QtWidgets.QComboBox()
+        self.cameraBinningComboBox.addItems(['1', '2', '4'])
+        self.cameraROILabel = QtWidgets.QLabel('ROI:')
+        self.cameraROIComboBox = QtWidgets.QComboBox()
+        self.cameraROIComboBox.addItems(['Full Frame', 'Center 1024', 'Center 512', 'Center 256'])
         self.scaleBarTogglePushButton = QtWidgets.QPushButton('Scale Bar')
         self.scaleBarTogglePushButton.setCheckable(True)
         self.xyBookMarkPushButton = QtWidgets.QPushButton('Bookmark')
@@ -271,6 +278,8 @@ class GUI(QtWidgets.QMainWindow):
 
         self.imageAdjustmentClahePushButton = QtWidgets.QPushButton('Apply Clahe')
         self.imageAdjustmentClahePushButton.setCheckable(True)
+        self.imageAdjustmentClaheDisplayOnlyPushButton = QtWidgets.QPushButton('Clahe Display Only')
+        self.imageAdjustmentClaheDisplayOnlyPushButton.setCheckable(True)
         self.imageAdjustmentClaheGridLabel = QtWidgets.QLabel('Grid Size:')
         self.imageAdjustmentClaheGridValueDoubleSpinBox = QtWidgets.QDoubleSpinBox()
         self.imageAdjustmentClaheGridValueDoubleSpinBox.setMinimum(3)
@@ -290,10 +299,64 @@ class GUI(QtWidgets.QMainWindow):
         self.imageAdjustmentThresholdSlider.setValue(50)
         self.imageAdjustmentThresholdSlider.setSingleStep(1)
         self.imageAdjustmentThresholdLabel = QtWidgets.QLabel('50')
+        self.imageAdjustmentAutoRangePushButton = QtWidgets.QPushButton('Auto Range')
+        self.imageAdjustmentAutoRangePushButton.setCheckable(True)
+        self.imageAdjustmentBlackLevelLabel = QtWidgets.QLabel('Black:')
+        self.imageAdjustmentBlackLevelSpinBox = QtWidgets.QSpinBox()
+        self.imageAdjustmentBlackLevelSpinBox.setMaximum(65535)
+        self.imageAdjustmentBlackLevelSpinBox.setSingleStep(256)
+        self.imageAdjustmentBlackLevelSpinBox.setValue(0)
+        self.imageAdjustmentWhiteLevelLabel = QtWidgets.QLabel('White:')
+        self.imageAdjustmentWhiteLevelSpinBox = QtWidgets.QSpinBox()
+        self.imageAdjustmentWhiteLevelSpinBox.setMaximum(65535)
+        self.imageAdjustmentWhiteLevelSpinBox.setSingleStep(256)
+        self.imageAdjustmentWhiteLevelSpinBox.setValue(65535)
+        self.imageAdjustmentGammaLabel = QtWidgets.QLabel('Gamma:')
+        self.imageAdjustmentGammaDoubleSpinBox = QtWidgets.QDoubleSpinBox()
+        self.imageAdjustmentGammaDoubleSpinBox.setMinimum(0.1)
+        self.imageAdjustmentGammaDoubleSpinBox.setMaximum(5)
+        self.imageAdjustmentGammaDoubleSpinBox.setSingleStep(0.1)
+        self.imageAdjustmentGammaDoubleSpinBox.setDecimals(2)
+        self.imageAdjustmentGammaDoubleSpinBox.setValue(1)
+        self.imageAdjustmentCalibrateHotPixelsPushButton = QtWidgets.QPushButton('Calibrate Hot Pixels')
+        self.imageAdjustmentFlatFieldPushButton = QtWidgets.QPushButton('Flat Field')
+        self.imageAdjustmentFlatFieldPushButton.setCheckable(True)
+        self.imageAdjustmentCaptureFlatFieldPushButton = QtWidgets.QPushButton('Capture Flat Field')
+        self.imageAdjustmentBackgroundPushButton = QtWidgets.QPushButton('Subtract Background')
+        self.imageAdjustmentBackgroundPushButton.setCheckable(True)
+        self.imageAdjustmentBackgroundModeComboBox = QtWidgets.QComboBox()
+        self.imageAdjustmentBackgroundModeComboBox.addItems(['mean', 'median'])
 
         self.takeScreenshotPushButton = QtWidgets.QPushButton(text='Screenshot')
+        self.screenshotBurstSpinBox = QtWidgets.QSpinBox()
+        self.screenshotBurstSpinBox.setPrefix('x')
+        self.screenshotBurstSpinBox.setMinimum(1)
+        self.screenshotBurstSpinBox.setMaximum(100)
+        self.screenshotOverlaysPushButton = QtWidgets.QPushButton('Overlays')
+        self.screenshotOverlaysPushButton.setCheckable(True)
         self.takeVideoPushbutton = QtWidgets.QPushButton('Record Video')
         self.takeVideoPushbutton.setCheckable(True)
+        self.recordingFormatComboBox = QtWidgets.QComboBox()
+        self.recordingFormatComboBox.addItems(['mp4', 'raw'])
+        self.recordingPolicyLabel = QtWidgets.QLabel('When Behind:')
+        self.recordingPolicyComboBox = QtWidgets.QComboBox()
+        self.recordingPolicyComboBox.addItems(['block', 'drop', 'spill'])
+        self.pretriggerLabel = QtWidgets.QLabel('Pre-trigger:')
+        self.pretriggerSecondsDoubleSpinBox = QtWidgets.QDoubleSpinBox()
+        self.pretriggerSecondsDoubleSpinBox.setSuffix(' s')
+        self.pretriggerSecondsDoubleSpinBox.setMinimum(0)
+        self.pretriggerSecondsDoubleSpinBox.setMaximum(60)
+        self.pretriggerSecondsDoubleSpinBox.setSingleStep(1)
+        self.pretriggerMemorySpinBox = QtWidgets.QSpinBox()
+        self.pretriggerMemorySpinBox.setSuffix(' MB')
+        self.pretriggerMemorySpinBox.setMinimum(64)
+        self.pretriggerMemorySpinBox.setMaximum(16384)
+        self.pretriggerMemorySpinBox.setSingleStep(256)
+        self.pretriggerMemorySpinBox.setValue(1024)
+        self.pretriggerBitDepthComboBox = QtWidgets.QComboBox()
+        self.pretriggerBitDepthComboBox.addItems(['8 bit', '16 bit'])
+        self.showStatsPushButton = QtWidgets.QPushButton('Stats')
+        self.showStatsPushButton.setCheckable(True)
 
         #
         # ARRANGE THE WIDGETS
@@ -334,6 +397,10 @@ class GUI(QtWidgets.QMainWindow):
         self.microscopeLayoutMiddle.addWidget(self.diaVoltageDoubleSpinBox)
         self.microscopeLayoutMiddle.addWidget(self.cameraExposureLabel)
         self.microscopeLayoutMiddle.addWidget(self.cameraExposureDoubleSpinBox)
+        self.microscopeLayoutMiddle.addWidget(self.cameraBinningLabel)
+        self.microscopeLayoutMiddle.addWidget(self.cameraBinningComboBox)
+        self.microscopeLayoutMiddle.addWidget(self.cameraROILabel)
+        self.microscopeLayoutMiddle.addWidget(self.cameraROIComboBox)
         self.microscopeLayoutMiddle.addWidget(self.scaleBarTogglePushButton)
         self.microscopeLayoutMiddle.setAlignment(QtCore.Qt.AlignLeft)
         self.microscopeLayoutMiddle.setAlignment(QtCore.Qt.AlignLeft)
@@ -509,30 +576,64 @@ class GUI(QtWidgets.QMainWindow):
         #     self.oetGroupBox.setEnabled(False)
 
         self.imageAdustmentGroupBox = QtWidgets.QGroupBox('Image Adjustment')
-        self.imageAdustmentLayout = QtWidgets.QHBoxLayout()
+        self.imageAdustmentLayout = QtWidgets.QVBoxLayout()
         self.imageAdustmentGroupBox.setLayout(self.imageAdustmentLayout)
-        self.imageAdustmentLayout.addWidget(self.imageAdjustmentClahePushButton)
-        self.imageAdustmentLayout.addWidget(self.imageAdjustmentClaheClipValueLabel)
-        self.imageAdustmentLayout.addWidget(self.imageAdjustmentClaheClipValueDoubleSpinBox)
-        self.imageAdustmentLayout.addWidget(self.imageAdjustmentClaheGridLabel)
-        self.imageAdustmentLayout.addWidget(self.imageAdjustmentClaheGridValueDoubleSpinBox)
-        self.imageAdustmentLayout.setAlignment(QtCore.Qt.AlignLeft)
-        self.imageAdustmentLayout.addWidget(self.imageAdjustmentThresholdPushButton)
-        self.imageAdustmentLayout.addWidget(self.imageAdjustmentThresholdSlider)
-        self.imageAdustmentLayout.addWidget(self.imageAdjustmentThresholdLabel)
+        self.imageAdustmentLayoutUpper = QtWidgets.QHBoxLayout()
+        self.imageAdustmentLayoutUpper.addWidget(self.imageAdjustmentClahePushButton)
+        self.imageAdustmentLayoutUpper.addWidget(self.imageAdjustmentClaheDisplayOnlyPushButton)
+        self.imageAdustmentLayoutUpper.addWidget(self.imageAdjustmentClaheClipValueLabel)
+        self.imageAdustmentLayoutUpper.addWidget(self.imageAdjustmentClaheClipValueDoubleSpinBox)
+        self.imageAdustmentLayoutUpper.addWidget(self.imageAdjustmentClaheGridLabel)
+        self.imageAdustmentLayoutUpper.addWidget(self.imageAdjustmentClaheGridValueDoubleSpinBox)
+        self.imageAdustmentLayoutUpper.setAlignment(QtCore.Qt.AlignLeft)
+        self.imageAdustmentLayoutUpper.addWidget(self.imageAdjustmentThresholdPushButton)
+        self.imageAdustmentLayoutUpper.addWidget(self.imageAdjustmentThresholdSlider)
+        self.imageAdustmentLayoutUpper.addWidget(self.imageAdjustmentThresholdLabel)
+        self.imageAdustmentLayout.addLayout(self.imageAdustmentLayoutUpper)
+
+        self.imageAdustmentLayoutLower = QtWidgets.QHBoxLayout()
+        self.imageAdustmentLayoutLower.addWidget(self.imageAdjustmentAutoRangePushButton)
+        self.imageAdustmentLayoutLower.addWidget(self.imageAdjustmentBlackLevelLabel)
+        self.imageAdustmentLayoutLower.addWidget(self.imageAdjustmentBlackLevelSpinBox)
+        self.imageAdustmentLayoutLower.addWidget(self.imageAdjustmentWhiteLevelLabel)
+        self.imageAdustmentLayoutLower.addWidget(self.imageAdjustmentWhiteLevelSpinBox)
+        self.imageAdustmentLayoutLower.addWidget(self.imageAdjustmentGammaLabel)
+        self.imageAdustmentLayoutLower.addWidget(self.imageAdjustmentGammaDoubleSpinBox)
+        self.imageAdustmentLayoutLower.addWidget(self.imageAdjustmentCalibrateHotPixelsPushButton)
+        self.imageAdustmentLayoutLower.setAlignment(QtCore.Qt.AlignLeft)
+        self.imageAdustmentLayout.addLayout(self.imageAdustmentLayoutLower)
+
+        self.imageAdustmentLayoutCorrection = QtWidgets.QHBoxLayout()
+        self.imageAdustmentLayoutCorrection.addWidget(self.imageAdjustmentFlatFieldPushButton)
+        self.imageAdustmentLayoutCorrection.addWidget(self.imageAdjustmentCaptureFlatFieldPushButton)
+        self.imageAdustmentLayoutCorrection.addWidget(self.imageAdjustmentBackgroundPushButton)
+        self.imageAdustmentLayoutCorrection.addWidget(self.imageAdjustmentBackgroundModeComboBox)
+        self.imageAdustmentLayoutCorrection.setAlignment(QtCore.Qt.AlignLeft)
+        self.imageAdustmentLayout.addLayout(self.imageAdustmentLayoutCorrection)
         self.VBoxLayout.addWidget(self.imageAdustmentGroupBox)
 
         self.acquisitionGroupBox = QtWidgets.QGroupBox('Acquisition')
         self.acquisitionLayout = QtWidgets.QHBoxLayout()
         self.acquisitionGroupBox.setLayout(self.acquisitionLayout)
         self.acquisitionLayout.addWidget(self.takeScreenshotPushButton)
+        self.acquisitionLayout.addWidget(self.screenshotBurstSpinBox)
+        self.acquisitionLayout.addWidget(self.screenshotOverlaysPushButton)
         self.acquisitionLayout.addWidget(self.takeVideoPushbutton)
+        self.acquisitionLayout.addWidget(self.recordingFormatComboBox)
+        self.acquisitionLayout.addWidget(self.recordingPolicyLabel)
+        self.acquisitionLayout.addWidget(self.recordingPolicyComboBox)
+        self.acquisitionLayout.addWidget(self.pretriggerLabel)
+        self.acquisitionLayout.addWidget(self.pretriggerSecondsDoubleSpinBox)
+        self.acquisitionLayout.addWidget(self.pretriggerMemorySpinBox)
+        self.acquisitionLayout.addWidget(self.pretriggerBitDepthComboBox)
+        self.acquisitionLayout.addWidget(self.showStatsPushButton)
         self.acquisitionLayout.setAlignment(QtCore.Qt.AlignLeft)
         self.VBoxLayout.addWidget(self.acquisitionGroupBox)
 
         self.image_viewer = ImageViewer()
 
-        self.image_processing = imageProcessor(self.image_viewer.height(), self.image_viewer.width())
+        self.image_processing = imageProcessor(self.image_viewer.height(), self.image_viewer.width(),
+                                               camera_name=self.camera_name)
         self.image_processing_thread = QThread()
         self.image_processing_thread.start()
 
@@ -542,8 +643,23 @@ class GUI(QtWidgets.QMainWindow):
         self.toggle_scale_bar_signal.connect(self.image_viewer.toggle_scale_bar_slot)
 
         self.set_camera_exposure_signal.connect(self.image_processing.set_exposure_slot)
+        self.set_camera_roi_signal.connect(self.image_processing.set_roi_slot)
+        self.set_camera_binning_signal.connect(self.image_processing.set_binning_slot)
+        self.image_processing.readout_signal.connect(self.image_viewer.readout_slot)
+        self.image_processing.readout_signal.connect(self.readoutChanged)
 
         self.image_processing.VideoSignal.connect(self.image_viewer.setImage)
+        self.image_viewer.release_frame_signal.connect(self.image_processing.release_display_frame)
+        self.image_viewer.display_mailbox = self.image_processing.display_mailbox
+        self.image_processing.frame_available_signal.connect(self.image_viewer.display_latest_frame_slot)
+        self.image_viewer.profiler = self.image_processing.profiler
+
+        self.statsDock = StatsDock()
+        self.addDockWidget(Qt.RightDockWidgetArea, self.statsDock)
+        self.statsDock.hide()
+        self.image_processing.stats_signal.connect(self.statsDock.update_stats_slot)
+        self.showStatsPushButton.clicked.connect(self.statsDock.setVisible)
+        self.statsDock.visibilityChanged.connect(self.showStatsPushButton.setChecked)
 
         self.image_viewer.setSizePolicy(QtWidgets.QSizePolicy.MinimumExpanding,
                                         QtWidgets.QSizePolicy.MinimumExpanding)
@@ -622,9 +738,21 @@ class GUI(QtWidgets.QMainWindow):
         self.stageXYStartAccelerationDoubleSpinBox.valueChanged.connect(self.stage.set_xy_start_accel)
 
         self.takeScreenshotPushButton.clicked.connect(self.image_processing.take_screenshot_slot)
+        self.screenshot_params_signal.connect(self.image_processing.set_screenshot_params_slot)
+        self.screenshotBurstSpinBox.valueChanged.connect(self.setScreenshotParams)
+        self.screenshotOverlaysPushButton.clicked.connect(self.setScreenshotParams)
         self.start_record_video_signal.connect(self.image_processing.start_recording_video_slot)
         self.stop_record_video_signal.connect(self.image_processing.stop_video_slot)
+        self.recording_policy_signal.connect(self.image_processing.set_recording_policy_slot)
+        self.recording_format_signal.connect(self.image_processing.set_recording_format_slot)
+        self.recordingFormatComboBox.currentTextChanged.connect(self.recording_format_signal.emit)
+        self.recordingPolicyComboBox.currentTextChanged.connect(self.recording_policy_signal.emit)
+        self.pretrigger_signal.connect(self.image_processing.set_pretrigger_slot)
+        self.pretriggerSecondsDoubleSpinBox.valueChanged.connect(self.setPretrigger)
+        self.pretriggerMemorySpinBox.valueChanged.connect(self.setPretrigger)
+        self.pretriggerBitDepthComboBox.currentTextChanged.connect(self.setPretrigger)
         self.takeVideoPushbutton.clicked.connect(self.toggleVideoRecording)
+        self.image_processing.recording_stopped_signal.connect(self.recordingStopped)
 
         self.magnificationComboBoxWidget.currentTextChanged.connect(self.changeMagnification)
         self.xystageStepSizeDoubleSpinBox.valueChanged.connect(self.stage.set_xystep_size)
@@ -634,6 +762,8 @@ class GUI(QtWidgets.QMainWindow):
         self.diaLightPushbutton.clicked.connect(self.toggleDiaLamp)
         self.diaVoltageDoubleSpinBox.valueChanged.connect(self.microscope.set_dia_voltage)
         self.cameraExposureDoubleSpinBox.valueChanged.connect(self.setCameraExposure)
+        self.cameraBinningComboBox.currentTextChanged.connect(self.setCameraBinning)
+        self.cameraROIComboBox.currentTextChanged.connect(self.setCameraROI)
         self.scaleBarTogglePushButton.clicked.connect(self.toggleScaleBar)
 
         self.xyBookMarkPushButton.clicked.connect(self.bookmark_current_location)
@@ -698,9 +828,22 @@ class GUI(QtWidgets.QMainWindow):
         self.imageAdjustmentClaheClipValueDoubleSpinBox.valueChanged.connect(self.apply_image_adjustment)
         self.imageAdjustmentClaheGridValueDoubleSpinBox.valueChanged.connect(self.apply_image_adjustment)
         self.imageAdjustmentClahePushButton.clicked.connect(self.apply_image_adjustment)
+        self.imageAdjustmentClaheDisplayOnlyPushButton.clicked.connect(self.apply_image_adjustment)
         self.image_adjustment_params_signal.connect(self.image_processing.image_adjustment_params_slot)
         self.imageAdjustmentThresholdSlider.valueChanged.connect(self.apply_image_adjustment)
         self.imageAdjustmentThresholdPushButton.clicked.connect(self.apply_image_adjustment)
+        self.imageAdjustmentAutoRangePushButton.clicked.connect(self.apply_image_adjustment)
+        self.imageAdjustmentBlackLevelSpinBox.valueChanged.connect(self.apply_image_adjustment)
+        self.imageAdjustmentWhiteLevelSpinBox.valueChanged.connect(self.apply_image_adjustment)
+        self.imageAdjustmentGammaDoubleSpinBox.valueChanged.connect(self.apply_image_adjustment)
+        self.imageAdjustmentCalibrateHotPixelsPushButton.clicked.connect(self.calibrate_hot_pixels)
+        self.calibrate_hot_pixels_signal.connect(self.image_processing.calibrate_hot_pixels_slot)
+        self.imageAdjustmentFlatFieldPushButton.clicked.connect(self.apply_image_adjustment)
+        self.imageAdjustmentBackgroundPushButton.clicked.connect(self.apply_image_adjustment)
+        self.imageAdjustmentBackgroundModeComboBox.currentTextChanged.connect(self.apply_image_adjustment)
+        self.imageAdjustmentCaptureFlatFieldPushButton.clicked.connect(self.capture_flat_field)
+        self.optical_config_signal.connect(self.image_processing.optical_config_slot)
+        self.capture_flat_field_signal.connect(self.image_processing.capture_flat_field_slot)
 
 
         self.oetProjectCircleBrushPushButton.setEnabled(False)
@@ -747,6 +890,32 @@ class GUI(QtWidgets.QMainWindow):
         recursiveSetChildFocusPolicy(self)
 
 
+class StatsDock(QtWidgets.QDockWidget):
+
+    def __init__(self, parent=None):
+        super(StatsDock, self).__init__('Pipeline Stats', parent)
+        self.table = QtWidgets.QTableWidget(0, 5)
+        self.table.setHorizontalHeaderLabels(['count', 'p50 (ms)', 'p95 (ms)', 'p99 (ms)', 'mean (ms)'])
+        self.table.setEditTriggers(QtWidgets.QAbstractItemView.NoEditTriggers)
+        self.table.setMinimumWidth(450)
+        self.setWidget(self.table)
+
+    @QtCore.pyqtSlot('PyQt_PyObject')
+    def update_stats_slot(self, payload):
+        if not self.isVisible():
+            return
+        stats, counters = payload
+        rows = [(stage, [s['count'], f"{s['p50']:.2f}", f"{s['p95']:.2f}", f"{s['p99']:.2f}", f"{s['mean']:.2f}"])
+                for stage, s in stats.items()]
+        # counters only have a value, they go under the timings
+        rows += [(name, [value, '', '', '', '']) for name, value in counters.items()]
+        self.table.setRowCount(len(rows))
+        self.table.setVerticalHeaderLabels([name for name, _ in rows])
+        for i, (_, values) in enumerate(rows):
+            for j, value in enumerate(values):
+                self.table.setItem(i, j, QtWidgets.QTableWidgetItem(str(value)))
+
+
 class ImageViewer(QtWidgets.QWidget):
     resize_event_signal = QtCore.pyqtSignal(QtCore.QSize, 'PyQt_PyObject')
     click_event_signal = QtCore.pyqtSignal(QtGui.QMouseEvent)
@@ -755,10 +924,16 @@ class ImageViewer(QtWidgets.QWidget):
     control_signal = QtCore.pyqtSignal('PyQt_PyObject')
     calibration_signal = QtCore.pyqtSignal('PyQt_PyObject')
     enable_dmd_signal = QtCore.pyqtSignal()
+    release_frame_signal = QtCore.pyqtSignal('PyQt_PyObject')
 
     def __init__(self, parent=None):
         super(ImageViewer, self).__init__(parent)
         self.image = QtGui.QImage()
+        # the array backing self.image, handed back to the image processor once it has been painted
+        self.frame_buffer = None
+        # set by the GUI, the image processor leaves its newest frame in here for us
+        self.display_mailbox = None
+        self.profiler = None
         self.setAttribute(QtCore.Qt.WA_OpaquePaintEvent)
         self.ignore_release = True
         self.drawing_path = False
@@ -778,16 +953,35 @@ class ImageViewer(QtWidgets.QWidget):
 
         self.scale_bar_value = 'Unk'
         self.scale_bar_length = 10
+        # the scale bar is calibrated on the full sensor, a smaller roi gets stretched over the same window
+        self.scale_bar_zoom = 1
+        # the readout being shown, see to_sensor_coords
+        self.readout = None
         self.show_dmd_overlay = False
         self.sizePolicy = QtWidgets.QSizePolicy(QtWidgets.QSizePolicy.MinimumExpanding,
                                                 QtWidgets.QSizePolicy.MinimumExpanding,)
 
     def paintEvent(self, event):
+        t0 = time.perf_counter()
         painter = QtGui.QPainter(self)
         # draw in the center here
         x = int(self.width() / 2 - self.image.width() / 2)  # offset to draw in center
         painter.drawImage(x, 0, self.image)
         self.image = QtGui.QImage()
+        self.release_frame()
+        if self.profiler is not None:
+            self.profiler.record('paint', time.perf_counter() - t0)
+
+    def release_frame(self):
+        if self.frame_buffer is not None:
+            self.release_frame_signal.emit(self.frame_buffer)
+            self.frame_buffer = None
+
+    @QtCore.pyqtSlot()
+    def display_latest_frame_slot(self):
+        np_img = self.display_mailbox.take()
+        if np_img is not None:
+            self.setImage(np_img)
 
     # @QtCore.pyqtSlot(QtGui.QImage)
 
@@ -797,12 +991,43 @@ class ImageViewer(QtWidgets.QWidget):
         self.scale_bar_value = self.scale_bar_values[objective][0]
         self.scale_bar_length = self.scale_bar_values[objective][1]
 
+    @QtCore.pyqtSlot('PyQt_PyObject')
+    def readout_slot(self, readout):
+        self.readout = readout
+        if readout['roi'] is None:
+            self.scale_bar_zoom = 1
+        else:
+            self.scale_bar_zoom = readout['sensor_size'][0] / readout['roi'][2]
+        if len(self.calibration_payload) > 1:
+            (start_x, start_y), (end_x, end_y) = [self.from_sensor_coords(x, y) for x, y in
+                                                  (self.calibration_payload[0], self.calibration_payload[-1])]
+            if start_x < 0 or start_y < 0 or end_x > 1 or end_y > 1:
+                logging.warning('the roi only shows part of the dmd area, clicks outside it can\'t be projected')
+
+    def to_sensor_coords(self, x_scaled, y_scaled):
+        # fractions of the window to fractions of the full sensor. binning doesn't change the field, an roi is
+        # stretched over the whole window. the dmd calibration is kept in sensor fractions so it holds for any roi
+        if self.readout is None or self.readout['roi'] is None:
+            return x_scaled, y_scaled
+        x, y, width, height = self.readout['roi']
+        sensor_width, sensor_height = self.readout['sensor_size']
+        return (x + x_scaled * width) / sensor_width, (y + y_scaled * height) / sensor_height
+
+    def from_sensor_coords(self, x_scaled, y_scaled):
+        if self.readout is None or self.readout['roi'] is None:
+            return x_scaled, y_scaled
+        x, y, width, height = self.readout['roi']
+        sensor_width, sensor_height = self.readout['sensor_size']
+        return (x_scaled * sensor_width - x) / width, (y_scaled * sensor_height - y) / height
+
     def toggle_dmd_overlay(self, state):
         self.show_dmd_overlay = state
 
     @QtCore.pyqtSlot('PyQt_PyObject')
     def setImage(self, np_img):
+        t0 = time.perf_counter()
         if self.scale_bar_shown:
+            scale_bar_end = 20 + int((self.scale_bar_length - 20) * self.scale_bar_zoom)
             # draw our scale line and text in a reasonable location
             cv2.putText(np_img, self.scale_bar_value,
                         (20, int(self.height() * .925)),
@@ -812,13 +1037,13 @@ class ImageViewer(QtWidgets.QWidget):
                         2)
             # draw it three times to get over the stupid end cap business...
             cv2.line(np_img, (20, int(self.height() * .925) + 20),
-                     (self.scale_bar_length, int(self.height() * .925) + 20),
+                     (scale_bar_end, int(self.height() * .925) + 20),
                      255, 1)
             cv2.line(np_img, (20, int(self.height() * .925) + 21),
-                     (self.scale_bar_length, int(self.height() * .925) + 21),
+                     (scale_bar_end, int(self.height() * .925) + 21),
                      255, 1)
             cv2.line(np_img, (20, int(self.height() * .925) + 22),
-                     (self.scale_bar_length, int(self.height() * .925) + 22),
+                     (scale_bar_end, int(self.height() * .925) + 22),
                      255, 1)
         # if self.show_dmd_overlay:
         #     np_img = cv2.cvtColor(np_img, cv2.COLOR_GRAY2BGR).astype(np.uint8)
@@ -829,17 +1054,24 @@ class ImageViewer(QtWidgets.QWidget):
         #                    int(self.calibration_payload[-1][1] * self.height())),
         #                   (255, 0, 0), 5)
         #     np_img = cv2.addWeighted(np_img, 1, dmd_overlay, 0.25, 0)
+        # a frame that never got painted is replaced, give its buffer back first
+        self.release_frame()
         if len(np_img.shape) > 2:
-            # Format_RGB16
+            # Format_RGB16, this copies so the buffer can go straight back
             qt_img = qimage2ndarray.array2qimage(np_img)
             self.image = qt_img
+            self.release_frame_signal.emit(np_img)
         else:
+            # this wraps the buffer without copying, so we hold on to it until it is painted
             self.image = QtGui.QImage(np_img.data, self.height(), self.width(), np_img.strides[0],
                                       QtGui.QImage.Format_Grayscale8)
+            self.frame_buffer = np_img
 
         self.image_width = self.image.width()
         self.image_height = self.image.height()
         self.update()
+        if self.profiler is not None:
+            self.profiler.record('setImage', time.perf_counter() - t0)
 
     def sizeHint(self):
         return QtCore.QSize(2060 // 3, 2048 // 3)
@@ -878,8 +1110,7 @@ class ImageViewer(QtWidgets.QWidget):
             self.begin_path = event.pos()
         elif self.calibrating:
             # just scale this one here...probably could be neater
-            x_scaled = event.pos().x() / self.width()
-            y_scaled = event.pos().y() / self.height()
+            x_scaled, y_scaled = self.to_sensor_coords(event.pos().x() / self.width(), event.pos().y() / self.height())
             self.calibration_payload.append((x_scaled, y_scaled))
             string = f'calibration point marked: {x_scaled}, {y_scaled}'
             logging.info(string)
@@ -0,0 +1,61 @@
+import logging
+import queue
+import time
+from PyQt5 import QtCore
+
+
+class AcquisitionWorker(QtCore.QThread):
+    # tells the image processor there is something waiting in the frame queue
+    frame_ready_signal = QtCore.pyqtSignal()
+
+    def __init__(self, camera, frame_queue, lossless=True, profiler=None, parent=None):
+        super(AcquisitionWorker, self).__init__(parent)
+        self.camera = camera
+        self.frame_queue = frame_queue
+        self.lossless = lossless
+        self.profiler = profiler
+        self.running = False
+        # how long we wait on a full queue before throwing away the oldest frame
+        self.put_timeout = 0.5
+        self.frames_acquired = 0
+        self.frames_overflowed = 0
+
+    def run(self):
+        logging.info('acquisition worker started')
+        self.running = True
+        while self.running:
+            try:
+                # the camera backend waits a little itself when there is nothing new
+                t0 = time.perf_counter()
+                frames = self.camera.read_frames(self.lossless)
+            except Exception as e:
+                logging.warning(f'failed to get image from camera: {e}')
+                time.sleep(0.05)
+                continue
+            if len(frames) == 0:
+                continue
+            if self.profiler is not None:
+                self.profiler.record('acquisition', (time.perf_counter() - t0) / len(frames))
+            for frame in frames:
+                self.put_frame(frame)
+        logging.info('acquisition worker stopped')
+
+    def put_frame(self, frame):
+        self.frames_acquired += 1
+        try:
+            # block while processing catches up, frames keep piling up in the camera's own buffer meanwhile. if that
+            # fills too the camera backend restarts it, see MMCoreCamera.restart_after_overflow
+            self.frame_queue.put(frame, timeout=self.put_timeout)
+        except queue.Full:
+            # processing has fallen too far behind, make room by dropping the oldest frame
+            try:
+                self.frame_queue.get_nowait()
+                self.frames_overflowed += 1
+            except queue.Empty:
+                pass
+            self.frame_queue.put_nowait(frame)
+        self.frame_ready_signal.emit()
+
+    def stop(self):
+        self.running = False
+        self.wait()
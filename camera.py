@@ -0,0 +1,273 @@
+import os
+import sys
+import time
+import queue
+import logging
+
+
+class Frame():
+    # one frame off the camera, whichever backend it came from. timestamp is time.time() when we got hold of it,
+    # monotonic is time.monotonic() at the same moment, for measuring intervals that a clock change can't upset
+
+    def __init__(self, buffer, timestamp, index, metadata=None, monotonic=None):
+        self.buffer = buffer
+        self.timestamp = timestamp
+        self.monotonic = monotonic if monotonic is not None else time.monotonic()
+        self.index = index
+        self.metadata = metadata if metadata is not None else {}
+
+
+class CameraBackend():
+    # everything the acquisition worker and image processor need from a camera. read_frames is called in a loop
+    # on the acquisition thread and should wait a little (not forever) when nothing has arrived, so that a polled
+    # camera and a callback driven one look exactly the same from the outside
+    name = 'camera'
+    # (rows, columns) of the full sensor, unbinned
+    sensor_shape = (2048, 2048)
+
+    def __init__(self, exposure=200):
+        self.exposure = exposure
+        self.roi = None
+        self.binning = 1
+        self.frame_index = 0
+        # times the camera's own buffer filled up and lost frames before we could read them
+        self.buffer_overflows = 0
+
+    def open(self):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def start(self):
+        raise NotImplementedError
+
+    def stop(self):
+        raise NotImplementedError
+
+    def read_frames(self, lossless=True):
+        raise NotImplementedError
+
+    def set_exposure(self, exposure):
+        self.exposure = exposure
+
+    def set_readout(self, roi, binning):
+        raise NotImplementedError(f'{self.name} does not support roi or binning')
+
+    def get_metadata(self):
+        return {'camera': self.name, 'exposure': self.exposure, 'binning': self.binning, 'roi': self.roi}
+
+    def make_frame(self, buffer, metadata=None):
+        frame_metadata = self.get_metadata()
+        if metadata is not None:
+            frame_metadata.update(metadata)
+        frame = Frame(buffer, time.time(), self.frame_index, frame_metadata, time.monotonic())
+        self.frame_index += 1
+        return frame
+
+
+class MMCoreCamera(CameraBackend):
+    # any camera micromanager can run as a continuous sequence. frames are polled out of the micromanager circular
+    # buffer, either every one of them (lossless) or only the newest. it's the pco on the nikon scope by default
+    name = 'nikon'
+    sensor_shape = (2048, 2060)
+    mm_directory = 'C:\\Program Files\\Micro-Manager-2.0gamma'
+    device = ('camera', 'PCO_Camera', 'pco_camera')
+    initial_properties = [('PixelRate', 'fast scan'), ('Noisefilter', 'Off')]
+
+    def __init__(self, exposure=200):
+        super(MMCoreCamera, self).__init__(exposure)
+        self.mmc = None
+        # the module the core came from, for its Metadata class
+        self.mm_module = None
+        self.label = self.device[0]
+
+    def create_core(self):
+        sys.path.append(self.mm_directory)
+        os.chdir(self.mm_directory)
+        import MMCorePy
+        self.mm_module = MMCorePy
+        return MMCorePy.CMMCore()
+
+    def open(self):
+        self.mmc = self.create_core()
+        self.mmc.setCircularBufferMemoryFootprint(500)
+        self.mmc.loadDevice(*self.device)
+        self.mmc.initializeAllDevices()
+        self.mmc.setCameraDevice(self.label)
+        properties = self.mmc.getDevicePropertyNames(self.label)
+        for name, value in self.initial_properties:
+            self.mmc.setProperty(self.label, name, value)
+        self.mmc.setProperty(self.label, 'Exposure', self.exposure)
+        for p in properties:
+            log_string = p + str(self.mmc.getProperty(self.label, p)) + ': ' + \
+                         str(self.mmc.getAllowedPropertyValues(self.label, p))
+            logging.info(log_string)
+
+    def close(self):
+        self.mmc.stopSequenceAcquisition()
+        self.mmc.reset()
+
+    def start(self):
+        self.mmc.startContinuousSequenceAcquisition(1)
+
+    def stop(self):
+        self.mmc.stopSequenceAcquisition()
+
+    def get_poll_interval(self):
+        # exposure is in ms, poll four times per exposure but never slower than 20Hz
+        return max(0.001, min(self.exposure / 4000, 0.05))
+
+    def read_frames(self, lossless=True):
+        if self.mmc.getRemainingImageCount() == 0:
+            if self.mmc.isBufferOverflowed():
+                # everything from before the overflow has been read, the sequence has stopped
+                self.restart_after_overflow()
+                return []
+            # nothing new from the camera, sleep for a fraction of the exposure instead of spinning
+            time.sleep(self.get_poll_interval())
+            return []
+        if not lossless:
+            md = self.mm_module.Metadata()
+            buffer = self.mmc.getLastImageMD(md)
+            self.mmc.clearCircularBuffer()
+            return [self.make_frame(buffer, {'mmcore': self.read_tags(md)})]
+        frames = []
+        while self.mmc.getRemainingImageCount() > 0:
+            md = self.mm_module.Metadata()
+            buffer = self.mmc.popNextImageMD(md)
+            frames.append(self.make_frame(buffer, {'mmcore': self.read_tags(md)}))
+        return frames
+
+    def restart_after_overflow(self):
+        # micromanager ends the sequence when the circular buffer fills, frames were lost between the last one we
+        # read and now
+        self.buffer_overflows += 1
+        logging.warning(f'{self.name} circular buffer overflowed and frames were lost, restarting the sequence '
+                        f'({self.buffer_overflows} overflows so far)')
+        self.mmc.stopSequenceAcquisition()
+        self.mmc.clearCircularBuffer()
+        self.mmc.startContinuousSequenceAcquisition(1)
+
+    @staticmethod
+    def read_tags(md):
+        # the tags micromanager attached to the image (elapsed time, image number, camera properties...) as a dict
+        return {key: md.GetSingleTag(key).GetValue() for key in md.GetKeys()}
+
+    def set_exposure(self, exposure):
+        self.exposure = exposure
+        self.mmc.setProperty(self.label, 'Exposure', exposure)
+
+    def set_readout(self, roi, binning):
+        self.mmc.stopSequenceAcquisition()
+        try:
+            self.mmc.setProperty(self.label, 'Binning', str(binning))
+            if roi is None:
+                self.mmc.clearROI()
+            else:
+                # micromanager wants the roi in binned pixels
+                x, y, w, h = roi
+                self.mmc.setROI(x // binning, y // binning, w // binning, h // binning)
+            self.roi = roi
+            self.binning = binning
+        finally:
+            # nothing already acquired belongs to the new readout
+            self.mmc.clearCircularBuffer()
+            self.mmc.startContinuousSequenceAcquisition(1)
+
+
+class SimulatedCamera(MMCoreCamera):
+    # the micromanager backend talking to a synthetic camera, for load testing off the rig. the fake camera is set up
+    # from the environment the same way the backend is picked, anything unset keeps SimulatedCore's default. main.py
+    # has a --sim-* option for each of these
+    name = 'simulated'
+    options = {'bit_depth': ('OET_SIM_BIT_DEPTH', int, 'bits per pixel, 8 or 16'),
+               'jitter': ('OET_SIM_JITTER', float, 'frame timing jitter as a fraction of the exposure'),
+               'robot_count': ('OET_SIM_ROBOTS', int, 'robots drifting around the scene'),
+               'cell_count': ('OET_SIM_CELLS', int, 'cells scattered over the scene'),
+               'seed': ('OET_SIM_SEED', int, 'seed for the scene, noise and timing jitter')}
+
+    def get_options(self):
+        options = {}
+        for name, (variable, convert, _) in self.options.items():
+            value = os.environ.get(variable)
+            if value is None:
+                continue
+            try:
+                options[name] = convert(value)
+            except ValueError:
+                raise ValueError(f'{variable} should be {convert.__name__}, got: {value}')
+        return options
+
+    def create_core(self):
+        import simulated_camera
+        self.mm_module = simulated_camera
+        options = self.get_options()
+        logging.info(f'simulated camera options: {options}')
+        return simulated_camera.SimulatedCore(self.sensor_shape, **options)
+
+
+class HamamatsuCamera(CameraBackend):
+    # the hamamatsu driver pushes frames at us from its own thread, they wait in a queue until read_frames picks
+    # them up so the rest of the pipeline sees them just like polled frames
+    name = 'hamamatsu'
+    sensor_shape = (2048, 2048)
+
+    def __init__(self, exposure=200):
+        super(HamamatsuCamera, self).__init__(exposure)
+        self.hcam = None
+        self.incoming = queue.Queue(maxsize=64)
+        self.poll_timeout = 0.05
+
+    def open(self):
+        from control.micromanager import Camera
+        self.hcam = Camera()
+        self.sensor_shape = (Camera.height, Camera.width)
+
+    def start(self):
+        self.hcam.start_sequence_qt(self.frame_callback)
+
+    def stop(self):
+        # older versions of the driver can't stop a qt sequence, the frames just stop being read
+        if hasattr(self.hcam, 'stop_sequence'):
+            self.hcam.stop_sequence()
+
+    def close(self):
+        self.stop()
+
+    def frame_callback(self, buffer):
+        frame = self.make_frame(buffer)
+        try:
+            self.incoming.put_nowait(frame)
+        except queue.Full:
+            # nobody is reading, keep the newest
+            try:
+                self.incoming.get_nowait()
+            except queue.Empty:
+                pass
+            self.incoming.put_nowait(frame)
+
+    def read_frames(self, lossless=True):
+        try:
+            frames = [self.incoming.get(timeout=self.poll_timeout)]
+        except queue.Empty:
+            return []
+        while True:
+            try:
+                frames.append(self.incoming.get_nowait())
+            except queue.Empty:
+                break
+        return frames if lossless else frames[-1:]
+
+
+camera_backends = {'nikon': MMCoreCamera, 'hamamatsu': HamamatsuCamera, 'simulated': SimulatedCamera}
+
+
+def create_camera(name=None, exposure=200):
+    # OET_CAMERA=simulated runs everything against a fake camera
+    if name is None:
+        name = os.environ.get('OET_CAMERA', 'nikon')
+    if name not in camera_backends:
+        raise ValueError(f'unknown camera backend: {name}, choose from {list(camera_backends.keys())}')
+    logging.info(f'using camera backend: {name}')
+    return camera_backends[name](exposure)
@@ -1,61 +1,320 @@
 import cv2, os
 import numpy as np
 import logging
-import tensorflow as tf
+import threading
+import collections
 import time
 
-# load ai model
-model_loc = r'C:\Users\Mohamed\Desktop\Harrison\OET\cnn_models\8515_vaL_model_augmented_w_gfp_class_weighted2'
-try:
-    logging.info(f'loading AI detection model: {model_loc}\ntensorflow version: {tf.__version__}')
-    u_net = tf.keras.models.load_model(model_loc)
-    # blank inference to start the graph
-    u_net.predict(np.zeros((1, 2060, 2044, 1)))
-    logging.info('loaded AI detection model.')
-except Exception as e:
-    logging.warning(f'Failed to load AI detection model: {str(e)}')
-    logging.warning(f'CURRENT DIR: {os.getcwd()}')
-
-
-class MyMeanIOU(tf.keras.metrics.MeanIoU):
-
-    def update_state(self, y_true, y_pred, sample_weight=None):
-        return super().update_state(tf.argmax(y_true, axis=-1), tf.argmax(y_pred, axis=-1), sample_weight)
-
-
-def change_model(model_loc):
+# tensorflow and the model are only loaded when asked for, see start_model_loading. importing this module is cheap
+# so robot detection never waits on them
+# OET_CELL_MODEL picks another one, e.g. a .tflite export from model_tools.py
+model_loc = os.environ.get('OET_CELL_MODEL', r'C:\Users\Mohamed\Desktop\Harrison\OET\cnn_models'
+                                             r'\8515_vaL_model_augmented_w_gfp_class_weighted2')
+tf = None
+# the active model, replaced whole when switching so a predict already running keeps the one it started with
+u_net = None
+active_model_loc = None
+# a model_loc ending in .tflite runs through the tflite interpreter with this many threads instead of keras
+tflite_threads = os.cpu_count()
+# not loaded, loading, ready or failed
+model_state = 'not loaded'
+model_ready = threading.Event()
+
+
+def import_tensorflow():
+    global tf
+    if tf is None:
+        import tensorflow
+        tf = tensorflow
+    return tf
+
+
+def get_interpreter_class():
+    # the standalone tflite runtime if it's installed, it starts far quicker than all of tensorflow
     try:
-        logging.info(f'loading AI detection model: {model_loc}\ntensorflow version: {tf.__version__}')
+        from tflite_runtime.interpreter import Interpreter
+    except ImportError:
+        Interpreter = import_tensorflow().lite.Interpreter
+    return Interpreter
+
+
+class TFLiteModel():
+    # an exported (and maybe int8 quantized) copy of the u-net run through the tflite interpreter, see model_tools.py.
+    # looks like a keras model as far as predict goes, so it can go anywhere u_net does. the interpreter is resized
+    # whenever the input shape changes, which is what warming up a shape means here
+    def __init__(self, model_loc, num_threads=None):
+        self.model_loc = model_loc
+        self.num_threads = num_threads if num_threads is not None else tflite_threads
+        self.interpreter = get_interpreter_class()(model_path=model_loc, num_threads=self.num_threads)
+        self.interpreter.allocate_tensors()
+        self.input_details = self.interpreter.get_input_details()[0]
+        self.output_details = self.interpreter.get_output_details()[0]
+        self.input_shape = None
+
+    def quantize(self, batch):
+        dtype = self.input_details['dtype']
+        scale, zero_point = self.input_details['quantization']
+        if np.issubdtype(dtype, np.integer) and scale != 0:
+            info = np.iinfo(dtype)
+            return np.clip(np.round(batch / scale + zero_point), info.min, info.max).astype(dtype)
+        return batch.astype(dtype)
+
+    def dequantize(self, output):
+        scale, zero_point = self.output_details['quantization']
+        if np.issubdtype(output.dtype, np.integer) and scale != 0:
+            return (output.astype(np.float32) - zero_point) * scale
+        return output
+
+    def predict(self, batch):
+        batch = np.asarray(batch)
+        if batch.shape != self.input_shape:
+            self.interpreter.resize_tensor_input(self.input_details['index'], batch.shape, strict=False)
+            self.interpreter.allocate_tensors()
+            # resizing can hand back new tensor details, quantization included
+            self.input_details = self.interpreter.get_input_details()[0]
+            self.output_details = self.interpreter.get_output_details()[0]
+            self.input_shape = batch.shape
+        self.interpreter.set_tensor(self.input_details['index'], self.quantize(batch))
+        self.interpreter.invoke()
+        return self.dequantize(self.interpreter.get_tensor(self.output_details['index']))
+
+
+def get_mean_iou_class():
+    # the metric some of the models were saved with, it can only be defined once tensorflow is imported
+
+    class MyMeanIOU(tf.keras.metrics.MeanIoU):
+
+        def update_state(self, y_true, y_pred, sample_weight=None):
+            return super().update_state(tf.argmax(y_true, axis=-1), tf.argmax(y_pred, axis=-1), sample_weight)
+    return MyMeanIOU
+
+
+class ModelRegistry():
+    # the last few models we loaded, most recently used last, each with the input shapes it has already been run on
+    # (the first predict at a new shape builds the graph, which takes seconds). switching to a cached model is just
+    # pointing u_net at it, so a change lands between two predicts and never in the middle of one
+    warm_up_shape = (2060, 2044)
+
+    def __init__(self, capacity=2):
+        self.capacity = capacity
+        self.models = collections.OrderedDict()
+        self.lock = threading.Lock()
+        # one model loads at a time, loading the same one twice at once would just waste memory
+        self.load_lock = threading.Lock()
+
+    def __contains__(self, model_loc):
+        return model_loc in self.models
+
+    def load(self, model_loc):
+        if model_loc.endswith('.tflite'):
+            return TFLiteModel(model_loc)
+        import_tensorflow()
         if 'miou' in model_loc:
-            u_net = tf.keras.models.load_model(model_loc, custom_objects={'MyMeanIOU': MyMeanIOU})
-        else:
-            u_net = tf.keras.models.load_model(model_loc)
+            return tf.keras.models.load_model(model_loc, custom_objects={'MyMeanIOU': get_mean_iou_class()})
+        return tf.keras.models.load_model(model_loc)
+
+    def warm_up(self, entry, shape):
         # blank inference to start the graph
-        u_net.predict(np.zeros((1, 2060, 2044, 1)))
-        logging.info('loaded AI detection model.')
+        if shape not in entry['warmed_up']:
+            entry['model'].predict(np.zeros((1,) + tuple(shape) + (1,)))
+            entry['warmed_up'].add(shape)
+
+    def get(self, model_loc, timings=None):
+        # the cached entry, loaded and warmed up first if it isn't cached
+        timings = timings if timings is not None else {}
+        with self.load_lock:
+            with self.lock:
+                entry = self.models.get(model_loc)
+                if entry is not None:
+                    self.models.move_to_end(model_loc)
+            if entry is None:
+                t0 = time.perf_counter()
+                entry = {'model': self.load(model_loc), 'warmed_up': set()}
+                timings['load model'] = time.perf_counter() - t0
+            t0 = time.perf_counter()
+            self.warm_up(entry, self.warm_up_shape)
+            timings['warm up'] = time.perf_counter() - t0
+            with self.lock:
+                self.models[model_loc] = entry
+                self.evict(keep=model_loc)
+        return entry
+
+    def evict(self, keep=None):
+        # never the active model, it may be in the middle of a predict, nor the one about to become active
+        for cached_loc in list(self.models.keys()):
+            if len(self.models) <= self.capacity:
+                break
+            if cached_loc != keep and self.models[cached_loc]['model'] is not u_net:
+                logging.info(f'dropping cached AI detection model: {cached_loc}')
+                del self.models[cached_loc]
+
+    def mark_warmed_up(self, model, shape):
+        with self.lock:
+            for entry in self.models.values():
+                if entry['model'] is model:
+                    entry['warmed_up'].add(tuple(shape))
+
+    def get_cached(self):
+        with self.lock:
+            return {model_loc: sorted(entry['warmed_up']) for model_loc, entry in self.models.items()}
+
+
+model_registry = ModelRegistry()
+
+
+def load_model(model_loc=model_loc):
+    # import, load and warm up, timing each, then make it the active model. a cached model skips straight to the
+    # swap. blocks, so call it from a thread when there is a gui waiting
+    global u_net, model_state, active_model_loc
+    if not model_ready.is_set():
+        model_state = 'loading'
+    timings = {}
+    try:
+        if not model_loc.endswith('.tflite'):
+            t0 = time.perf_counter()
+            import_tensorflow()
+            timings['import tensorflow'] = time.perf_counter() - t0
+        cached = model_loc in model_registry
+        logging.info(f'loading AI detection model: {model_loc}{" (cached)" if cached else ""}\n'
+                     f'tensorflow version: {tf.__version__ if tf is not None else "not loaded"}')
+        entry = model_registry.get(model_loc, timings)
+        u_net = entry['model']
+        active_model_loc = model_loc
+        model_state = 'ready'
+        model_ready.set()
+        logging.info('loaded AI detection model: ' + ', '.join(f'{k} {v:.2f}s' for k, v in timings.items()))
     except Exception as e:
+        # whatever was active before stays active
+        model_state = 'ready' if model_ready.is_set() else 'failed'
         logging.warning(f'Failed to load AI detection model: {str(e)}')
         logging.warning(f'CURRENT DIR: {os.getcwd()}')
+    return timings
 
 
-def get_cell_overlay(img):
-    img = np.expand_dims(img, 0)
-    if len(img.shape) < 4:
-        img = np.expand_dims(img, -1)
+def start_model_loading(model_loc=model_loc, callback=None):
+    # loads on a background thread, callback gets (model_state, timings) from that thread once it is done
+    def load():
+        timings = load_model(model_loc)
+        if callback is not None:
+            callback(model_state, timings)
+    thread = threading.Thread(target=load, daemon=True)
+    thread.start()
+    return thread
 
-    t0 = time.time()
-    pred_mask = u_net.predict(img)
-    print(f'inference time: {time.time() - t0}')
-    pred_mask = tf.argmax(pred_mask, axis=-1)
 
-    red_mask = tf.where(pred_mask == 1, 255, 0)
-    green_mask = tf.where(pred_mask == 2, 255, 0)
+def change_model(model_loc):
+    # blocks until the model is loaded, cached models swap in straight away. see start_model_loading for a gui
+    return load_model(model_loc)
+
 
-    cell_detection_overlay = tf.stack((red_mask, green_mask, np.zeros(red_mask.shape)), axis=-1)
-    cell_detection_overlay = tf.squeeze(cell_detection_overlay)
+# full runs the model on the image as given, half and quarter shrink it first, tiled runs overlapping tiles over
+# an roi at the image's own resolution
+cell_inference_modes = ['full', 'half', 'quarter', 'tiled']
+cell_inference_scales = {'full': 1, 'half': 2, 'quarter': 4}
+# inputs are padded up to a multiple of this so every pooling level of the u-net divides evenly
+model_size_multiple = 16
 
-    cell_detection_overlay = tf.image.resize(cell_detection_overlay, (2048, 2060)).numpy().astype(np.uint8)
-    return cell_detection_overlay
+
+def to_batch(img):
+    img = np.expand_dims(img, 0)
+    if len(img.shape) < 4:
+        img = np.expand_dims(img, -1)
+    return img
+
+
+def pad_to_multiple(img, multiple=model_size_multiple, min_size=0):
+    height, width = img.shape[:2]
+    padded_height = max(-(-height // multiple) * multiple, min_size)
+    padded_width = max(-(-width // multiple) * multiple, min_size)
+    if (padded_height, padded_width) == (height, width):
+        return img
+    return cv2.copyMakeBorder(img, 0, padded_height - height, 0, padded_width - width, cv2.BORDER_CONSTANT, value=0)
+
+
+def classes_to_overlay(classes, shape):
+    # class 1 red, class 2 green, scaled to the (height, width) of the frame the overlay gets drawn over
+    overlay = np.zeros(classes.shape + (3,), dtype=np.uint8)
+    overlay[..., 0][classes == 1] = 255
+    overlay[..., 1][classes == 2] = 255
+    if overlay.shape[:2] != tuple(shape):
+        overlay = cv2.resize(overlay, (shape[1], shape[0]), interpolation=cv2.INTER_LINEAR)
+    return overlay
+
+
+def get_tile_starts(start, length, tile_size, step, limit):
+    # tile origins along one axis covering start to start + length, the last one pulled back to end on the edge
+    starts = list(range(start, start + max(length - tile_size, 0), step)) + [start + length - tile_size]
+    return sorted(set(min(max(s, 0), limit - tile_size) for s in starts))
+
+
+def get_tile_weight(tile_size, overlap):
+    # ramps down towards the tile edges so overlapping tiles fade into each other instead of leaving seams. never
+    # zero, where only one tile covers a pixel it just gets that tile's prediction
+    ramp = np.ones(tile_size, dtype=np.float32)
+    if overlap > 0:
+        edge = (np.arange(overlap, dtype=np.float32) + 1) / (overlap + 1)
+        ramp[:overlap] = edge
+        ramp[-overlap:] = edge[::-1]
+    return np.outer(ramp, ramp)[..., np.newaxis]
+
+
+def predict_tiled(model, img, roi, tile_size=512, overlap=64):
+    # class per pixel over the roi (x, y, width, height), from one batched predict of overlapping tiles
+    height, width = img.shape[:2]
+    x, y, roi_width, roi_height = roi
+    padded = pad_to_multiple(img, min_size=tile_size)
+    step = max(tile_size - overlap, 1)
+    xs = get_tile_starts(x, roi_width, tile_size, step, padded.shape[1])
+    ys = get_tile_starts(y, roi_height, tile_size, step, padded.shape[0])
+    origins = [(tx, ty) for ty in ys for tx in xs]
+    tiles = np.stack([padded[ty:ty + tile_size, tx:tx + tile_size] for tx, ty in origins])
+    probabilities = model.predict(tiles[..., np.newaxis] if tiles.ndim == 3 else tiles)
+
+    # blend everything the tiles cover, then cut the roi out of it
+    x0, y0 = xs[0], ys[0]
+    covered_height, covered_width = ys[-1] + tile_size - y0, xs[-1] + tile_size - x0
+    weighted = np.zeros((covered_height, covered_width, probabilities.shape[-1]), dtype=np.float32)
+    weights = np.zeros((covered_height, covered_width, 1), dtype=np.float32)
+    weight = get_tile_weight(tile_size, overlap)
+    for (tx, ty), tile_probabilities in zip(origins, probabilities):
+        weighted[ty - y0:ty - y0 + tile_size, tx - x0:tx - x0 + tile_size] += tile_probabilities * weight
+        weights[ty - y0:ty - y0 + tile_size, tx - x0:tx - x0 + tile_size] += weight
+    classes = np.argmax(weighted / weights, axis=-1).astype(np.uint8)
+    roi_height, roi_width = min(roi_height, height - y), min(roi_width, width - x)
+    return classes[y - y0:y - y0 + roi_height, x - x0:x - x0 + roi_width]
+
+
+def get_cell_overlay(img, shape=(2048, 2060), mode='full', roi=None, tile_size=512, overlap=64):
+    # roi is (x, y, width, height) in img's pixels and only used when tiled, None for the whole image. outside the
+    # roi the overlay is empty
+    if mode not in cell_inference_modes:
+        raise ValueError(f'unknown cell inference mode: {mode}, choose from {cell_inference_modes}')
+    # hold on to the model we start with, a swap while we're predicting only applies to the next call
+    model = u_net
+    if model is None:
+        raise RuntimeError(f'cell detection model is {model_state}')
+    t0 = time.time()
+    if mode == 'tiled':
+        height, width = img.shape[:2]
+        if roi is None:
+            roi = (0, 0, width, height)
+        x, y, roi_width, roi_height = roi
+        classes = np.zeros((height, width), dtype=np.uint8)
+        roi_classes = predict_tiled(model, img, roi, tile_size, overlap)
+        model_registry.mark_warmed_up(model, (tile_size, tile_size))
+        classes[y:y + roi_classes.shape[0], x:x + roi_classes.shape[1]] = roi_classes
+    elif mode == 'full':
+        classes = np.argmax(model.predict(to_batch(img))[0], axis=-1).astype(np.uint8)
+        model_registry.mark_warmed_up(model, img.shape[:2])
+    else:
+        scale = cell_inference_scales[mode]
+        small = cv2.resize(img, (img.shape[1] // scale, img.shape[0] // scale), interpolation=cv2.INTER_AREA)
+        padded = pad_to_multiple(small)
+        classes = np.argmax(model.predict(to_batch(padded))[0], axis=-1).astype(np.uint8)
+        model_registry.mark_warmed_up(model, padded.shape[:2])
+        classes = classes[:small.shape[0], :small.shape[1]]
+    logging.debug(f'inference time ({mode}): {time.time() - t0:.3f}s')
+    return classes_to_overlay(classes, shape)
 
 
 def detect_robots(img):
@@ -69,11 +328,12 @@ def detect_robots(img):
     return np.copy(filled)
 
 
-def get_large_contours(detect):
+def get_large_contours(detect, binning=1):
     # take a detection mask, and contour information add circles
     contours, hier = cv2.findContours(detect, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
     large_contours = []
-    contour_area_minimum = 2000
+    # calibrated on unbinned frames, binning shrinks areas by its square
+    contour_area_minimum = 2000 / binning ** 2
     for c in contours:
         if cv2.contourArea(c) > contour_area_minimum:
             large_contours.append(c)
@@ -92,7 +352,7 @@ def get_robot_angle(contour, center):
     return np.nanmean(np.where(val == 0, bin_centers, np.nan))
 
 
-def get_robots(large_contours, detect, objective):
+def get_robots(large_contours, detect, objective, binning=1):
     # get memory
     robot_control_mask = np.zeros(detect.shape)
     large_contour_image = cv2.drawContours(np.copy(robot_control_mask), large_contours, -1, 1, -1)
@@ -106,7 +366,7 @@ def get_robots(large_contours, detect, objective):
 
     robot_angles = []
     contours_towards_center = []
-    contour_range_border_limit = 100 * objective_calibration_dict[objective]
+    contour_range_border_limit = 100 * objective_calibration_dict[objective] / binning
 
     contours_in_limits = []
     for contour in large_contours:
@@ -114,7 +374,7 @@ def get_robots(large_contours, detect, objective):
         ys = np.squeeze(contour)[:, 1]
         # check that our contours are within acceptable limits, draw their circle if they are
         if np.all(xs > contour_range_border_limit) and np.all(
-                xs < large_contour_image.shape[0] - contour_range_border_limit):
+                xs < large_contour_image.shape[1] - contour_range_border_limit):
             if np.all(ys > contour_range_border_limit) and np.all(
                     ys < large_contour_image.shape[0] - contour_range_border_limit):
                 contours_in_limits.append(contour)
@@ -130,12 +390,68 @@ def get_robots(large_contours, detect, objective):
     return contours_towards_center, robot_angles
 
 
-def get_robot_control(img, objective):
+def get_robot_control(img, objective, binning=1):
     detected = detect_robots(img)
 
-    large_contours = get_large_contours(detected)
+    large_contours = get_large_contours(detected, binning)
 
     robots, robot_angles = get_robots(large_contours,
                                       detected,
-                                      objective)
+                                      objective,
+                                      binning)
     return robots, robot_angles
+
+
+def get_control_mask(shape, robots, objective, binning=1, buffer_size=10, dilation_size=30, open_robots=False):
+    # draws the dmd mask around every robot, green for the one being controlled
+    objective_calibration_dict = {'2x': [8, 0.25],
+                                  '4x': [4, 0.5],
+                                  '10x': [2, 1],
+                                  '20x': [1, 2],
+                                  '40x': [0.5, 4]}
+
+    robot_control_mask = np.zeros(tuple(shape[:2]) + (3,), dtype=np.uint8)
+
+    # everything is sized in unbinned pixels, so shrink it along with the binned frame
+    line_length = int(200 * objective_calibration_dict[objective][1] / binning)
+    line_width = max(1, int(80 * objective_calibration_dict[objective][1] / binning))
+    robot_center_radius = int(120 // objective_calibration_dict[objective][0] / binning)
+    buffer_size = max(1, buffer_size // binning)
+    dilation_size = max(1, dilation_size // binning)
+
+    for robot in robots:
+        contour = robots[robot]['contour']
+        angle = robots[robot]['angle']
+
+        M = cv2.moments(contour)
+        cx = int(M["m10"] / M["m00"])
+        cy = int(M["m01"] / M["m00"])
+
+        # draw the contours on our control mask
+        if 'control' in robots[robot].keys():
+            if robots[robot]['control']:
+                # green for the controlled robot
+                robot_control_mask = cv2.drawContours(robot_control_mask, [contour], -1, (0, 255, 0), -1)
+                cv2.circle(robot_control_mask, (cx, cy), robot_center_radius, (0, 255, 0), -1)
+        else:
+            # red for all non-controlled, but detected robots
+            robot_control_mask = cv2.drawContours(robot_control_mask, [contour], -1, (255, 0, 0), -1)
+            cv2.circle(robot_control_mask, (cx, cy), robot_center_radius, (255, 0, 0), -1)
+
+        if open_robots:
+            # draw a blank line to remove the opening for the robot
+            try:
+                cv2.line(robot_control_mask, (cx, cy),
+                         (cx + int(line_length * np.cos(angle)), cy + int(line_length * np.sin(angle))), (0, 0, 0),
+                         line_width)
+            except Exception as e:
+                logging.warning('failed to draw line to open robots')
+
+    robot_control_mask = cv2.dilate(robot_control_mask, np.ones((buffer_size, buffer_size)))
+
+    dilation = np.copy(robot_control_mask)
+    dilation = cv2.dilate(dilation, np.ones((dilation_size, dilation_size)) * 255).astype(np.uint8)
+
+    robot_control_mask = dilation - robot_control_mask
+
+    return robot_control_mask
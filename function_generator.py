@@ -5,6 +5,11 @@ import logging
 class FunctionGenerator():
 
     def __init__(self):
+        # the last values we set, so the rest of the program can know the state without querying the instrument
+        self.voltage = None
+        self.frequency = None
+        self.waveform = None
+        self.output = False
         # hard coded for now...for some reason ResourceManager.list_resources() hangs indefinitely
         failure = False
         try:
@@ -31,21 +36,25 @@ class FunctionGenerator():
 
     def set_voltage(self, voltage):
         self.connection.write(f'SOURce:VOLTage:LEVel:IMMediate:AMPLitude {voltage}')
+        self.voltage = voltage
         ret = self.connection.query('VOLT?')
         logging.info(f'voltage set to {ret}')
 
     def set_frequency(self, frequency):
         self.connection.write(f'SOURce:FREQuency {frequency}')
+        self.frequency = frequency
         ret = self.connection.query('FREQ?')
         logging.info(f'frequency set to {ret}')
 
     def set_waveform(self, waveform):
         self.connection.write(f'FUNC {waveform}')
+        self.waveform = waveform
         ret = self.connection.query('FUNC?')
         logging.info(f'waveform set to {ret}')
 
     def change_output(self, output):
         self.connection.write(f'OUTP {output}')
+        self.output = str(output).upper() in ['1', 'ON']
         ret = self.connection.query('OUTP?')
         logging.info(f'function generator output: {ret}')
 
@@ -1,39 +1,35 @@
-import os, sys, time
+import os, time
+import threading
 from time import strftime
 import logging
+import queue
 import names
 import numpy as np
-from PyQt5 import QtCore, QtGui, QtWidgets
+from PyQt5 import QtCore, QtGui
 import cv2
-import enum
-from control.micromanager import Camera
-from detection import get_robot_control, get_cell_overlay
-import imageio_ffmpeg
+from acquisition import AcquisitionWorker
+from camera import Frame, create_camera
+from recording import RecordingWriter, FfmpegSink, RawChunkSink, PreTriggerBuffer, ScreenshotWriter
+from pipeline import FramePool, DisplayMailbox, FrameProcessor, LutLookup
+from profiler import PipelineProfiler
+from inference import InferenceWorker
+from metadata import InstrumentState, MetadataSidecar
+from detection import get_robot_control, get_cell_overlay, get_control_mask, model_ready
 import matplotlib.pyplot as plt
 
 
-class CameraType(enum.Enum):
-    HAMAMATSU = 1
-    NIKON = 2
-
-
-camera_type = CameraType.NIKON
-
-if camera_type is CameraType.NIKON:
-    NATIVE_CAMERA_WIDTH = 2048
-    NATIVE_CAMERA_HEIGHT = 2060
-if camera_type == 'hamamatsu':
-    NATIVE_CAMERA_WIDTH = 2048
-    NATIVE_CAMERA_HEIGHT = 2048
-
-
 class imageProcessor(QtCore.QThread):
     # VideoSignal = QtCore.pyqtSignal(QtGui.QImage)
     VideoSignal = QtCore.pyqtSignal('PyQt_PyObject')
     robot_signal = QtCore.pyqtSignal('PyQt_PyObject')
     fps_signal = QtCore.pyqtSignal('PyQt_PyObject')
+    frame_available_signal = QtCore.pyqtSignal()
+    readout_signal = QtCore.pyqtSignal('PyQt_PyObject')
+    stats_signal = QtCore.pyqtSignal('PyQt_PyObject')
+    # a recording ended without the record button being pressed, e.g. the readout changed under it
+    recording_stopped_signal = QtCore.pyqtSignal()
 
-    def __init__(self, height, width, parent=None):
+    def __init__(self, height, width, camera_name=None, parent=None):
         super(imageProcessor, self).__init__(parent)
         self.exposure = 200
         self.resize_lock = QtCore.QMutex()
@@ -45,17 +41,79 @@ class imageProcessor(QtCore.QThread):
         self.robots = {}
         self.recording = False
         self.writer = None
+        # the format the open writer was made for, a change to recording_format waits for the next recording
+        self.writer_format = None
+        # frames are written on their own thread, the policy says what happens when it can't keep up
+        self.recording_policy = 'block'
+        # mp4 is 8 bit and lossy, raw keeps the camera's full bit depth in memory mapped chunks
+        self.recording_format = 'mp4'
+        self.recording_queue_size = 64
+        # every recorded frame gets a row of camera and instrument state in a sidecar next to the video, see
+        # metadata.MetadataSidecar. the window keeps instrument_state up to date
+        self.instrument_state = InstrumentState()
+        self.metadata_sidecar = None
+        self.video_frames = 0
+        # the latest detection results and the frame they came from, they go in the rows of every frame after it
+        self.reset_detection_results()
+        # the last few seconds before record is pressed, written at the start of every recording. off until the gui
+        # gives it a length
+        self.pretrigger_buffer = PreTriggerBuffer()
         self.fps = None
         self.video_dir = 'C:\\Users\\Mohamed\\Desktop\\Harrison\\Videos\\'
+        self.calibration_dir = 'C:\\Users\\Mohamed\\Desktop\\Harrison\\OET\\calibration\\'
+        self.profile_dir = 'C:\\Users\\Mohamed\\Desktop\\Harrison\\OET\\profiles\\'
+        self.screenshot_dir = 'C:\\Users\\Mohamed\\Desktop\\Harrison\\Screenshots\\'
+        # stills are encoded on their own thread. a screenshot is burst_length consecutive frames off the camera,
+        # each saved at full bit depth, plus the overlays drawn over the 8 bit frame if screenshot_overlays is on
+        self.screenshot_writer = ScreenshotWriter()
+        self.screenshot_writer.start()
+        self.burst_length = 1
+        self.screenshot_overlays = False
+        self.screenshot_name = ''
+        self.screenshots_pending = 0
+        self.screenshots_taken = 0
         self.vid_name = ''
-        self.image_adjustment_params = {'clahe': False, 'clip': 3.0, 'grid': 8, 'threshold': False,
-                                        'threshold_percent': 50}
+        # display resolution buffers are handed to the viewer and come back through release_display_frame
+        self.display_pools = {}
+        self.display_pool_size = 3
+        # only the newest processed frame waits here for the viewer, anything it replaces counts as skipped
+        self.display_mailbox = DisplayMailbox(discard_callback=self.release_display_frame)
+
+        # lossless acquisition drains every frame out of the micromanager circular buffer into our own queue,
+        # otherwise we only ever grab the most recent frame and skip whatever arrived in between polls
+        self.lossless_acquisition = True
+        self.frame_queue_size = 32
+        self.frame_queue = queue.Queue(maxsize=self.frame_queue_size)
+        self.frame_count = 0
+        self.frames_processed = 0
+        self.frames_displayed = 0
+        # the newest frame we processed, with its timestamp and metadata
+        self.last_frame = None
+        self.fps_t0 = time.time()
+        self.fps_acquired_t0 = 0
+        # per stage timings and drop counts, shown in the stats dock and written out once a second
+        self.profiler = PipelineProfiler()
+        # picked at runtime, see camera.create_camera
+        self.camera = create_camera(camera_name, self.exposure)
+        # conversion, correction, adjustment and display rendering, shared with the offline replay harness
+        self.frame_processor = FrameProcessor(self.calibration_dir, self.camera.name, self.profiler,
+                                              shape_changed_callback=self.reset_overlays)
+
+        # camera readout, roi is (x, y, width, height) in unbinned sensor pixels, None for the full sensor. the
+        # frames that come back are the roi divided by the binning, and everything downstream just follows their shape
+        self.roi = None
+        self.binning = 1
+
+        # cell inference takes far longer than a frame, so it runs on its own thread on the newest frame it can get
+        # and the overlay catches up whenever it finishes
+        self.cell_inference_worker = InferenceWorker(self.infer_cells, 'cell inference')
+        self.cell_inference_worker.overlay_ready_signal.connect(self.cell_overlay_slot)
+        self.cell_overlay_staleness = 0
+        # see detection.get_cell_overlay, roi is in frame pixels. replaced whole so the worker never sees half an update
+        self.cell_inference_params = {'mode': 'full', 'roi': None, 'tile_size': 512, 'overlap': 64}
 
         logging.info('initializing camera...')
-        if camera_type is CameraType.NIKON:
-            self.init_nikon()
-        if camera_type is CameraType.HAMAMATSU:
-            self.init_hamamatsu()
+        self.init_camera()
 
         self.run_video = True
         self.window_size = QtCore.QSize(self.height, self.width)
@@ -65,55 +123,37 @@ class imageProcessor(QtCore.QThread):
 
 
         # initialize all of our empty masks
-        self.path_overlay = np.zeros((NATIVE_CAMERA_WIDTH, NATIVE_CAMERA_HEIGHT, 3), dtype=np.uint8)
-        self.robot_detection_overlay = np.zeros((NATIVE_CAMERA_WIDTH, NATIVE_CAMERA_HEIGHT, 3), dtype=np.uint8)
-        self.cell_detection_overlay = np.zeros((NATIVE_CAMERA_WIDTH, NATIVE_CAMERA_HEIGHT, 3), dtype=np.uint8)
+        self.reset_overlays(self.camera.sensor_shape)
 
-        self.image = np.zeros((NATIVE_CAMERA_WIDTH, NATIVE_CAMERA_HEIGHT))
+        self.image = np.zeros(self.camera.sensor_shape)
         self.window_size = QtCore.QSize(self.height, self.width)  # original image size
         self.qt_image = QtGui.QImage(self.image.data, self.height,
                                      self.width, QtGui.QImage.Format_Grayscale8)
 
 
 
-    def init_nikon(self):
-        # start micromanager and grab camera
-        mm_directory = 'C:\\Program Files\\Micro-Manager-2.0gamma'
-        sys.path.append(mm_directory)
-        os.chdir(mm_directory)
-
-        import MMCorePy
+    def init_camera(self):
         try:
-            self.mmc = MMCorePy.CMMCore()
-            self.mmc.setCircularBufferMemoryFootprint(500)
-            self.mmc.loadDevice('camera', 'PCO_Camera', 'pco_camera')
-            self.mmc.initializeAllDevices()
-            self.mmc.setCameraDevice('camera')
-            properties = self.mmc.getDevicePropertyNames('camera')
-            self.mmc.setProperty('camera', 'PixelRate', 'fast scan')
-            self.mmc.setProperty('camera', 'Noisefilter', 'Off')
-            self.mmc.setProperty('camera', 'Exposure', self.exposure)
-            # self.mmc.setProperty('camera', 'PixelType', '8bit')
-            for p in properties:
-                log_string = p + str(self.mmc.getProperty('camera', p)) + ': ' + \
-                             str(self.mmc.getAllowedPropertyValues('camera', p))
-                logging.info(log_string)
-            self.mmc.startContinuousSequenceAcquisition(1)
+            self.camera.open()
+            self.camera.start()
             self.run_video = True
-        except:
-            logging.critical('failed to connect to camera')
-
-    def init_hamamatsu(self):
-        self.hcam = Camera()
-        self.width = Camera.width
-        self.height = Camera.height
-        self.hcam.start_sequence_qt(self.process_and_emit_image)
+        except Exception as e:
+            logging.critical(f'failed to connect to camera: {e}')
+        # frames are pulled off the camera on their own thread and handed to us through the frame queue, whichever
+        # backend they come from
+        self.acquisition_worker = AcquisitionWorker(self.camera, self.frame_queue, lossless=self.lossless_acquisition,
+                                                    profiler=self.profiler)
+        self.acquisition_worker.frame_ready_signal.connect(self.process_frames_slot)
 
     def __del__(self):
         try:
             logging.info('closing camera...')
-            self.mmc.stopSequenceAcquisition()
-            self.mmc.reset()
+            self.acquisition_worker.stop()
+            self.screenshot_writer.stop()
+            if self.cell_inference_worker.isRunning():
+                self.cell_inference_worker.stop()
+            self.profiler.close()
+            self.camera.close()
         except:
             logging.critical('failed to terminate connection to camera')
 
@@ -127,76 +167,194 @@ class imageProcessor(QtCore.QThread):
     @QtCore.pyqtSlot()
     def startVideo(self):
         logging.info('starting video stream...')
-        count = 0
-        t0 = time.time()
-        QtWidgets.QApplication.processEvents()
-        while self.run_video:
-            QtWidgets.QApplication.processEvents()
-            if self.mmc.getRemainingImageCount() > 0:
-                try:
-                    img = self.mmc.getLastImage()
-                    # img = np.right_shift(img, 1)
-                    img = (img / 256).astype(np.uint8)
-                    if self.recording:
-                        self.writer.send(img)
-                    self.image = img
-                except Exception as e:
-                    logging.warning(f'camera dropped frame {count}, {e}')
-                # self.VideoSignal.emit(img)
-                self.process_and_emit_image(img)
-                count += 1
-                if count % 5 == 0:
-                    if self.robot_detection:
-                        self.run_robot_detection()
-                    if self.cell_detection:
-                        self.run_cell_detection()
-                if count % 20 == 0:
-                    # calculate our fps and send it to be shown on status bar
-                    t1 = time.time()
-                    self.fps = min(20 / (t1 - t0), 1000/self.exposure)
-                    t0 = t1
-                    self.fps_signal.emit(self.fps)
-            else:
-                count += 1
-                logging.info(f'Camera dropped frame: {count}')
-            QtWidgets.QApplication.processEvents()
+        self.run_video = True
+        self.fps_t0 = time.time()
+        self.fps_acquired_t0 = self.acquisition_worker.frames_acquired
+        if self.profiler.csv_file is None:
+            self.profiler.start_session(self.profile_dir)
+        if not self.acquisition_worker.isRunning():
+            self.acquisition_worker.start()
+
+    @QtCore.pyqtSlot()
+    def process_frames_slot(self):
+        # take everything the acquisition worker has queued up so far, frames arriving while we work wait for
+        # the next call so a fast camera can't keep us in here forever
+        newest = None
+        for _ in range(self.frame_queue.qsize()):
+            try:
+                frame = self.frame_queue.get_nowait()
+            except queue.Empty:
+                break
+            newest = frame
+            # converting is the slow part, raw and 16 bit paths take the camera buffer as it is and only frames
+            # that end up 8 bit somewhere get converted. the newest is converted for the display below
+            img = None
+            if self.needs_conversion():
+                img = self.frame_processor.convert(frame.buffer)
+            if self.screenshots_pending > 0:
+                self.capture_screenshot(frame, img)
+            if self.recording:
+                if self.writer_format == 'raw':
+                    # the camera hands us a fresh buffer for every frame, so it can go straight to the writer
+                    written = self.writer.submit(frame.buffer, frame.timestamp, frame.index)
+                else:
+                    # img is our scratch buffer, the writer gets its own copy
+                    written = self.writer.submit(img.copy(), frame.timestamp, frame.index)
+                self.write_metadata_row(frame, written)
+            elif self.pretrigger_buffer.seconds > 0:
+                # the instrument state goes with it so the history gets the right metadata rows
+                extra = (frame.metadata, self.instrument_state.snapshot())
+                if self.pretrigger_buffer.bit_depth == 16:
+                    self.pretrigger_buffer.push(frame.buffer, frame.timestamp, frame.index, frame.monotonic, extra)
+                else:
+                    self.pretrigger_buffer.push(img, frame.timestamp, frame.index, frame.monotonic, extra, copy=True)
+            self.frames_processed += 1
+        # run_video is off while the window is being resized, that only pauses the display, every frame above has
+        # still been recorded
+        if newest is None or not self.run_video:
+            return
+        frame = newest
+        if img is None:
+            img = self.frame_processor.convert(frame.buffer)
+        self.last_frame = frame
+        self.image = self.frame_processor.correct_illumination(img)
+
+        # only the newest frame gets shown, the rest were recorded above
+        self.process_and_emit_image(self.image)
+        self.frame_count += 1
+        if self.cell_detection and model_ready.is_set():
+            # the worker only keeps the newest frame, so every frame can go
+            self.cell_inference_worker.submit(self.image, frame.index, frame.monotonic)
+        if self.frame_count % 5 == 0:
+            if self.robot_detection:
+                with self.profiler.time('robot detection'):
+                    self.run_robot_detection()
+        self.update_fps()
+
+    def needs_conversion(self):
+        # whether the frame being processed is needed in 8 bit before the display gets to it
+        if self.screenshots_pending > 0 and self.screenshot_overlays:
+            return True
+        if self.recording:
+            return self.writer_format != 'raw'
+        return self.pretrigger_buffer.seconds > 0 and self.pretrigger_buffer.bit_depth != 16
+
+    def write_metadata_row(self, frame, written, instrument_state=None):
+        # video_frame is where the frame ended up in the recording, -1 if the writer had to drop it. pre-trigger
+        # frames bring their own instrument state and have no detection results
+        row = {'frame': frame.index, 'video_frame': self.video_frames if written else -1,
+               'timestamp': frame.timestamp, 'monotonic': frame.monotonic}
+        if written:
+            self.video_frames += 1
+        metadata = frame.metadata
+        row['exposure'] = metadata.get('exposure')
+        row['binning'] = metadata.get('binning')
+        roi = metadata.get('roi')
+        if roi is not None:
+            row['roi_x'], row['roi_y'], row['roi_width'], row['roi_height'] = roi
+        if instrument_state is not None:
+            row.update(instrument_state)
+            self.metadata_sidecar.append(row, camera_metadata=metadata.get('mmcore'))
+            return
+        row.update(self.instrument_state.snapshot())
+        row.update(self.detection_results)
+        self.metadata_sidecar.append(row, self.pending_detections, metadata.get('mmcore'))
+        self.pending_detections = None
+
+    def update_fps(self):
+        t1 = time.time()
+        if t1 - self.fps_t0 < 1:
+            return
+        # report the rate of frames that actually reached us from the camera
+        frames_acquired = self.acquisition_worker.frames_acquired
+        self.fps = (frames_acquired - self.fps_acquired_t0) / (t1 - self.fps_t0)
+        self.fps_t0 = t1
+        self.fps_acquired_t0 = frames_acquired
+        self.fps_signal.emit(self.fps)
+        frames_skipped = self.display_mailbox.frames_skipped
+        logging.debug(f'frames acquired: {frames_acquired}, processed: {self.frames_processed}, '
+                      f'displayed: {self.frames_displayed - frames_skipped}, skipped for display: {frames_skipped}, '
+                      f'overflowed: {self.acquisition_worker.frames_overflowed}, '
+                      f'camera buffer overflows: {self.camera.buffer_overflows}')
+        self.update_stats(frames_acquired, frames_skipped)
+
+    def update_stats(self, frames_acquired, frames_skipped):
+        self.profiler.set_counter('fps', round(self.fps, 2))
+        self.profiler.set_counter('frames acquired', frames_acquired)
+        self.profiler.set_counter('frames processed', self.frames_processed)
+        self.profiler.set_counter('frames displayed', self.frames_displayed - frames_skipped)
+        self.profiler.set_counter('dropped: queue overflow', self.acquisition_worker.frames_overflowed)
+        self.profiler.set_counter('dropped: camera buffer overflows', self.camera.buffer_overflows)
+        self.profiler.set_counter('dropped: display skipped', frames_skipped)
+        self.profiler.set_counter('dropped: display buffers busy',
+                                  sum(pool.exhausted for pool in self.display_pools.values()))
+        if self.recording:
+            for name, value in self.writer.get_stats().items():
+                self.profiler.set_counter(f'recording: {name}', value)
+        elif self.pretrigger_buffer.seconds > 0:
+            for name, value in self.pretrigger_buffer.get_stats().items():
+                self.profiler.set_counter(f'pre-trigger: {name}', value)
+        if self.cell_detection:
+            for name, value in self.cell_inference_worker.get_stats().items():
+                self.profiler.set_counter(f'cell inference: {name}', value)
+            self.profiler.set_counter('cell inference: staleness frames', self.cell_overlay_staleness)
+        stats, counters = self.profiler.get_stats()
+        self.profiler.write_snapshot(stats, counters)
+        self.stats_signal.emit((stats, counters))
+
+    def reset_overlays(self, shape):
+        # the readout changed, anything drawn in the old frame's pixels no longer lines up
+        overlay_shape = tuple(shape[:2]) + (3,)
+        self.path_overlay = np.zeros(overlay_shape, dtype=np.uint8)
+        self.robot_detection_overlay = np.zeros(overlay_shape, dtype=np.uint8)
+        self.cell_detection_overlay = np.zeros(overlay_shape, dtype=np.uint8)
+        self.frame_processor.overlay_compositor.set_layer('robot', self.robot_detection_overlay)
+        self.frame_processor.overlay_compositor.set_layer('path', self.path_overlay)
+        self.frame_processor.overlay_compositor.set_layer('cell', self.cell_detection_overlay)
+        self.robots = {}
+
+    def get_display_pool(self, shape):
+        if shape not in self.display_pools:
+            self.display_pools[shape] = FramePool(shape, count=self.display_pool_size)
+        return self.display_pools[shape]
+
+    def release_display_frame(self, np_img):
+        # called once the viewer has finished painting a frame we gave it
+        if np_img is not None and np_img.shape in self.display_pools:
+            self.display_pools[np_img.shape].release(np_img)
 
     def process_and_emit_image(self, np_img):
         # np_img is native resolution from camera
+        np_img = self.frame_processor.adjust(np_img)
 
-        # apply all of our visual adjustments to the feed
-        if self.image_adjustment_params['threshold']:
-            # first remove our hot pixels
-            median = np.median(np_img)
-            np_img[np.where(np_img > 2 * median)] = 0
-            percent = self.image_adjustment_params['threshold_percent']
-            _, binary_inv = cv2.threshold(np_img, int(percent * 255), 255, cv2.THRESH_BINARY_INV)
-            _, to_zero = cv2.threshold(np_img, int(percent * 255), 255, cv2.THRESH_TOZERO)
-            np_img = binary_inv + to_zero
-        if self.image_adjustment_params['clahe']:
-            clahe = cv2.createCLAHE(clipLimit=self.image_adjustment_params['clip'],
-                                    tileGridSize=(int(self.image_adjustment_params['grid']),
-                                                  int(self.image_adjustment_params['grid'])))
-            np_img = clahe.apply(np_img)
-        if self.robot_detection:
-            np_img = cv2.cvtColor(np_img, cv2.COLOR_GRAY2BGR)
-            np_img = cv2.addWeighted(np_img, 1, self.robot_detection_overlay, 0.8, 0)
-            np_img = cv2.addWeighted(np_img, 1, self.path_overlay, 0.8, 0)
-        if self.cell_detection:
-            np_img = cv2.cvtColor(np_img, cv2.COLOR_GRAY2RGB)
-            np_img = cv2.addWeighted(np_img, 1, self.cell_detection_overlay, 0.8, 0)
-        # resize
+        # scale down to the window first so colouring and blending only touch display resolution pixels. the
+        # result goes into a display buffer the viewer will give back to us once it has painted it
         self.resize_lock.lock()
-        np_img = cv2.resize(np_img, (self.window_size.width(), self.window_size.height()))
+        display_size = (self.window_size.width(), self.window_size.height())
+        pool = self.get_display_pool(self.frame_processor.get_display_shape(display_size))
+        display_img = pool.acquire()
+        if display_img is not None:
+            self.frame_processor.render_display_frame(np_img, display_size, display_img)
         self.resize_lock.unlock()
+        if display_img is None:
+            # the viewer is still holding every buffer, it is behind so there is no point in sending another
+            return
 
-        # emit our array, whatever shape it may be
+        # hand our array over, whatever shape it may be. the viewer is only poked when the mailbox was empty,
+        # otherwise it already has a pending notification and will pick up this newer frame instead
         if self.run_video:
-            self.VideoSignal.emit(np_img)
+            self.frames_displayed += 1
+            with self.profiler.time('emit'):
+                if self.display_mailbox.post(display_img):
+                    self.frame_available_signal.emit()
+        else:
+            pool.release(display_img)
 
     @QtCore.pyqtSlot('PyQt_PyObject')
     def toggle_robot_detection_slot(self, state):
         self.robot_detection = state
+        self.frame_processor.overlay_compositor.set_enabled('robot', state)
+        self.frame_processor.overlay_compositor.set_enabled('path', state)
         if not self.robot_detection:
             self.clear_paths_overlay_slot()
             self.robots = {}
@@ -204,70 +362,58 @@ class imageProcessor(QtCore.QThread):
     @QtCore.pyqtSlot('PyQt_PyObject')
     def toggle_cell_detection_slot(self, state):
         self.cell_detection = state
+        self.frame_processor.overlay_compositor.set_enabled('cell', state)
+        if state and not self.cell_inference_worker.isRunning():
+            self.cell_inference_worker.start()
+
+    def infer_cells(self, img):
+        # runs on the inference worker. at full resolution the model gets its training size, so scale to that and
+        # back, the other modes do their own scaling or tiling of the frame
+        params = self.cell_inference_params
+        if params['mode'] == 'full':
+            model_img = cv2.resize(img, (2044, 2060))
+            return get_cell_overlay(model_img, img.shape[:2])
+        return get_cell_overlay(img, img.shape[:2], params['mode'], params['roi'], params['tile_size'],
+                                params['overlap'])
 
-    def run_cell_detection(self):
-        # process current image to find cells
-        self.image = cv2.resize(self.image, (2044, 2060))
-        self.cell_detection_overlay = get_cell_overlay(np.copy(self.image))
-
-
-    def get_control_mask(self, robots):
-        objective_calibration_dict = {'2x': [8, 0.25],
-                                      '4x': [4, 0.5],
-                                      '10x': [2, 1],
-                                      '20x': [1, 2],
-                                      '40x': [0.5, 4]}
-
-        robot_control_mask = np.zeros(self.image.shape + (3,), dtype=np.uint8)
-
-        line_length = int(200 * objective_calibration_dict[self.objective][1])
-        line_width = int(80 * objective_calibration_dict[self.objective][1])
-        robot_center_radius = 120 // objective_calibration_dict[self.objective][0]
-
-        for robot in robots:
-            contour = robots[robot]['contour']
-            angle = robots[robot]['angle']
-
-            M = cv2.moments(contour)
-            cx = int(M["m10"] / M["m00"])
-            cy = int(M["m01"] / M["m00"])
-
-            # draw the contours on our control mask
-            if 'control' in robots[robot].keys():
-                if robots[robot]['control']:
-                    # green for the controlled robot
-                    robot_control_mask = cv2.drawContours(robot_control_mask, [contour], -1, (0, 255, 0), -1)
-                    cv2.circle(robot_control_mask, (cx, cy), robot_center_radius, (0, 255, 0), -1)
-            else:
-                # red for all non-controlled, but detected robots
-                robot_control_mask = cv2.drawContours(robot_control_mask, [contour], -1, (255, 0, 0), -1)
-                cv2.circle(robot_control_mask, (cx, cy), robot_center_radius, (255, 0, 0), -1)
-
-            if self.open_robots:
-                # draw a blank line to remove the opening for the robot
-                try:
-                    cv2.line(robot_control_mask, (cx, cy),
-                             (cx + int(line_length * np.cos(angle)), cy + int(line_length * np.sin(angle))), (0, 0, 0),
-                             line_width)
-                except Exception as e:
-                    logging.warning('failed to draw line to open robots')
-
-        robot_control_mask = cv2.dilate(robot_control_mask, np.ones((self.buffer_size, self.buffer_size)))
-
-        dilation = np.copy(robot_control_mask)
-        dilation = cv2.dilate(dilation, np.ones((self.dilation_size, self.dilation_size)) * 255).astype(np.uint8)
+    @QtCore.pyqtSlot('PyQt_PyObject')
+    def set_cell_inference_params_slot(self, params):
+        cell_inference_params = dict(self.cell_inference_params)
+        cell_inference_params.update(params)
+        self.cell_inference_params = cell_inference_params
+        logging.info(f'cell inference params set: {cell_inference_params}')
 
-        robot_control_mask = dilation - robot_control_mask
+    @QtCore.pyqtSlot('PyQt_PyObject')
+    def cell_overlay_slot(self, result):
+        overlay = result['overlay']
+        if self.last_frame is None or overlay.shape[:2] != self.image.shape[:2]:
+            # the readout changed while the model was running, it doesn't line up any more
+            return
+        # how far behind the live frame the overlay is, in frames and in time since its frame arrived
+        self.cell_overlay_staleness = self.last_frame.index - result['frame']
+        self.profiler.record('cell inference', result['latency'])
+        self.profiler.record('cell overlay age', time.monotonic() - result['monotonic'])
+        if not self.cell_detection:
+            return
+        self.cell_detection_overlay = overlay
+        self.frame_processor.overlay_compositor.set_layer('cell', self.cell_detection_overlay)
+        if self.recording:
+            self.detection_results['cell_pixels_red'] = np.count_nonzero(overlay[..., 0])
+            self.detection_results['cell_pixels_green'] = np.count_nonzero(overlay[..., 1])
+            self.detection_results['cell_detection_frame'] = result['frame']
 
-        return robot_control_mask
 
     def run_robot_detection(self):
         # process current image to find robots
-        robot_contours, robot_angles = get_robot_control(self.image, self.objective)
+        robot_contours, robot_angles = get_robot_control(self.image, self.objective, self.binning)
 
         if len(robot_contours) == 0:
-            # no robots found
-            self.detection_overlay.fill(0)
+            # no robots found. a new array rather than clearing this one, a screenshot may still be holding it
+            self.robot_detection_overlay = np.zeros_like(self.robot_detection_overlay)
+            self.frame_processor.overlay_compositor.set_layer('robot', self.robot_detection_overlay)
+            if self.recording:
+                self.detection_results['robot_count'] = 0
+                self.detection_results['robot_detection_frame'] = self.last_frame.index
             return
 
         if self.robots == {}:
@@ -280,7 +426,30 @@ class imageProcessor(QtCore.QThread):
             # update our understanding of the robots
             self.update_robot_information(robot_contours, robot_angles)
 
-        self.robot_detection_overlay = self.get_control_mask(self.robots).astype(np.uint8)
+        self.robot_detection_overlay = get_control_mask(self.image.shape, self.robots, self.objective, self.binning,
+                                                        self.buffer_size, self.dilation_size,
+                                                        self.open_robots).astype(np.uint8)
+        self.frame_processor.overlay_compositor.set_layer('robot', self.robot_detection_overlay)
+        if self.recording:
+            self.record_robot_detections()
+
+    def reset_detection_results(self):
+        # a new recording starts without any, -1 frames mean nothing has been detected in it yet
+        self.detection_results = {'robot_count': 0, 'robot_detection_frame': -1, 'cell_pixels_red': 0,
+                                  'cell_pixels_green': 0, 'cell_detection_frame': -1}
+        self.pending_detections = None
+
+    def record_robot_detections(self):
+        # robot positions in frame pixels, written to the sidecar with the next row
+        robots = {}
+        for name, robot in self.robots.items():
+            M = cv2.moments(robot['contour'])
+            if M['m00'] == 0:
+                continue
+            robots[name] = {'cx': M['m10'] / M['m00'], 'cy': M['m01'] / M['m00'], 'angle': float(robot['angle'])}
+        self.detection_results['robot_count'] = len(robots)
+        self.detection_results['robot_detection_frame'] = self.last_frame.index
+        self.pending_detections = {'frame': self.last_frame.index, 'robots': robots}
 
     @QtCore.pyqtSlot('PyQt_PyObject')
     def robot_control_slot(self, payload):
@@ -317,13 +486,15 @@ class imageProcessor(QtCore.QThread):
         nearest_robot = None
         nearest_robot_cx = None
         nearest_robot_cy = None
+        # contours live in the current frame's pixels, which the viewer stretches over the whole window
+        frame_height, frame_width = self.image.shape[:2]
         for robot in self.robots:
             contour = self.robots[robot]['contour']
             M = cv2.moments(contour)
 
             # unit normalize our native image width and the window width for comparison
-            cx = int(M["m10"] / M["m00"]) / NATIVE_CAMERA_WIDTH
-            cy = int(M["m01"] / M["m00"]) / NATIVE_CAMERA_HEIGHT
+            cx = int(M["m10"] / M["m00"]) / frame_width
+            cy = int(M["m01"] / M["m00"]) / frame_height
             click_x = payload['start_x'] / self.width
             click_y = payload['start_y'] / self.height
 
@@ -340,7 +511,7 @@ class imageProcessor(QtCore.QThread):
 
     @QtCore.pyqtSlot('PyQt_PyObject')
     def image_adjustment_params_slot(self, image_adjustment_params):
-        self.image_adjustment_params = image_adjustment_params
+        self.frame_processor.set_params(image_adjustment_params)
 
     @QtCore.pyqtSlot('PyQt_PyObject')
     def path_slot(self, payload):
@@ -362,20 +533,23 @@ class imageProcessor(QtCore.QThread):
         self.draw_paths()
 
     def draw_paths(self):
-        self.path_overlay = np.zeros((NATIVE_CAMERA_WIDTH, NATIVE_CAMERA_HEIGHT, 3), dtype=np.uint8)
+        self.path_overlay = np.zeros(self.path_overlay.shape, dtype=np.uint8)
+        frame_height, frame_width = self.path_overlay.shape[:2]
         # find closest contour, color the robot the same as the path, and draw it
         for robot in self.robots:
             if 'path_start_x' in self.robots[robot].keys():
-                start_x_scaled = int(self.robots[robot]['path_start_x'] * NATIVE_CAMERA_WIDTH)
-                start_y_scaled = int(self.robots[robot]['path_start_y'] * NATIVE_CAMERA_HEIGHT)
-                end_x_scaled = int(self.robots[robot]['path_end_x'] * NATIVE_CAMERA_WIDTH)
-                end_y_scaled = int(self.robots[robot]['path_end_y'] * NATIVE_CAMERA_HEIGHT)
+                start_x_scaled = int(self.robots[robot]['path_start_x'] * frame_width)
+                start_y_scaled = int(self.robots[robot]['path_start_y'] * frame_height)
+                end_x_scaled = int(self.robots[robot]['path_end_x'] * frame_width)
+                end_y_scaled = int(self.robots[robot]['path_end_y'] * frame_height)
                 cv2.line(self.path_overlay, (start_x_scaled, start_y_scaled),
                          (end_x_scaled, end_y_scaled), (0, 255, 0), 2)
+        self.frame_processor.overlay_compositor.set_layer('path', self.path_overlay)
 
     @QtCore.pyqtSlot()
     def clear_paths_overlay_slot(self):
-        self.path_overlay = np.zeros((NATIVE_CAMERA_WIDTH, NATIVE_CAMERA_HEIGHT, 3), dtype=np.uint8)
+        self.path_overlay = np.zeros(self.path_overlay.shape, dtype=np.uint8)
+        self.frame_processor.overlay_compositor.set_layer('path', self.path_overlay)
 
     @QtCore.pyqtSlot(QtCore.QSize, 'PyQt_PyObject')
     def resize_slot(self, size, running):
@@ -387,6 +561,8 @@ class imageProcessor(QtCore.QThread):
         self.resize_lock.lock()
         self.width = size.width()
         self.height = size.height()
+        # buffers still out with the viewer at the old size just get dropped when they come back
+        self.display_pools = {}
         self.image = np.zeros((self.height, self.width), dtype=np.uint8)
         self.VideoSignal.emit(self.image)
 
@@ -400,29 +576,189 @@ class imageProcessor(QtCore.QThread):
             self.draw_paths()
         self.resize_lock.unlock()
 
+    @QtCore.pyqtSlot()
+    def calibrate_hot_pixels_slot(self):
+        # the camera should be looking at nothing (shutters closed, lamps off) while this runs
+        self.frame_processor.hot_pixel_map.start_calibration()
+
+    @QtCore.pyqtSlot('PyQt_PyObject')
+    def optical_config_slot(self, config_name):
+        self.frame_processor.flat_field.load(config_name)
+        # the old background belongs to the old optics
+        self.frame_processor.background_model.reset()
+
+    @QtCore.pyqtSlot()
+    def capture_flat_field_slot(self):
+        # the camera should be looking at an empty, evenly lit field while this runs
+        self.frame_processor.flat_field.start_capture()
+
+    @QtCore.pyqtSlot('PyQt_PyObject')
+    def set_roi_slot(self, roi):
+        self.set_camera_readout(roi, self.binning)
+
+    @QtCore.pyqtSlot('PyQt_PyObject')
+    def set_binning_slot(self, binning):
+        self.set_camera_readout(self.roi, int(binning))
+
+    def get_readout(self):
+        # sensor size is (width, height)
+        return {'roi': self.roi, 'binning': self.binning,
+                'sensor_size': (self.camera.sensor_shape[1], self.camera.sensor_shape[0])}
+
+    def set_camera_readout(self, roi, binning):
+        if self.recording:
+            # the video writer was opened for the old frame size
+            logging.info('readout changing, stopping recording')
+            self.stop_video_slot()
+        logging.info(f'setting camera readout, roi: {roi}, binning: {binning}')
+        try:
+            self.camera.set_readout(roi, binning)
+        except Exception as e:
+            logging.warning(f'failed to set camera readout: {e}')
+        self.roi = self.camera.roi
+        self.binning = self.camera.binning
+        # the pre-trigger history is the old frame size
+        self.pretrigger_buffer.clear()
+        # nothing already queued belongs to the new readout
+        while not self.frame_queue.empty():
+            try:
+                self.frame_queue.get_nowait()
+            except queue.Empty:
+                break
+        self.readout_signal.emit(self.get_readout())
+
     @QtCore.pyqtSlot('PyQt_PyObject')
     def set_exposure_slot(self, exposure):
         self.exposure = exposure
-        self.mmc.setProperty('camera', 'Exposure', self.exposure)
+        self.camera.set_exposure(self.exposure)
         logging.info(f'exposure set: {self.exposure}')
 
     @QtCore.pyqtSlot()
     def take_screenshot_slot(self):
-        cv2.imwrite(
-            'C:\\Users\\Mohamed\\Desktop\\Harrison\\Screenshots\\' + strftime('%Y_%m_%d_%H_%M_%S.png', time.gmtime()),
-            self.image)
+        # the frames themselves are picked up as they come in, see capture_screenshot
+        name = strftime('%Y_%m_%d_%H_%M_%S', time.gmtime())
+        if self.burst_length > 1:
+            name = os.path.join(name + '_burst', name)
+        self.screenshot_name = self.screenshot_dir + name
+        self.screenshots_taken = 0
+        self.screenshots_pending = self.burst_length
+        logging.info(f'screenshot: {self.screenshot_name}, {self.burst_length} frames')
+
+    def capture_screenshot(self, frame, img):
+        # frame.buffer is fresh from the camera so the writer can have it, img is our scratch buffer so it gets copied
+        path = self.screenshot_name
+        if self.burst_length > 1:
+            path += f'_{self.screenshots_taken:04d}_frame_{frame.index}'
+        if self.screenshot_overlays:
+            # the live layers keep changing under the writer, it gets copies
+            layers = [layer.copy() for layer in self.frame_processor.overlay_compositor.get_visible_layers()]
+            self.screenshot_writer.submit(path, frame.buffer, img.copy(), layers)
+        else:
+            self.screenshot_writer.submit(path, frame.buffer)
+        self.screenshots_taken += 1
+        self.screenshots_pending -= 1
+
+    @QtCore.pyqtSlot('PyQt_PyObject')
+    def set_screenshot_params_slot(self, params):
+        self.burst_length = max(int(params['burst_length']), 1)
+        self.screenshot_overlays = params['overlays']
 
     @QtCore.pyqtSlot()
     def start_recording_video_slot(self):
-        self.vid_name = self.video_dir + strftime('%Y_%m_%d_%H_%M_%S.mp4', time.gmtime())
+        self.writer_format = self.recording_format
+        if self.writer_format == 'raw':
+            # a directory of chunks plus the frame index, read it back with recording.RawRecording
+            self.vid_name = self.video_dir + strftime('%Y_%m_%d_%H_%M_%S_raw', time.gmtime())
+            sink = RawChunkSink(self.vid_name)
+        else:
+            self.vid_name = self.video_dir + strftime('%Y_%m_%d_%H_%M_%S.mp4', time.gmtime())
+            # size is (width, height) of whatever the camera is currently reading out
+            native_shape = self.frame_processor.native_shape
+            if native_shape is not None:
+                size = (native_shape[1], native_shape[0])
+            else:
+                size = (self.camera.sensor_shape[1], self.camera.sensor_shape[0])
+            # play back at the rate we're actually getting frames
+            fps = round(self.fps) if self.fps else 30
+            sink = FfmpegSink(self.vid_name, size, fps=max(fps, 1))
         logging.info(f'recording video: {self.vid_name} at {self.fps}fps')
-        self.writer = imageio_ffmpeg.write_frames(self.vid_name, (2060, 2048), macro_block_size=1, pix_fmt_in='gray',
-                                                  fps=30)
-        self.writer.send(None)
+        history, history_convert = self.get_pretrigger_history()
+        self.writer = RecordingWriter(sink, self.recording_queue_size, self.recording_policy,
+                                      spill_dir=self.video_dir,
+                                      history=[(buffer, timestamp, index) for buffer, timestamp, index, _, _ in history],
+                                      history_convert=history_convert)
+        self.metadata_sidecar = MetadataSidecar(os.path.splitext(self.vid_name)[0] + '_metadata')
+        self.video_frames = 0
+        self.reset_detection_results()
+        for _, timestamp, index, monotonic, (metadata, instrument_state) in history:
+            self.write_metadata_row(Frame(None, timestamp, index, metadata, monotonic), True, instrument_state)
+        self.writer.start()
         self.recording = True
 
+    def get_pretrigger_history(self):
+        # what the pre-trigger buffer is holding, and how to turn it into what this recording's sink wants
+        history = self.pretrigger_buffer.take()
+        if len(history) == 0:
+            return [], None
+        logging.info(f'recording starts with {len(history)} pre-trigger frames, '
+                     f'{history[-1][3] - history[0][3]:.2f}s')
+        if self.writer_format == 'raw':
+            if self.pretrigger_buffer.bit_depth == 8:
+                logging.warning('pre-trigger buffer is 8 bit, raw recordings need the camera frames, '
+                                'starting without history')
+                return [], None
+            return history, None
+        if self.pretrigger_buffer.bit_depth == 16:
+            # converted on the writer thread with the table in use right now, the live view keeps its own
+            lut = self.frame_processor.lut_converter.lut
+            # its own index buffer, it runs on the writer thread
+            lookup = LutLookup()
+
+            def history_convert(buffer):
+                return lookup.apply(lut, buffer)
+            return history, history_convert
+        return history, None
+
+    @QtCore.pyqtSlot('PyQt_PyObject')
+    def set_pretrigger_slot(self, params):
+        # seconds of history (0 turns it off), the memory it may use in MB, and 8 or 16 bit frames
+        self.pretrigger_buffer.configure(params['seconds'], params['max_mb'], params['bit_depth'])
+        logging.info(f'pre-trigger buffer set: {params}')
+
     @QtCore.pyqtSlot()
     def stop_video_slot(self):
+        if not self.recording:
+            # already stopped, e.g. by a readout change before the button caught up
+            return
         self.recording = False
-        self.writer.close()
-        logging.info(f'video: {self.vid_name} finished recording')
+        self.recording_stopped_signal.emit()
+        # the writer can have a long spill backlog to get through, wait for it on a thread of its own so the live
+        # view keeps going. not a daemon, so quitting still waits for the recording to be finished
+        finisher = threading.Thread(target=self.finish_recording, name='recording finisher',
+                                    args=(self.writer, self.metadata_sidecar, self.vid_name))
+        finisher.start()
+        self.writer = None
+        self.writer_format = None
+        self.metadata_sidecar = None
+
+    def finish_recording(self, writer, metadata_sidecar, vid_name):
+        # returns once everything queued has been written
+        writer.stop()
+        metadata_sidecar.close()
+        logging.info(f'video: {vid_name} finished recording, {metadata_sidecar.rows_written} metadata rows')
+
+    @QtCore.pyqtSlot('PyQt_PyObject')
+    def set_recording_format_slot(self, recording_format):
+        # picked up by the next recording, the one in progress keeps writing what its sink was made for
+        self.recording_format = recording_format
+        if self.recording:
+            logging.warning(f'recording format set to {recording_format} during a recording, '
+                            f'it applies to the next one')
+        else:
+            logging.info(f'recording format set: {recording_format}')
+
+    @QtCore.pyqtSlot('PyQt_PyObject')
+    def set_recording_policy_slot(self, policy):
+        # picked up by the next recording
+        self.recording_policy = policy
+        logging.info(f'recording policy set: {policy}')
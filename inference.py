@@ -0,0 +1,77 @@
+import logging
+import threading
+import time
+import numpy as np
+from PyQt5 import QtCore
+
+
+class InferenceWorker(QtCore.QThread):
+    # runs a slow model on its own thread so the stream never waits for it. only the newest submitted frame is kept,
+    # a frame that arrives while another is waiting replaces it, so whenever the model is free it starts on the most
+    # recent frame we have. results come back through overlay_ready_signal tagged with the frame they belong to
+    overlay_ready_signal = QtCore.pyqtSignal('PyQt_PyObject')
+
+    def __init__(self, infer, name='inference', parent=None):
+        super(InferenceWorker, self).__init__(parent)
+        # infer takes an image and returns the overlay, it is only ever called from this thread
+        self.infer = infer
+        self.name = name
+        self.condition = threading.Condition()
+        self.running = False
+        # frames are copied into one of two buffers, the one waiting and the one the model is working on
+        self.pending_buffer = None
+        self.working_buffer = None
+        self.pending_frame = None
+        self.frames_submitted = 0
+        self.frames_replaced = 0
+        self.frames_inferred = 0
+
+    def submit(self, img, frame_index, monotonic):
+        # img can be a scratch buffer, it is copied. monotonic is when the frame arrived, for the overlay's age
+        with self.condition:
+            if self.pending_buffer is None or self.pending_buffer.shape != img.shape or \
+                    self.pending_buffer.dtype != img.dtype:
+                self.pending_buffer = np.empty_like(img)
+            np.copyto(self.pending_buffer, img)
+            if self.pending_frame is not None:
+                self.frames_replaced += 1
+            self.pending_frame = (frame_index, monotonic)
+            self.frames_submitted += 1
+            self.condition.notify()
+
+    def start(self):
+        # set here rather than in run so a stop straight after start can't be missed
+        self.running = True
+        super(InferenceWorker, self).start()
+
+    def run(self):
+        logging.info(f'{self.name} worker started')
+        while True:
+            with self.condition:
+                while self.pending_frame is None and self.running:
+                    self.condition.wait()
+                if not self.running:
+                    break
+                self.pending_buffer, self.working_buffer = self.working_buffer, self.pending_buffer
+                frame_index, monotonic = self.pending_frame
+                self.pending_frame = None
+            t0 = time.perf_counter()
+            try:
+                overlay = self.infer(self.working_buffer)
+            except Exception as e:
+                logging.warning(f'{self.name} failed: {e}')
+                continue
+            self.frames_inferred += 1
+            self.overlay_ready_signal.emit({'overlay': overlay, 'frame': frame_index, 'monotonic': monotonic,
+                                            'latency': time.perf_counter() - t0})
+        logging.info(f'{self.name} worker stopped')
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.wait()
+
+    def get_stats(self):
+        return {'submitted': self.frames_submitted, 'inferred': self.frames_inferred,
+                'replaced': self.frames_replaced}
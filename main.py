@@ -2,6 +2,9 @@ import logging, time, sys, os
 import pickle
 from time import strftime
 
+startup_t0 = time.perf_counter()
+
+# cheap, tensorflow and the cell model are loaded in the background once the window is up
 import detection
 
 log_name = strftime('..\\logs\\%Y_%m_%d_%H_%M_%S.log', time.gmtime())
@@ -10,6 +13,7 @@ logging.getLogger().addHandler(logging.StreamHandler(sys.stdout))
 # logging.getLogger().addHandler(logging.Formatter(fmt=' %(name)s :: %(levelname)-8s :: %(message)s'.replace('\n', '')))
 # from inputs import get_gamepad
 import names, re
+import argparse
 import PyQt5.QtGui
 from PyQt5 import QtCore, QtGui, QtWidgets, QtTest
 from function_generator import FunctionGenerator
@@ -22,23 +26,39 @@ import cv2
 import matplotlib.pyplot as plt
 import numpy as np
 from GUI import GUI
+from profiler import StartupTimer
+from camera import SimulatedCamera
 import threading
 
 
 class Window(GUI):
     start_video_signal = QtCore.pyqtSignal()
     set_camera_exposure_signal = QtCore.pyqtSignal('PyQt_PyObject')
+    set_camera_roi_signal = QtCore.pyqtSignal('PyQt_PyObject')
+    set_camera_binning_signal = QtCore.pyqtSignal('PyQt_PyObject')
     screenshot_signal = QtCore.pyqtSignal()
+    screenshot_params_signal = QtCore.pyqtSignal('PyQt_PyObject')
     start_record_video_signal = QtCore.pyqtSignal()
     stop_record_video_signal = QtCore.pyqtSignal()
+    recording_policy_signal = QtCore.pyqtSignal('PyQt_PyObject')
+    recording_format_signal = QtCore.pyqtSignal('PyQt_PyObject')
+    pretrigger_signal = QtCore.pyqtSignal('PyQt_PyObject')
+    model_loaded_signal = QtCore.pyqtSignal('PyQt_PyObject', 'PyQt_PyObject')
+    model_changed_signal = QtCore.pyqtSignal('PyQt_PyObject', 'PyQt_PyObject')
     enable_robot_detection_signal = QtCore.pyqtSignal('PyQt_PyObject')
     enable_cell_detection_signal = QtCore.pyqtSignal('PyQt_PyObject')
     update_detection_params_signal = QtCore.pyqtSignal('PyQt_PyObject')
     image_adjustment_params_signal = QtCore.pyqtSignal('PyQt_PyObject')
     toggle_scale_bar_signal = QtCore.pyqtSignal('PyQt_PyObject')
+    calibrate_hot_pixels_signal = QtCore.pyqtSignal()
+    optical_config_signal = QtCore.pyqtSignal('PyQt_PyObject')
+    capture_flat_field_signal = QtCore.pyqtSignal()
 
-    def __init__(self):
+    def __init__(self, camera_name=None, startup_timer=None):
         super(Window, self).__init__()
+        self.startup_timer = startup_timer if startup_timer is not None else StartupTimer()
+        # None lets the image processor pick, see camera.create_camera
+        self.camera_name = camera_name
         self.unavailable_instruments = []
         self.dmd = False
         self.unavailable_instruments.append('DMD')
@@ -95,15 +115,24 @@ class Window(GUI):
         self.fps = 0
         self.stage_pos = (0, 0)
         self.pump_status = ''
+        # z comes from the microscope sdk, which the gui thread is also using, so it is read less often than the
+        # rest: every z_poll_recording seconds while recording, every z_poll_idle seconds otherwise
+        self.z_poll_recording = 0.5
+        self.z_poll_idle = 5
+        self.last_z_poll = 0
         self.detection_model_loc = r'C:\Users\Mohamed\Desktop\Harrison\OET\cnn_models' \
                                    r'\8515_vaL_model_augmented_w_gfp_class_weighted2 '
         self.default_directory = r'C:\Users\Mohamed\Desktop\Harrison'
         self.gui_update_thread = threading.Thread(target=self.get_system_position, daemon=True)
+        # not loaded, loading, ready or failed, see detection.start_model_loading
+        self.detection_model_state = detection.model_state
 
         if self.dmd:
             dmd_start_thread.join()
+        self.startup_timer.mark('instruments')
         self.setupUI(self)
         self.initialize_gui_state()
+        self.startup_timer.mark('gui and camera')
 
         self.image_processing.robot_signal.connect(self.robot_control_slot)
 
@@ -116,6 +145,24 @@ class Window(GUI):
         self.update_detection_params()
         self.showMaximized()
         self.gui_update_thread.start()
+        # the model loads once the event loop is running, so the window gets drawn first
+        self.model_loaded_signal.connect(self.model_loaded_slot)
+        self.model_changed_signal.connect(self.model_changed_slot)
+        QtCore.QTimer.singleShot(0, self.start_model_loading)
+
+    def start_model_loading(self):
+        self.startup_timer.mark('window shown')
+        self.detection_model_state = 'loading'
+        self.detectCellsPushButton.setEnabled(False)
+        detection.start_model_loading(detection.model_loc, callback=self.model_loaded_signal.emit)
+
+    @QtCore.pyqtSlot('PyQt_PyObject', 'PyQt_PyObject')
+    def model_loaded_slot(self, state, timings):
+        self.detection_model_state = state
+        for phase, seconds in timings.items():
+            self.startup_timer.add(f'cell model {phase}', seconds)
+        self.startup_timer.mark(f'cell model {state}')
+        self.detectCellsPushButton.setEnabled(state == 'ready')
 
     def start_dmd(self):
         self.dmd = Polygon1000(1140, 912)
@@ -138,12 +185,49 @@ class Window(GUI):
                     self.pump_status = self.pump.get_pump_status()
                 else:
                     self.pump_status = 'disconnected'
-
-                time.sleep(.1)
             except Exception as e:
                 logging.info(f'minor error encountered when communicating with system: {e}')
-        # response = self.microscope.get_z()
-        # z = float(response.iZPOSITION)
+            self.update_instrument_state()
+            time.sleep(.1)
+
+    def update_instrument_state(self):
+        # goes into the per frame metadata of every recording, see metadata.InstrumentState
+        # each instrument on its own, one failing shouldn't leave the others stale
+        state = {}
+        try:
+            state['stage_x'], state['stage_y'] = float(self.stage_pos[0]), float(self.stage_pos[1])
+        except Exception as e:
+            logging.info(f'minor error encountered when reading stage state: {e}')
+        if self.microscope:
+            z_poll = self.z_poll_recording if self.image_processing.recording else self.z_poll_idle
+            if time.monotonic() - self.last_z_poll >= z_poll:
+                self.last_z_poll = time.monotonic()
+                try:
+                    state['z'] = float(self.microscope.get_z().iZPOSITION)
+                except Exception as e:
+                    logging.info(f'minor error encountered when reading microscope state: {e}')
+        if self.fluorescence_controller:
+            try:
+                state['fluorescence_intensity'] = self.fluorescence_controller.current_intensity
+                state['fluorescence_lamp'] = self.fluorescence_controller.lamp_index
+            except Exception as e:
+                logging.info(f'minor error encountered when reading fluorescence state: {e}')
+        if self.dmd:
+            try:
+                state['dmd_pattern_hash'] = self.dmd.pattern_hash
+            except Exception as e:
+                logging.info(f'minor error encountered when reading dmd state: {e}')
+        try:
+            state.update(self.get_function_generator_state())
+        except Exception as e:
+            logging.info(f'minor error encountered when reading function generator state: {e}')
+        self.image_processing.instrument_state.update(state)
+
+    def get_function_generator_state(self):
+        if not self.function_generator:
+            return {}
+        return {'fg_voltage': self.function_generator.voltage, 'fg_frequency': self.function_generator.frequency,
+                'fg_output': int(self.function_generator.output)}
 
     @QtCore.pyqtSlot('PyQt_PyObject')
     def fps_slot(self, fps):
@@ -153,7 +237,8 @@ class Window(GUI):
         spacer = ' ' * 20
         self.statusBar.showMessage(f'Controls: Arrows->XY, PageU/D->Z, ESC->HALT, Space->FG ON/OFF, WASD->Robot Move'
                                    f'{spacer}FPS: {fps:.2f}{spacer}POSITION: {x}mm, {y}mm{spacer}'
-                                   f'PUMP: {self.pump_status}{spacer} DETECTOR: {self.detection_model_loc}')
+                                   f'PUMP: {self.pump_status}{spacer} DETECTOR ({self.detection_model_state}): '
+                                   f'{self.detection_model_loc}')
 
     def bookmark_current_location(self):
         x, y = self.stage_pos
@@ -186,6 +271,7 @@ class Window(GUI):
         self.microscope.load_config(status)
         self.microscope.get_status()
         self.update_gui_state(loading=True)
+        self.optical_config_signal.emit(text)
         # TODO: need to set xylis configs and exposure
 
     def go_to_current_optical_config(self):
@@ -264,9 +350,9 @@ class Window(GUI):
         x = event.pos().x()
         y = event.pos().y()
 
-        # scale everything
-        unit_scaled_viewer_x = x / self.image_viewer.width()
-        unit_scaled_viewer_y = y / self.image_viewer.height()
+        # scale everything, to fractions of the full sensor like the calibration whatever the roi
+        unit_scaled_viewer_x, unit_scaled_viewer_y = self.image_viewer.to_sensor_coords(x / self.image_viewer.width(),
+                                                                                        y / self.image_viewer.height())
 
         # see if we are calibrated
         if len(self.image_viewer.calibration_payload) < 2:
@@ -483,10 +569,14 @@ class Window(GUI):
         # now we crop out the sections that cannot be illuminated by the dmd
         # need an offset (difference between image width and viewer width)
         offset = int(0.5 * (self.image_viewer.width() - img.shape[0]))
-        dmd_start_x = int(self.image_viewer.calibration_payload[0][0] * self.image_viewer.width() - offset)
-        dmd_end_x = int(self.image_viewer.calibration_payload[-1][0] * self.image_viewer.width() - offset)
-        dmd_start_y = int(self.image_viewer.calibration_payload[0][1] * self.image_viewer.height())
-        dmd_end_y = int(self.image_viewer.calibration_payload[-1][1] * self.image_viewer.height())
+        # the calibration is in fractions of the full sensor, back to the window for the current roi
+        (start_x, start_y), (end_x, end_y) = [self.image_viewer.from_sensor_coords(x, y) for x, y in
+                                              (self.image_viewer.calibration_payload[0],
+                                               self.image_viewer.calibration_payload[-1])]
+        dmd_start_x = int(start_x * self.image_viewer.width() - offset)
+        dmd_end_x = int(end_x * self.image_viewer.width() - offset)
+        dmd_start_y = int(start_y * self.image_viewer.height())
+        dmd_end_y = int(end_y * self.image_viewer.height())
         img = img[dmd_start_y:dmd_end_y, dmd_start_x:dmd_end_x]
 
         # final resize to adjust to exact dimensions for dmd projection
@@ -500,6 +590,10 @@ class Window(GUI):
     def apply_image_adjustment(self, value):
 
         clahe = self.imageAdjustmentClahePushButton.isChecked()
+        clahe_display_only = self.imageAdjustmentClaheDisplayOnlyPushButton.isChecked()
+        flat_field = self.imageAdjustmentFlatFieldPushButton.isChecked()
+        background_subtraction = self.imageAdjustmentBackgroundPushButton.isChecked()
+        background_mode = self.imageAdjustmentBackgroundModeComboBox.currentText()
         clip = self.imageAdjustmentClaheClipValueDoubleSpinBox.value()
         grid = self.imageAdjustmentClaheGridValueDoubleSpinBox.value()
 
@@ -507,10 +601,45 @@ class Window(GUI):
         threshold_percent = self.imageAdjustmentThresholdSlider.value() / 100
         self.imageAdjustmentThresholdLabel.setText(str(self.imageAdjustmentThresholdSlider.value()))
 
+        auto_range = self.imageAdjustmentAutoRangePushButton.isChecked()
+        black_level = self.imageAdjustmentBlackLevelSpinBox.value()
+        white_level = self.imageAdjustmentWhiteLevelSpinBox.value()
+        gamma = self.imageAdjustmentGammaDoubleSpinBox.value()
+        self.imageAdjustmentBlackLevelSpinBox.setEnabled(not auto_range)
+        self.imageAdjustmentWhiteLevelSpinBox.setEnabled(not auto_range)
+
         image_adjustment_params = {'clahe': clahe, 'clip': clip, 'grid': grid, 'threshold': threshold,
-                                   'threshold_percent': threshold_percent}
+                                   'threshold_percent': threshold_percent, 'auto_range': auto_range,
+                                   'black_level': black_level, 'white_level': white_level, 'gamma': gamma,
+                                   'clahe_display_only': clahe_display_only, 'flat_field': flat_field,
+                                   'background_subtraction': background_subtraction,
+                                   'background_mode': background_mode}
         self.image_adjustment_params_signal.emit(image_adjustment_params)
 
+    def calibrate_hot_pixels(self):
+        reply = QtWidgets.QMessageBox.question(self, 'Hot Pixel Calibration',
+                                               'Close all shutters and turn off all lamps so the camera sees a dark '
+                                               'frame, then press OK to calibrate.',
+                                               QtWidgets.QMessageBox.Ok | QtWidgets.QMessageBox.Cancel,
+                                               QtWidgets.QMessageBox.Cancel)
+        if reply == QtWidgets.QMessageBox.Ok:
+            logging.info('starting hot pixel calibration')
+            self.calibrate_hot_pixels_signal.emit()
+
+    def capture_flat_field(self):
+        if self.opticalConfigComboBox.currentText() == 'New':
+            QtWidgets.QMessageBox.about(self, 'Flat Field', 'Save or select an optical config first, flat fields '
+                                                            'are stored per optical config.')
+            return
+        reply = QtWidgets.QMessageBox.question(self, 'Flat Field',
+                                               'Move to an empty, evenly lit area of the chip, then press OK to '
+                                               'capture.',
+                                               QtWidgets.QMessageBox.Ok | QtWidgets.QMessageBox.Cancel,
+                                               QtWidgets.QMessageBox.Cancel)
+        if reply == QtWidgets.QMessageBox.Ok:
+            logging.info(f'capturing flat field for {self.opticalConfigComboBox.currentText()}')
+            self.capture_flat_field_signal.emit()
+
     @QtCore.pyqtSlot('PyQt_PyObject')
     def robot_control_slot(self, robot_signal):
         logging.info(robot_signal)
@@ -528,17 +657,44 @@ class Window(GUI):
         file_name = QtWidgets.QFileDialog.getExistingDirectory(self,
                                                                'Open detection model',
                                                                self.default_directory + '/OET/cnn_models')
-        self.detection_model_loc = file_name
-        detection.change_model(file_name)
+        if not file_name:
+            return
+        # the current model keeps running until the new one is loaded and warmed up, cached ones swap straight in
+        self.detection_model_state = 'switching'
+        detection.start_model_loading(file_name, callback=self.model_changed_signal.emit)
+
+    @QtCore.pyqtSlot('PyQt_PyObject', 'PyQt_PyObject')
+    def model_changed_slot(self, state, timings):
+        self.detection_model_state = state
+        self.detection_model_loc = detection.active_model_loc
+        logging.info(f'detection model now {self.detection_model_loc}, cached: '
+                     f'{list(detection.model_registry.get_cached().keys())}')
 
 
     def toggleVideoRecording(self):
         state = self.takeVideoPushbutton.isChecked()
+        # the open recording can't change format
+        self.recordingFormatComboBox.setEnabled(not state)
         if state:
             self.start_record_video_signal.emit()
         else:
             self.stop_record_video_signal.emit()
 
+    @QtCore.pyqtSlot()
+    def recordingStopped(self):
+        # the image processor can stop a recording by itself, e.g. when the readout changes
+        self.takeVideoPushbutton.setChecked(False)
+        self.recordingFormatComboBox.setEnabled(True)
+
+    def setScreenshotParams(self):
+        self.screenshot_params_signal.emit({'burst_length': self.screenshotBurstSpinBox.value(),
+                                            'overlays': self.screenshotOverlaysPushButton.isChecked()})
+
+    def setPretrigger(self):
+        bit_depth = int(self.pretriggerBitDepthComboBox.currentText().split(' ')[0])
+        self.pretrigger_signal.emit({'seconds': self.pretriggerSecondsDoubleSpinBox.value(),
+                                     'max_mb': self.pretriggerMemorySpinBox.value(), 'bit_depth': bit_depth})
+
     def toggleFluorescenceLamp(self):
         state = self.fluorescenceToggleLampPushButton.isChecked()
         if state:
@@ -601,6 +757,8 @@ class Window(GUI):
     def toggleFgOutput(self):
         state = self.fgOutputTogglePushButton.isChecked()
         self.function_generator.change_output(int(state))
+        # don't wait for the next poll, the frames right after this should already show the change
+        self.image_processing.instrument_state.update(self.get_function_generator_state())
 
     def toggleDrawPaths(self):
         state = self.drawPathsPushButton.isChecked()
@@ -679,6 +837,7 @@ class Window(GUI):
         self.function_generator.set_voltage(v)
         self.function_generator.set_frequency(f)
         self.function_generator.set_waveform(w)
+        self.image_processing.instrument_state.update(self.get_function_generator_state())
 
     def changeMagnification(self, text):
         if self.detectRobotsPushButton.isChecked():
@@ -708,14 +867,52 @@ class Window(GUI):
     def setCameraExposure(self, exposure):
         self.set_camera_exposure_signal.emit(exposure)
 
+    def setCameraBinning(self, binning):
+        self.set_camera_binning_signal.emit(int(binning))
+
+    def setCameraROI(self, text):
+        if text == 'Full Frame':
+            self.set_camera_roi_signal.emit(None)
+            return
+        # square roi in the middle of the sensor, in unbinned pixels
+        size = int(text.split(' ')[-1])
+        sensor_width, sensor_height = self.image_processing.get_readout()['sensor_size']
+        x = (sensor_width - size) // 2
+        y = (sensor_height - size) // 2
+        self.set_camera_roi_signal.emit((x, y, size, size))
+
+    @QtCore.pyqtSlot('PyQt_PyObject')
+    def readoutChanged(self, readout):
+        # show what the camera actually ended up with, a rejected roi or binning puts the combos back
+        self.cameraBinningComboBox.blockSignals(True)
+        self.cameraBinningComboBox.setCurrentText(str(readout['binning']))
+        self.cameraBinningComboBox.blockSignals(False)
+        roi_text = 'Full Frame' if readout['roi'] is None else f"Center {readout['roi'][2]}"
+        if self.cameraROIComboBox.findText(roi_text) >= 0:
+            self.cameraROIComboBox.blockSignals(True)
+            self.cameraROIComboBox.setCurrentText(roi_text)
+            self.cameraROIComboBox.blockSignals(False)
+
     def toggleScaleBar(self):
         objective = self.magnificationComboBoxWidget.currentText()
         self.toggle_scale_bar_signal.emit(objective)
 
 
 if __name__ == '__main__':
-    app = QtWidgets.QApplication(sys.argv)
-    window = Window()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--camera', default=None, help='camera backend: nikon, hamamatsu or simulated')
+    for name, (variable, convert, description) in SimulatedCamera.options.items():
+        parser.add_argument(f"--sim-{name.replace('_', '-')}", dest=variable, type=convert, default=None,
+                            help=f'simulated camera: {description} (or set {variable})')
+    args, qt_args = parser.parse_known_args()
+    # the simulated camera reads its options from the environment, the command line wins
+    for variable, _, _ in SimulatedCamera.options.values():
+        if getattr(args, variable) is not None:
+            os.environ[variable] = str(getattr(args, variable))
+    startup_timer = StartupTimer(startup_t0)
+    startup_timer.mark('imports')
+    app = QtWidgets.QApplication(sys.argv[:1] + qt_args)
+    window = Window(camera_name=args.camera, startup_timer=startup_timer)
     window.show()
     window.activateWindow()
     sys.exit(app.exec_())
@@ -0,0 +1,144 @@
+import os
+import json
+import threading
+import numpy as np
+
+
+class InstrumentState():
+    # the latest known state of everything around the camera. the window polls the instruments and pushes what it
+    # finds in here, the processing thread reads a snapshot for every frame. updates replace the dict instead of
+    # changing it, so a snapshot never needs the lock
+    defaults = {'stage_x': np.nan, 'stage_y': np.nan, 'z': np.nan, 'fg_voltage': np.nan, 'fg_frequency': np.nan,
+                'fg_output': -1, 'dmd_pattern_hash': 0, 'fluorescence_intensity': np.nan, 'fluorescence_lamp': -1}
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.state = dict(self.defaults)
+
+    def update(self, values):
+        with self.lock:
+            state = dict(self.state)
+            state.update(values)
+            self.state = state
+
+    def snapshot(self):
+        return self.state
+
+
+class MetadataSidecar():
+    # one row per recorded frame, written next to the recording. every column goes to its own append only file of
+    # fixed size values so one column can be read back without touching the rest, and frame n of any column is at
+    # n * itemsize. rows are buffered and written out in batches. the variable length part of the detection results
+    # (which robot is where) goes to detections.jsonl, keyed on the frame index. the tags micromanager attaches to each
+    # image mostly repeat, so only the per image ones get columns and the rest go to camera_metadata.jsonl whenever
+    # they change, keyed on the first frame they apply to
+    columns = [('frame', np.int64), ('video_frame', np.int64), ('timestamp', np.float64),
+               ('monotonic', np.float64), ('exposure', np.float64), ('binning', np.int32), ('roi_x', np.int32),
+               ('roi_y', np.int32), ('roi_width', np.int32), ('roi_height', np.int32), ('stage_x', np.float64),
+               ('stage_y', np.float64), ('z', np.float64), ('fg_voltage', np.float64), ('fg_frequency', np.float64),
+               ('fg_output', np.int8), ('dmd_pattern_hash', np.uint32), ('fluorescence_intensity', np.float64),
+               ('fluorescence_lamp', np.int8), ('robot_count', np.int32), ('robot_detection_frame', np.int64),
+               ('cell_pixels_red', np.int64), ('cell_pixels_green', np.int64), ('cell_detection_frame', np.int64),
+               ('camera_elapsed_ms', np.float64), ('camera_image_number', np.int64)]
+    camera_tag_columns = {'camera_elapsed_ms': 'ElapsedTime-ms', 'camera_image_number': 'ImageNumber'}
+    # tags that change on every image, kept out of camera_metadata.jsonl
+    per_image_tags = ['ElapsedTime-ms', 'ImageNumber', 'TimeReceivedByCore', 'Time']
+
+    def __init__(self, path, flush_rows=64):
+        self.path = path
+        self.flush_rows = flush_rows
+        os.makedirs(path, exist_ok=True)
+        schema = {'columns': [(name, np.dtype(dtype).str) for name, dtype in self.columns]}
+        with open(os.path.join(path, 'schema.json'), 'w') as f:
+            json.dump(schema, f)
+        self.files = {name: open(os.path.join(path, f'{name}.bin'), 'ab') for name, _ in self.columns}
+        self.detections_file = open(os.path.join(path, 'detections.jsonl'), 'a')
+        self.camera_metadata_file = open(os.path.join(path, 'camera_metadata.jsonl'), 'a')
+        self.pending = {name: [] for name, _ in self.columns}
+        self.pending_detections = []
+        self.pending_camera_metadata = []
+        self.last_camera_metadata = None
+        self.rows_written = 0
+        self.closed = False
+
+    def append(self, row, detections=None, camera_metadata=None):
+        # missing columns are left as -1 (nan for floats) rather than failing the recording
+        if camera_metadata:
+            self.append_camera_metadata(row, camera_metadata)
+        for name, dtype in self.columns:
+            value = row.get(name)
+            if value is None:
+                value = np.nan if np.dtype(dtype).kind == 'f' else -1
+            self.pending[name].append(value)
+        if detections is not None:
+            self.pending_detections.append(json.dumps(detections))
+        if len(self.pending['frame']) >= self.flush_rows:
+            self.flush()
+
+    def append_camera_metadata(self, row, camera_metadata):
+        for name, tag in self.camera_tag_columns.items():
+            try:
+                row[name] = float(camera_metadata[tag])
+            except (KeyError, ValueError):
+                pass
+        tags = {key: value for key, value in camera_metadata.items() if key not in self.per_image_tags}
+        if tags != self.last_camera_metadata:
+            self.last_camera_metadata = tags
+            self.pending_camera_metadata.append(json.dumps({'frame': row['frame'], 'tags': tags}))
+
+    def flush(self):
+        rows = len(self.pending['frame'])
+        for name, dtype in self.columns:
+            self.files[name].write(np.asarray(self.pending[name]).astype(dtype).tobytes())
+            self.files[name].flush()
+            self.pending[name] = []
+        for line in self.pending_detections:
+            self.detections_file.write(line + '\n')
+        self.detections_file.flush()
+        self.pending_detections = []
+        for line in self.pending_camera_metadata:
+            self.camera_metadata_file.write(line + '\n')
+        self.camera_metadata_file.flush()
+        self.pending_camera_metadata = []
+        self.rows_written += rows
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.flush()
+        for f in self.files.values():
+            f.close()
+        self.detections_file.close()
+        self.camera_metadata_file.close()
+
+
+def read_metadata(path, columns=None):
+    # the columns of a MetadataSidecar as arrays, memory mapped so only what gets used is read
+    with open(os.path.join(path, 'schema.json')) as f:
+        schema = json.load(f)
+    data = {}
+    for name, dtype in schema['columns']:
+        if columns is not None and name not in columns:
+            continue
+        column_path = os.path.join(path, f'{name}.bin')
+        if os.path.getsize(column_path) == 0:
+            data[name] = np.zeros(0, dtype=dtype)
+        else:
+            data[name] = np.memmap(column_path, dtype=dtype, mode='r')
+    return data
+
+
+def read_detections(path):
+    detections = {}
+    with open(os.path.join(path, 'detections.jsonl')) as f:
+        for line in f:
+            entry = json.loads(line)
+            detections[entry['frame']] = entry
+    return detections
+
+
+def read_camera_metadata(path):
+    # [(first frame, tags)] in recording order, the tags hold until the next entry
+    with open(os.path.join(path, 'camera_metadata.jsonl')) as f:
+        return [(entry['frame'], entry['tags']) for entry in map(json.loads, f)]
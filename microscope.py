@@ -1,4 +1,5 @@
 import ctypes, time, os
+import threading
 import logging
 from PyQt5 import QtWidgets
 
@@ -89,6 +90,8 @@ class MIC_Data(ctypes.Structure):
 class Microscope():
 
     def __init__(self):
+        # the poll thread reads z while the gui thread moves things, the sdk gets one call at a time
+        self.lock = threading.RLock()
         self.open_microscope()
         self.step_size = 25000
         data_in = MIC_Data()
@@ -126,7 +129,8 @@ class Microscope():
     def get_status(self):
         data_in = MIC_Data()
         data_in.uiDataUsageMask = default_mask
-        ret = c_lib.MIC_DataGet(ctypes.byref(data_in))
+        with self.lock:
+            ret = c_lib.MIC_DataGet(ctypes.byref(data_in))
         if ret != 0:
             logging.info('get_status failed!', ret)
             self.close_microscope()
@@ -136,7 +140,8 @@ class Microscope():
     def get_z(self):
         data_in = MIC_Data()
         data_in.uiDataUsageMask = 0x0000000000000001
-        ret = c_lib.MIC_DataGet(ctypes.byref(data_in))
+        with self.lock:
+            ret = c_lib.MIC_DataGet(ctypes.byref(data_in))
         return data_in
 
     def open_microscope(self):
@@ -176,16 +181,18 @@ class Microscope():
         self.step_size = value
 
     def move_rel_z(self, amount):
-        self.get_status()
-        z = self.status.iZPOSITION
-        log_str = f'z pos before: {z}'
-        logging.info(log_str)
-        data_in = MIC_Data()
-        data_in.uiDataUsageMask = 0x0000000000000001
-        data_in.iZPOSITION = int(z) + int(amount)
-        # data_in.iZPOSITIONTolerance = 10
-        # data_in.iZPOSITIONSpeed = 1
-        self.issue_command(data_in)
+        # read and move under the one lock so nothing gets in between
+        with self.lock:
+            self.get_status()
+            z = self.status.iZPOSITION
+            log_str = f'z pos before: {z}'
+            logging.info(log_str)
+            data_in = MIC_Data()
+            data_in.uiDataUsageMask = 0x0000000000000001
+            data_in.iZPOSITION = int(z) + int(amount)
+            # data_in.iZPOSITIONTolerance = 10
+            # data_in.iZPOSITIONSpeed = 1
+            self.issue_command(data_in)
 
     def move_absolute_z(self, z=-500000):
         data_in = MIC_Data()
@@ -199,9 +206,10 @@ class Microscope():
         data_out.uiDataUsageMask = default_mask
 
         try:
-            ret = c_lib.MIC_DataSet(ctypes.byref(data_in),
-                                    ctypes.byref(data_out),
-                                    False)
+            with self.lock:
+                ret = c_lib.MIC_DataSet(ctypes.byref(data_in),
+                                        ctypes.byref(data_out),
+                                        False)
             if ret != 0:
                 logging.info('microscope error!', ret)
         except Exception as e:
@@ -286,9 +294,10 @@ class Microscope():
         data_out = MIC_Data()
         data_out.uiDataUsageMask = default_mask
         try:
-            ret = c_lib.MIC_DataSet(ctypes.byref(data_in),
-                                    ctypes.byref(data_out),
-                                    False)
+            with self.lock:
+                ret = c_lib.MIC_DataSet(ctypes.byref(data_in),
+                                        ctypes.byref(data_out),
+                                        False)
             if ret != 0:
                 logging.warning(f'microscope error! {ret}')
         except Exception as e:
@@ -1,5 +1,6 @@
 import os, logging
 import time
+import zlib
 from ctypes import *
 import numpy as np
 # from pyglet.gl import *
@@ -35,6 +36,8 @@ class Polygon1000():
         self.circle_radius = 25
         self.tog = False
         self.controllable_projections = {}
+        # crc of the last pattern sent to the dmd, so recordings can tell which pattern was up
+        self.pattern_hash = 0
         self.curr_img = self.get_blank_image()
 
         numpy_image = np.zeros((self.height, self.width), dtype=bool)
@@ -309,6 +312,7 @@ class Polygon1000():
         img = np.rot90(np.rot90(img))
         img = np.copy(img).T.flatten()
         image_bytes = np.packbits(img).tobytes()
+        self.pattern_hash = zlib.crc32(image_bytes)
         data = (c_ubyte * len(image_bytes))(*image_bytes)
         self.dmd_clib.MTPLG_SetDevStaticImageFromMemory(c_int(self.dev_id), byref(data), c_int(1))
 
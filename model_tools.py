@@ -0,0 +1,121 @@
+import time
+import logging
+import argparse
+import numpy as np
+import cv2
+import detection
+from replay import open_source
+
+
+def to_model_input(raw):
+    # the same frame the live cell detection feeds the model: 8 bit at the training size
+    if raw.dtype != np.uint8:
+        raw = (raw >> 8).astype(np.uint8)
+    return cv2.resize(raw, (2044, 2060))
+
+
+def iter_calibration_frames(source, count, shape):
+    for raw in open_source(source, count, shape):
+        yield to_model_input(raw)
+
+
+def export_tflite(model_loc, output, quantize='none', calibration_source='synthetic', calibration_frames=20):
+    # none keeps float32, float16 halves the weights, dynamic stores the weights as int8, int8 quantizes the
+    # activations too using calibration frames to pick their ranges
+    tf = detection.import_tensorflow()
+    converter = tf.lite.TFLiteConverter.from_saved_model(model_loc)
+    if quantize in ['float16', 'dynamic', 'int8']:
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if quantize == 'float16':
+        converter.target_spec.supported_types = [tf.float16]
+    elif quantize == 'int8':
+        def representative_dataset():
+            for img in iter_calibration_frames(calibration_source, calibration_frames, (2048, 2060)):
+                yield [img[np.newaxis, ..., np.newaxis].astype(np.float32)]
+        converter.representative_dataset = representative_dataset
+    t0 = time.perf_counter()
+    tflite_model = converter.convert()
+    with open(output, 'wb') as f:
+        f.write(tflite_model)
+    logging.info(f'exported {model_loc} to {output} ({quantize}) in {time.perf_counter() - t0:.1f}s, '
+                 f'{len(tflite_model) / 2 ** 20:.1f}MB')
+
+
+def get_classes(model, img):
+    return np.argmax(model.predict(img[np.newaxis, ..., np.newaxis])[0], axis=-1)
+
+
+def compare(reference, candidate, frames):
+    # how often the two models pick the same class per pixel, and the iou of each cell class between them
+    agreement = []
+    ious = {1: [], 2: []}
+    times = {'reference': [], 'candidate': []}
+    for img in frames:
+        t0 = time.perf_counter()
+        reference_classes = get_classes(reference, img)
+        t1 = time.perf_counter()
+        candidate_classes = get_classes(candidate, img)
+        t2 = time.perf_counter()
+        times['reference'].append(t1 - t0)
+        times['candidate'].append(t2 - t1)
+        agreement.append(np.mean(reference_classes == candidate_classes))
+        for c in ious:
+            union = np.count_nonzero((reference_classes == c) | (candidate_classes == c))
+            if union > 0:
+                ious[c].append(np.count_nonzero((reference_classes == c) & (candidate_classes == c)) / union)
+    # the first predict of each builds its graph, leave it out of the timings
+    return {'frames': len(agreement), 'agreement': float(np.min(agreement)) if agreement else 0,
+            'mean agreement': float(np.mean(agreement)) if agreement else 0,
+            'iou': {c: float(np.mean(v)) if v else None for c, v in ious.items()},
+            'reference ms': float(np.median(times['reference'][1:] or times['reference'])) * 1000,
+            'candidate ms': float(np.median(times['candidate'][1:] or times['candidate'])) * 1000}
+
+
+def format_comparison(result):
+    iou = ', '.join(f'class {c}: {v:.4f}' if v is not None else f'class {c}: not present'
+                    for c, v in result['iou'].items())
+    return (f"frames: {result['frames']}\n"
+            f"pixel agreement: worst {result['agreement']:.4%}, mean {result['mean agreement']:.4%}\n"
+            f"iou against reference: {iou}\n"
+            f"median inference: reference {result['reference ms']:.1f}ms, candidate {result['candidate ms']:.1f}ms "
+            f"({result['reference ms'] / max(result['candidate ms'], 1e-9):.2f}x)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='export the cell detection model for the tflite backend, and check '
+                                                 'an exported model still gives the same masks as the keras one')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    export_parser = subparsers.add_parser('export', help='convert a keras savedmodel to tflite')
+    export_parser.add_argument('model', nargs='?', default=detection.model_loc, help='keras savedmodel directory')
+    export_parser.add_argument('output', help='.tflite file to write')
+    export_parser.add_argument('--quantize', choices=['none', 'float16', 'dynamic', 'int8'], default='dynamic')
+    export_parser.add_argument('--calibration', default='synthetic',
+                               help='frames for int8 calibration: mp4, tiff stack, or "synthetic"')
+    export_parser.add_argument('--calibration-frames', type=int, default=20)
+    compare_parser = subparsers.add_parser('compare', help='mask agreement between two models over some frames')
+    compare_parser.add_argument('candidate', help='model to check, usually a .tflite')
+    compare_parser.add_argument('--reference', default=detection.model_loc, help='defaults to the keras model')
+    compare_parser.add_argument('--source', default='synthetic', help='mp4, tiff stack, or "synthetic"')
+    compare_parser.add_argument('--frames', type=int, default=10)
+    compare_parser.add_argument('--threads', type=int, default=None, help='tflite threads, defaults to every core')
+    compare_parser.add_argument('--min-agreement', type=float, default=0.99,
+                                help='fail if any frame agrees on fewer pixels than this')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.command == 'export':
+        export_tflite(args.model, args.output, args.quantize, args.calibration, args.calibration_frames)
+        return
+    if args.threads is not None:
+        detection.tflite_threads = args.threads
+    reference = detection.model_registry.load(args.reference)
+    candidate = detection.model_registry.load(args.candidate)
+    frames = [to_model_input(raw) for raw in open_source(args.source, args.frames)]
+    result = compare(reference, candidate, frames)
+    print(format_comparison(result))
+    if result['agreement'] < args.min_agreement:
+        raise SystemExit(f"worst frame agreement {result['agreement']:.4%} is below {args.min_agreement:.4%}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,577 @@
+import logging
+import os
+import time
+import collections
+import threading
+import numpy as np
+import cv2
+from profiler import PipelineProfiler
+
+
+class LutLookup():
+    # lut[raw] without the full frame temporary numpy makes for it (every index cast to intp first, 8 bytes a pixel).
+    # the frame goes through a small reused index buffer a band of rows at a time, so nothing is allocated per frame.
+    # 8 bit frames are read as v * 257 in 16 bit, so the full window passes them through unchanged
+    band_rows = 64
+
+    def __init__(self):
+        self.index = None
+
+    def apply(self, lut, raw, out=None):
+        if out is None:
+            out = np.empty(raw.shape, dtype=lut.dtype)
+        if raw.dtype == np.uint8:
+            return cv2.LUT(raw, np.ascontiguousarray(lut[::257]), dst=out)
+        if self.index is None or self.index.shape[1:] != raw.shape[1:]:
+            self.index = np.empty((self.band_rows,) + raw.shape[1:], dtype=np.intp)
+        for start in range(0, raw.shape[0], self.band_rows):
+            rows = min(self.band_rows, raw.shape[0] - start)
+            np.copyto(self.index[:rows], raw[start:start + rows])
+            # clip never triggers (the table covers every 16 bit value), raise would buffer the output
+            np.take(lut, self.index[:rows], out=out[start:start + rows], mode='clip')
+        return out
+
+
+class LutConverter():
+    # converts raw 16 bit camera frames to 8 bit with a single table lookup. the table is only rebuilt when the
+    # window/level, gamma or auto range actually move, so the per frame cost is the same whatever the mapping is
+
+    def __init__(self):
+        self.low = 0
+        self.high = 65535
+        self.gamma = 1.0
+        self.auto_range = False
+        # auto range looks at a subsampled histogram every few frames, clipping the extreme tails
+        self.auto_range_interval = 10
+        self.auto_range_subsample = 4
+        self.auto_range_percentiles = (0.1, 99.9)
+        self.frame_count = 0
+        self.lut = None
+        self.lookup = LutLookup()
+        self.build_lut()
+
+    def set_params(self, low, high, gamma, auto_range):
+        if auto_range and not self.auto_range:
+            # pick up a new window on the very next frame
+            self.frame_count = 0
+        self.auto_range = auto_range
+        if auto_range:
+            # the window belongs to the auto range while it is on
+            low, high = self.low, self.high
+        else:
+            low, high = int(min(low, high)), int(max(low, high))
+        if (low, high, gamma) != (self.low, self.high, self.gamma):
+            self.low, self.high, self.gamma = low, high, gamma
+            self.build_lut()
+
+    def build_lut(self):
+        values = np.arange(65536, dtype=np.float64)
+        scaled = np.clip((values - self.low) / max(self.high - self.low + 1, 1), 0, 1)
+        if self.gamma != 1:
+            # gamma below 1 lifts dim signal, above 1 pushes it down
+            scaled = scaled ** self.gamma
+        # with the default full window this is exactly the old divide by 256
+        self.lut = np.minimum(scaled * 256, 255).astype(np.uint8)
+        logging.info(f'conversion lut rebuilt: window {self.low}-{self.high}, gamma {self.gamma}')
+
+    def update_auto_range(self, raw):
+        sample = raw[::self.auto_range_subsample, ::self.auto_range_subsample]
+        if sample.dtype == np.uint8:
+            # the window is always in 16 bit units, see LutLookup
+            sample = sample.astype(np.uint16) * 257
+        cumulative = np.cumsum(np.bincount(sample.ravel(), minlength=65536))
+        lower, upper = self.auto_range_percentiles
+        low = int(np.searchsorted(cumulative, cumulative[-1] * lower / 100))
+        high = int(np.searchsorted(cumulative, cumulative[-1] * upper / 100))
+        # ignore small wobbles so we aren't rebuilding the table every few frames
+        tolerance = max((self.high - self.low) // 100, 1)
+        if abs(low - self.low) > tolerance or abs(high - self.high) > tolerance:
+            self.low, self.high = low, max(high, low + 1)
+            self.build_lut()
+
+    def convert(self, raw, out=None):
+        if self.auto_range and self.frame_count % self.auto_range_interval == 0:
+            self.update_auto_range(raw)
+        self.frame_count += 1
+        return self.lookup.apply(self.lut, raw, out)
+
+
+class FramePool():
+    # a fixed set of reusable buffers of one shape. buffers are handed out with acquire and come back with release
+    # once whoever we gave them to is done, so the frame path never has to allocate
+
+    def __init__(self, shape, dtype=np.uint8, count=3):
+        self.shape = tuple(shape)
+        self.dtype = dtype
+        self.lock = threading.Lock()
+        self.buffers = {}
+        self.free = collections.deque()
+        for _ in range(count):
+            buffer = np.zeros(self.shape, dtype=self.dtype)
+            self.buffers[id(buffer)] = buffer
+            self.free.append(buffer)
+        self.in_use = set()
+        self.exhausted = 0
+
+    def acquire(self):
+        with self.lock:
+            if len(self.free) == 0:
+                # everything is still out with the viewer
+                self.exhausted += 1
+                return None
+            buffer = self.free.popleft()
+            self.in_use.add(id(buffer))
+            return buffer
+
+    def release(self, buffer):
+        # buffers we don't own (or already got back) are ignored, so it is always safe to hand anything back
+        with self.lock:
+            if buffer is None or id(buffer) not in self.in_use:
+                return
+            self.in_use.discard(id(buffer))
+            self.free.append(self.buffers[id(buffer)])
+
+
+class DisplayMailbox():
+    # holds only the newest frame waiting for the viewer. posting over a frame that hasn't been picked up yet
+    # replaces it, so the viewer can never fall more than one frame behind the camera
+
+    def __init__(self, discard_callback=None):
+        self.lock = threading.Lock()
+        self.frame = None
+        # called with any frame that gets replaced before the viewer took it, so its buffer can be reused
+        self.discard_callback = discard_callback
+        self.frames_skipped = 0
+
+    def post(self, frame):
+        with self.lock:
+            replaced = self.frame
+            self.frame = frame
+        if replaced is None:
+            # the mailbox was empty, the viewer has to be told there is something new
+            return True
+        self.frames_skipped += 1
+        if self.discard_callback is not None:
+            self.discard_callback(replaced)
+        return False
+
+    def take(self):
+        with self.lock:
+            frame = self.frame
+            self.frame = None
+        return frame
+
+
+class OverlayCompositor():
+    # keeps the robot, path and cell overlays merged into one display resolution layer plus a mask of the pixels it
+    # covers. layers are only rescaled and re-merged when they change, get switched on or off, or the window
+    # resizes, so every frame costs a single masked blend however many layers are showing
+
+    def __init__(self, weight=0.8):
+        self.weight = weight
+        self.layers = {}
+        self.enabled = {}
+        self.scaled_layers = {}
+        self.dirty_layers = set()
+        self.merge_needed = True
+        self.display_size = None
+        self.merged = None
+        self.alpha = None
+        self.active = False
+
+    def set_layer(self, name, overlay):
+        self.layers[name] = overlay
+        self.dirty_layers.add(name)
+
+    def set_enabled(self, name, state):
+        if self.enabled.get(name) != state:
+            self.enabled[name] = state
+            self.merge_needed = True
+
+    def update(self, display_size):
+        if display_size != self.display_size:
+            self.display_size = display_size
+            self.dirty_layers.update(self.layers.keys())
+        if len(self.dirty_layers) == 0 and not self.merge_needed:
+            return
+        for name in self.dirty_layers:
+            self.scaled_layers[name] = cv2.resize(self.layers[name], display_size, interpolation=cv2.INTER_AREA)
+        self.dirty_layers = set()
+        self.merge_needed = False
+
+        width, height = display_size
+        self.merged = np.zeros((height, width, 3), dtype=np.uint8)
+        for name, scaled in self.scaled_layers.items():
+            if self.enabled.get(name, False):
+                cv2.add(self.merged, scaled, dst=self.merged)
+        # weight the merged layer once here rather than on every frame
+        cv2.addWeighted(self.merged, self.weight, self.merged, 0, 0, dst=self.merged)
+        self.alpha = np.where(self.merged.max(axis=2) > 0, 255, 0).astype(np.uint8)
+        self.active = bool(self.alpha.any())
+
+    def blend(self, display_img):
+        cv2.add(display_img, self.merged, dst=display_img, mask=self.alpha)
+        return display_img
+
+    def get_visible_layers(self):
+        # the enabled layers at the resolution they were drawn, for compositing a full size still
+        return [self.layers[name] for name in self.layers if self.enabled.get(name, False)]
+
+
+def composite_overlays(gray, layers, weight=0.8):
+    # an 8 bit frame with overlays drawn over it the way the viewer shows them, at the frame's own resolution. the
+    # result is rgb like the overlays
+    height, width = gray.shape[:2]
+    composite = cv2.cvtColor(gray, cv2.COLOR_GRAY2RGB)
+    merged = np.zeros((height, width, 3), dtype=np.uint8)
+    for layer in layers:
+        if layer.shape[:2] != (height, width):
+            layer = cv2.resize(layer, (width, height), interpolation=cv2.INTER_AREA)
+        cv2.add(merged, layer, dst=merged)
+    cv2.addWeighted(merged, weight, merged, 0, 0, dst=merged)
+    alpha = np.where(merged.max(axis=2) > 0, 255, 0).astype(np.uint8)
+    cv2.add(composite, merged, dst=composite, mask=alpha)
+    return composite
+
+
+class ClaheEngine():
+    # one persistent clahe object, only recreated when the clip limit or grid size actually change
+
+    def __init__(self, clip=3.0, grid=8):
+        self.clip = None
+        self.grid = None
+        self.clahe = None
+        self.set_params(clip, grid)
+
+    def set_params(self, clip, grid):
+        clip, grid = float(clip), int(grid)
+        if (clip, grid) == (self.clip, self.grid):
+            return
+        self.clip, self.grid = clip, grid
+        self.clahe = cv2.createCLAHE(clipLimit=self.clip, tileGridSize=(self.grid, self.grid))
+        logging.info(f'clahe rebuilt: clip {self.clip}, grid {self.grid}')
+
+    def apply(self, img, dst=None):
+        return self.clahe.apply(img, dst=dst)
+
+
+def histogram_median(img, subsample=1):
+    # median of an integer image read off its histogram, avoids the full sort np.median does
+    sample = img[::subsample, ::subsample]
+    if sample.dtype == np.uint8:
+        counts = cv2.calcHist([sample], [0], None, [256], [0, 256]).ravel()
+    else:
+        counts = np.bincount(sample.ravel())
+    cumulative = np.cumsum(counts)
+    return int(np.searchsorted(cumulative, cumulative[-1] / 2))
+
+
+class HotPixelMap():
+    # hot pixels found once from a short run of dark frames and saved per camera, so correcting a frame is just
+    # filling a precomputed list of pixel indices
+
+    def __init__(self, calibration_dir, camera_name):
+        self.calibration_dir = calibration_dir
+        self.path = os.path.join(calibration_dir, f'hot_pixels_{camera_name}.npz')
+        # a pixel is hot if its mean dark level is this many times the median dark level
+        self.hot_pixel_factor = 2
+        self.shape = None
+        self.indices = None
+        self.calibrating = False
+        self.calibration_sum = None
+        self.calibration_frames = 0
+        self.calibration_frames_needed = 0
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            logging.info(f'no hot pixel map found at {self.path}')
+            return
+        try:
+            data = np.load(self.path)
+            self.shape = tuple(data['shape'])
+            self.indices = data['indices']
+            logging.info(f'loaded hot pixel map: {len(self.indices)} hot pixels from {self.path}')
+        except Exception as e:
+            logging.warning(f'failed to load hot pixel map {self.path}: {e}')
+
+    def save(self):
+        os.makedirs(self.calibration_dir, exist_ok=True)
+        np.savez(self.path, shape=np.array(self.shape), indices=self.indices)
+        logging.info(f'saved hot pixel map: {self.path}')
+
+    def start_calibration(self, frame_count=20):
+        logging.info(f'calibrating hot pixels over {frame_count} dark frames...')
+        self.calibrating = True
+        self.calibration_sum = None
+        self.calibration_frames = 0
+        self.calibration_frames_needed = frame_count
+
+    def add_calibration_frame(self, raw):
+        if self.calibration_sum is None or self.calibration_sum.shape != raw.shape:
+            self.calibration_sum = np.zeros(raw.shape, dtype=np.float32)
+            self.calibration_frames = 0
+        cv2.accumulate(raw, self.calibration_sum)
+        self.calibration_frames += 1
+        if self.calibration_frames >= self.calibration_frames_needed:
+            self.finish_calibration()
+
+    def finish_calibration(self):
+        mean_dark = (self.calibration_sum / self.calibration_frames).astype(np.uint16)
+        median = histogram_median(mean_dark)
+        self.shape = mean_dark.shape
+        self.indices = np.flatnonzero(mean_dark > self.hot_pixel_factor * max(median, 1)).astype(np.int64)
+        self.calibrating = False
+        self.calibration_sum = None
+        logging.info(f'hot pixel calibration done: median dark level {median}, {len(self.indices)} hot pixels')
+        self.save()
+
+    def is_ready(self, shape):
+        return self.indices is not None and self.shape == tuple(shape[:2])
+
+    def apply(self, img):
+        np.put(img, self.indices, 0)
+        return img
+
+
+class BackgroundModel():
+    # slowly updated estimate of the static background, subtracted so uneven illumination doesn't move the
+    # detection thresholds. 'mean' is a running average, 'median' an approximate running median that steps every
+    # pixel one grey level towards the current frame
+
+    def __init__(self, mode='mean', learning_rate=0.02, update_interval=5):
+        self.mode = mode
+        self.learning_rate = learning_rate
+        self.update_interval = update_interval
+        self.reset()
+
+    def reset(self):
+        self.background = None
+        self.background_8bit = None
+        self.above = None
+        self.below = None
+        self.offset = 0
+        self.frame_count = 0
+
+    def set_mode(self, mode):
+        if mode != self.mode:
+            self.mode = mode
+            self.reset()
+
+    def update(self, img):
+        if self.background is None or self.background.shape != img.shape:
+            self.background = img.astype(np.float32) if self.mode == 'mean' else img.copy()
+            self.background_8bit = img.copy()
+            self.above = np.zeros(img.shape, dtype=np.uint8)
+            self.below = np.zeros(img.shape, dtype=np.uint8)
+            self.offset = int(cv2.mean(self.background_8bit)[0])
+        elif self.frame_count % self.update_interval == 0:
+            if self.mode == 'mean':
+                cv2.accumulateWeighted(img, self.background, self.learning_rate)
+                cv2.convertScaleAbs(self.background, dst=self.background_8bit)
+            else:
+                cv2.compare(img, self.background, cv2.CMP_GT, dst=self.above)
+                cv2.compare(img, self.background, cv2.CMP_LT, dst=self.below)
+                cv2.add(self.background, 1, dst=self.background, mask=self.above)
+                cv2.subtract(self.background, 1, dst=self.background, mask=self.below)
+                self.background_8bit = self.background
+            # the corrected image sits around the background's mean level so it keeps its overall brightness
+            self.offset = int(cv2.mean(self.background_8bit)[0])
+        self.frame_count += 1
+
+    def apply(self, img, dst=None):
+        return cv2.addWeighted(img, 1, self.background_8bit, -1, self.offset, dst=dst, dtype=cv2.CV_8U)
+
+
+class FlatField():
+    # a stored image of an empty field for each optical config. dividing by it evens out vignetting and uneven
+    # illumination across the chip
+
+    def __init__(self, flat_field_dir):
+        self.flat_field_dir = flat_field_dir
+        self.config_name = None
+        self.gain = None
+        self.capturing = False
+        self.capture_sum = None
+        self.capture_frames = 0
+        self.capture_frames_needed = 0
+
+    def get_path(self, config_name):
+        return os.path.join(self.flat_field_dir, f'flat_field_{config_name}.npy')
+
+    def load(self, config_name):
+        self.config_name = config_name
+        self.gain = None
+        path = self.get_path(config_name)
+        if not os.path.exists(path):
+            logging.info(f'no flat field stored for optical config {config_name}')
+            return
+        try:
+            self.set_flat(np.load(path))
+            logging.info(f'loaded flat field: {path}')
+        except Exception as e:
+            logging.warning(f'failed to load flat field {path}: {e}')
+
+    def set_flat(self, flat):
+        # gain brings every pixel up (or down) to the mean level of the flat
+        self.gain = (np.mean(flat) / np.maximum(flat, 1)).astype(np.float32)
+
+    def start_capture(self, frame_count=20):
+        if self.config_name is None:
+            logging.warning('no optical config selected, not capturing flat field')
+            return
+        logging.info(f'capturing flat field for {self.config_name} over {frame_count} frames...')
+        self.capturing = True
+        self.capture_sum = None
+        self.capture_frames = 0
+        self.capture_frames_needed = frame_count
+
+    def add_capture_frame(self, img):
+        if self.capture_sum is None or self.capture_sum.shape != img.shape:
+            self.capture_sum = np.zeros(img.shape, dtype=np.float32)
+            self.capture_frames = 0
+        cv2.accumulate(img, self.capture_sum)
+        self.capture_frames += 1
+        if self.capture_frames >= self.capture_frames_needed:
+            flat = self.capture_sum / self.capture_frames
+            self.capturing = False
+            self.capture_sum = None
+            self.set_flat(flat)
+            os.makedirs(self.flat_field_dir, exist_ok=True)
+            np.save(self.get_path(self.config_name), flat)
+            logging.info(f'saved flat field: {self.get_path(self.config_name)}')
+
+    def is_ready(self, shape):
+        return self.gain is not None and self.gain.shape == tuple(shape[:2])
+
+    def apply(self, img, dst=None):
+        return cv2.multiply(img, self.gain, dst=dst, dtype=cv2.CV_8U)
+
+
+class FrameProcessor():
+    # everything between a raw camera frame and a display frame. there is no qt or camera in here, so the live
+    # imageProcessor and the offline replay harness push frames through exactly the same steps
+
+    def __init__(self, calibration_dir, camera_name, profiler=None, shape_changed_callback=None):
+        self.image_adjustment_params = {'clahe': False, 'clip': 3.0, 'grid': 8, 'threshold': False,
+                                        'threshold_percent': 50, 'auto_range': False, 'black_level': 0,
+                                        'white_level': 65535, 'gamma': 1.0, 'clahe_display_only': False,
+                                        'flat_field': False, 'background_subtraction': False,
+                                        'background_mode': 'mean'}
+        self.profiler = profiler if profiler is not None else PipelineProfiler()
+        self.lut_converter = LutConverter()
+        self.clahe_engine = ClaheEngine(self.image_adjustment_params['clip'], self.image_adjustment_params['grid'])
+        self.hot_pixel_map = HotPixelMap(calibration_dir, camera_name)
+        # optional illumination correction ahead of detection and display
+        self.flat_field = FlatField(calibration_dir)
+        self.background_model = BackgroundModel()
+        # robot, path and cell overlays pre-merged at display resolution
+        self.overlay_compositor = OverlayCompositor()
+        # called with the new shape whenever the camera frame size changes
+        self.shape_changed_callback = shape_changed_callback
+
+        # native resolution scratch buffers, (re)allocated whenever the camera frame shape changes
+        self.native_shape = None
+        self.native_gray = None
+        self.native_adjusted = None
+        self.native_threshold = None
+        self.native_corrected = None
+        self.native_flat = None
+        # the grayscale frame scaled down to the window (and its clahe'd copy), overlays get blended onto a
+        # colour copy of this
+        self.display_gray = None
+        self.display_adjusted = None
+
+    def set_params(self, image_adjustment_params):
+        self.image_adjustment_params = image_adjustment_params
+        self.clahe_engine.set_params(image_adjustment_params['clip'], image_adjustment_params['grid'])
+        self.background_model.set_mode(image_adjustment_params['background_mode'])
+        self.lut_converter.set_params(image_adjustment_params['black_level'],
+                                      image_adjustment_params['white_level'],
+                                      image_adjustment_params['gamma'],
+                                      image_adjustment_params['auto_range'])
+
+    def allocate_native_buffers(self, shape):
+        if shape[:2] == self.native_shape:
+            return
+        self.native_shape = shape[:2]
+        self.native_gray = np.zeros(self.native_shape, dtype=np.uint8)
+        self.native_adjusted = np.zeros(self.native_shape, dtype=np.uint8)
+        self.native_threshold = np.zeros(self.native_shape, dtype=np.uint8)
+        self.native_corrected = np.zeros(self.native_shape, dtype=np.uint8)
+        self.native_flat = np.zeros(self.native_shape, dtype=np.uint8)
+        logging.info(f'allocated native frame buffers: {self.native_shape}')
+        if self.shape_changed_callback is not None:
+            self.shape_changed_callback(self.native_shape)
+
+    def convert(self, raw):
+        # raw camera frame to 8 bit, the result lives in our scratch buffer until the next frame
+        if self.hot_pixel_map.calibrating:
+            self.hot_pixel_map.add_calibration_frame(raw)
+        self.allocate_native_buffers(raw.shape)
+        with self.profiler.time('conversion'):
+            return self.lut_converter.convert(raw, out=self.native_gray)
+
+    def correct_illumination(self, img):
+        # flat field first to even out the illumination, then take off whatever static background is left
+        with self.profiler.time('correction'):
+            if self.flat_field.capturing:
+                self.flat_field.add_capture_frame(img)
+            if self.image_adjustment_params['flat_field'] and self.flat_field.is_ready(img.shape):
+                img = self.flat_field.apply(img, dst=self.native_flat)
+            if self.image_adjustment_params['background_subtraction']:
+                self.background_model.update(img)
+                img = self.background_model.apply(img, dst=self.native_corrected)
+        return img
+
+    def adjust(self, np_img):
+        # apply all of our visual adjustments to the feed, writing into our own scratch buffers as we go
+        self.allocate_native_buffers(np_img.shape)
+        t0 = time.perf_counter()
+        if self.image_adjustment_params['threshold']:
+            # first remove our hot pixels, straight from the calibrated map if we have one for this frame size
+            if self.hot_pixel_map.is_ready(np_img.shape):
+                self.hot_pixel_map.apply(np_img)
+            else:
+                median = histogram_median(np_img)
+                cv2.threshold(np_img, 2 * median, 255, cv2.THRESH_TOZERO_INV, dst=np_img)
+            threshold = int(self.image_adjustment_params['threshold_percent'] * 255)
+            cv2.threshold(np_img, threshold, 255, cv2.THRESH_BINARY_INV, dst=self.native_adjusted)
+            cv2.threshold(np_img, threshold, 255, cv2.THRESH_TOZERO, dst=self.native_threshold)
+            np_img = cv2.add(self.native_adjusted, self.native_threshold, dst=self.native_threshold)
+        if self.image_adjustment_params['clahe'] and not self.image_adjustment_params['clahe_display_only']:
+            np_img = self.clahe_engine.apply(np_img, dst=self.native_adjusted)
+        self.profiler.record('adjustment', time.perf_counter() - t0)
+        return np_img
+
+    def get_display_shape(self, display_size):
+        # brings the overlays up to date for this window size, a colour frame is only needed if any are showing
+        with self.profiler.time('compositing'):
+            self.overlay_compositor.update(display_size)
+        display_shape = (display_size[1], display_size[0])
+        if self.overlay_compositor.active:
+            return display_shape + (3,)
+        return display_shape
+
+    def render_display_frame(self, np_img, display_size, display_img):
+        display_clahe = self.image_adjustment_params['clahe'] and self.image_adjustment_params['clahe_display_only']
+        colour = self.overlay_compositor.active
+        if not display_clahe and not colour:
+            with self.profiler.time('resize'):
+                cv2.resize(np_img, display_size, dst=display_img)
+            return
+
+        display_shape = (display_size[1], display_size[0])
+        if self.display_gray is None or self.display_gray.shape != display_shape:
+            self.display_gray = np.zeros(display_shape, dtype=np.uint8)
+            self.display_adjusted = np.zeros(display_shape, dtype=np.uint8)
+        with self.profiler.time('resize'):
+            gray = cv2.resize(np_img, display_size, dst=self.display_gray)
+        if display_clahe:
+            # only for viewing, so run it on the much smaller display image
+            with self.profiler.time('display adjustment'):
+                gray = self.clahe_engine.apply(gray, dst=self.display_adjusted if colour else display_img)
+        if colour:
+            with self.profiler.time('compositing'):
+                cv2.cvtColor(gray, cv2.COLOR_GRAY2BGR, dst=display_img)
+                self.overlay_compositor.blend(display_img)
@@ -0,0 +1,115 @@
+import os
+import csv
+import time
+import logging
+import threading
+import contextlib
+import collections
+import numpy as np
+
+
+class StartupTimer():
+    # logs how long each phase of starting up took, and the running total
+
+    def __init__(self, t0=None):
+        self.t0 = t0 if t0 is not None else time.perf_counter()
+        self.last = self.t0
+        self.phases = collections.OrderedDict()
+
+    def mark(self, phase):
+        t = time.perf_counter()
+        self.phases[phase] = t - self.last
+        logging.info(f'startup: {phase} took {t - self.last:.2f}s, {t - self.t0:.2f}s since launch')
+        self.last = t
+
+    def add(self, phase, seconds):
+        # for phases timed somewhere else, e.g. on another thread
+        self.phases[phase] = seconds
+        logging.info(f'startup: {phase} took {seconds:.2f}s, {time.perf_counter() - self.t0:.2f}s since launch')
+
+
+class PipelineProfiler():
+    # rolling per-stage timings for the live pipeline. stages are timed from the acquisition, processing and gui
+    # threads so everything goes through one lock
+    stages = ['acquisition', 'conversion', 'correction', 'adjustment', 'resize', 'display adjustment', 'compositing',
+              'emit', 'robot detection', 'cell inference', 'cell overlay age', 'setImage', 'paint']
+
+    def __init__(self, window=500):
+        self.window = window
+        self.lock = threading.Lock()
+        self.timings = {stage: collections.deque(maxlen=window) for stage in self.stages}
+        self.totals = {stage: 0 for stage in self.stages}
+        # drop counters are owned elsewhere, we just get told their latest values
+        self.counters = collections.OrderedDict()
+        self.csv_path = None
+        self.csv_file = None
+        self.csv_writer = None
+        self.session_t0 = time.time()
+
+    def record(self, stage, seconds):
+        with self.lock:
+            if stage not in self.timings:
+                self.timings[stage] = collections.deque(maxlen=self.window)
+                self.totals[stage] = 0
+            self.timings[stage].append(seconds)
+            self.totals[stage] += 1
+
+    @contextlib.contextmanager
+    def time(self, stage):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - t0)
+
+    def set_counter(self, name, value):
+        with self.lock:
+            self.counters[name] = value
+
+    def get_stats(self):
+        # everything in ms, stages that haven't run yet are left out
+        stats = collections.OrderedDict()
+        with self.lock:
+            snapshot = [(stage, np.array(timings), self.totals[stage]) for stage, timings in self.timings.items()]
+            counters = dict(self.counters)
+        for stage, timings, total in snapshot:
+            if len(timings) == 0:
+                continue
+            p50, p95, p99 = np.percentile(timings, [50, 95, 99]) * 1000
+            stats[stage] = {'count': total, 'mean': timings.mean() * 1000, 'p50': p50, 'p95': p95, 'p99': p99}
+        return stats, counters
+
+    def start_session(self, profile_dir):
+        self.close()
+        self.session_t0 = time.time()
+        self.csv_path = os.path.join(profile_dir, time.strftime('profile_%Y_%m_%d_%H_%M_%S.csv', time.gmtime()))
+        try:
+            os.makedirs(profile_dir, exist_ok=True)
+            self.csv_file = open(self.csv_path, 'w', newline='')
+            self.csv_writer = csv.writer(self.csv_file)
+            self.csv_writer.writerow(['time', 'stage', 'count', 'mean_ms', 'p50_ms', 'p95_ms', 'p99_ms'])
+            logging.info(f'writing pipeline profile: {self.csv_path}')
+        except OSError as e:
+            logging.warning(f'failed to open pipeline profile {self.csv_path}: {e}')
+            self.csv_file = None
+            self.csv_writer = None
+
+    def write_snapshot(self, stats=None, counters=None):
+        if self.csv_writer is None:
+            return
+        if stats is None:
+            stats, counters = self.get_stats()
+        t = round(time.time() - self.session_t0, 3)
+        for stage, s in stats.items():
+            self.csv_writer.writerow([t, stage, s['count'], round(s['mean'], 3), round(s['p50'], 3),
+                                      round(s['p95'], 3), round(s['p99'], 3)])
+        # counters go in the same file, with the count column holding their value
+        for name, value in counters.items():
+            self.csv_writer.writerow([t, name, value, '', '', '', ''])
+        self.csv_file.flush()
+
+    def close(self):
+        if self.csv_file is not None:
+            self.csv_file.close()
+            self.csv_file = None
+            self.csv_writer = None
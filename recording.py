@@ -0,0 +1,400 @@
+import os
+import json
+import time
+import queue
+import logging
+import tempfile
+import threading
+import collections
+import numpy as np
+import cv2
+import imageio_ffmpeg
+from pipeline import composite_overlays
+
+
+class FfmpegSink():
+    # 8 bit grayscale frames encoded to mp4 by ffmpeg
+
+    def __init__(self, path, size, fps=30):
+        self.path = path
+        self.writer = imageio_ffmpeg.write_frames(path, size, macro_block_size=1, pix_fmt_in='gray', fps=fps)
+        self.writer.send(None)
+
+    def write(self, buffer, timestamp, index):
+        self.writer.send(buffer)
+
+    def close(self):
+        self.writer.close()
+
+
+class RawChunkSink():
+    # lossless recording of the camera's own frames (16 bit normally). frames are copied into preallocated,
+    # memory mapped chunk files and every frame gets a fixed size record in an index file, so a recording can be
+    # seeked to frame n straight away and read back without copying, see RawRecording
+    index_dtype = np.dtype([('frame', np.int64), ('timestamp', np.float64), ('chunk', np.int32), ('slot', np.int32),
+                            ('offset', np.int64)])
+
+    def __init__(self, path, chunk_frames=128):
+        self.path = path
+        self.chunk_frames = chunk_frames
+        os.makedirs(path, exist_ok=True)
+        self.index_file = open(os.path.join(path, 'index.bin'), 'wb')
+        self.shape = None
+        self.dtype = None
+        self.chunk = None
+        self.chunk_number = -1
+        self.slot = 0
+        self.frames_written = 0
+
+    def get_chunk_path(self, chunk_number):
+        return os.path.join(self.path, f'chunk_{chunk_number:05d}.raw')
+
+    def write_header(self):
+        header = {'shape': list(self.shape), 'dtype': self.dtype.str, 'chunk_frames': self.chunk_frames,
+                  'index_dtype': self.index_dtype.descr}
+        with open(os.path.join(self.path, 'header.json'), 'w') as f:
+            json.dump(header, f)
+
+    def next_chunk(self):
+        if self.chunk is not None:
+            self.chunk.flush()
+            del self.chunk
+        self.chunk_number += 1
+        self.slot = 0
+        self.chunk = np.memmap(self.get_chunk_path(self.chunk_number), dtype=self.dtype, mode='w+',
+                               shape=(self.chunk_frames,) + self.shape)
+
+    def write(self, buffer, timestamp, index):
+        if self.shape is None:
+            # the first frame decides the layout of the whole recording
+            self.shape = tuple(buffer.shape)
+            self.dtype = buffer.dtype
+            self.write_header()
+        elif tuple(buffer.shape) != self.shape:
+            raise ValueError(f'frame shape {buffer.shape} does not match recording shape {self.shape}')
+        if self.chunk is None or self.slot == self.chunk_frames:
+            self.next_chunk()
+        self.chunk[self.slot] = buffer
+        record = np.array([(index if index is not None else self.frames_written, timestamp, self.chunk_number,
+                            self.slot, self.slot * buffer.nbytes)], dtype=self.index_dtype)
+        self.index_file.write(record.tobytes())
+        self.slot += 1
+        self.frames_written += 1
+
+    def close(self):
+        if self.chunk is not None:
+            self.chunk.flush()
+            del self.chunk
+            self.chunk = None
+            # the last chunk only needs to be as long as the frames that made it in
+            frame_bytes = int(np.prod(self.shape)) * self.dtype.itemsize
+            os.truncate(self.get_chunk_path(self.chunk_number), self.slot * frame_bytes)
+        self.index_file.close()
+
+
+class RawRecording():
+    # reads back a RawChunkSink recording. frames are views straight into the memory mapped chunks
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'header.json')) as f:
+            header = json.load(f)
+        self.shape = tuple(header['shape'])
+        self.dtype = np.dtype(header['dtype'])
+        self.chunk_frames = header['chunk_frames']
+        self.index = np.fromfile(os.path.join(path, 'index.bin'), dtype=RawChunkSink.index_dtype)
+        self.timestamps = self.index['timestamp']
+        self.chunks = {}
+
+    def __len__(self):
+        return len(self.index)
+
+    def get_chunk(self, chunk_number):
+        if chunk_number not in self.chunks:
+            path = os.path.join(self.path, f'chunk_{chunk_number:05d}.raw')
+            frame_count = os.path.getsize(path) // (int(np.prod(self.shape)) * self.dtype.itemsize)
+            self.chunks[chunk_number] = np.memmap(path, dtype=self.dtype, mode='r',
+                                                  shape=(frame_count,) + self.shape)
+        return self.chunks[chunk_number]
+
+    def __getitem__(self, n):
+        record = self.index[n]
+        return self.get_chunk(int(record['chunk']))[int(record['slot'])]
+
+    def find_time(self, timestamp):
+        # the frame closest to (at or after) a timestamp
+        return min(int(np.searchsorted(self.timestamps, timestamp)), len(self) - 1)
+
+
+class SpillBuffer():
+    # frames the writer couldn't keep up with, appended raw to a temporary file (no encoding, so it's about as fast
+    # as the disk) and read back in order once the writer catches up
+
+    def __init__(self, spill_dir=None):
+        self.lock = threading.Lock()
+        self.file = tempfile.TemporaryFile(dir=spill_dir)
+        self.entries = collections.deque()
+        self.write_offset = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def put(self, buffer, timestamp, index):
+        data = np.ascontiguousarray(buffer)
+        with self.lock:
+            self.file.seek(self.write_offset)
+            self.file.write(data.tobytes())
+            self.entries.append((self.write_offset, data.shape, data.dtype, timestamp, index))
+            self.write_offset += data.nbytes
+
+    def get(self):
+        with self.lock:
+            offset, shape, dtype, timestamp, index = self.entries.popleft()
+            self.file.seek(offset)
+            buffer = np.frombuffer(self.file.read(int(np.prod(shape)) * np.dtype(dtype).itemsize), dtype=dtype)
+            if len(self.entries) == 0:
+                # everything has been read back, start the file over
+                self.file.seek(0)
+                self.file.truncate()
+                self.write_offset = 0
+        return buffer.reshape(shape), timestamp, index
+
+    def close(self):
+        self.file.close()
+
+
+class PreTriggerBuffer():
+    # the last few seconds of frames, kept all the time so a recording can start from before record was pressed.
+    # bounded by time and by memory, whichever comes first. at 16 bit we hold on to the camera's own frames (it hands
+    # us a fresh one every time so there is nothing to copy), at 8 bit the converted frame is copied into a recycled
+    # buffer for half the memory
+    depths = [8, 16]
+
+    def __init__(self, seconds=0, max_mb=1024, bit_depth=8):
+        self.entries = collections.deque()
+        self.free = []
+        self.nbytes = 0
+        self.configure(seconds, max_mb, bit_depth)
+
+    def configure(self, seconds, max_mb, bit_depth):
+        if bit_depth not in self.depths:
+            raise ValueError(f'pre-trigger bit depth must be one of {self.depths}, not {bit_depth}')
+        self.seconds = seconds
+        self.max_bytes = max_mb * 2 ** 20
+        self.bit_depth = bit_depth
+        self.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get_buffer(self, like):
+        while self.free:
+            buffer = self.free.pop()
+            if buffer.shape == like.shape and buffer.dtype == like.dtype:
+                return buffer
+        return np.empty_like(like)
+
+    def push(self, buffer, timestamp, index, monotonic, extra=None, copy=False):
+        # extra is anything the caller wants back with the frame
+        if self.seconds <= 0:
+            return
+        if copy:
+            stored = self.get_buffer(buffer)
+            np.copyto(stored, buffer)
+        else:
+            stored = buffer
+        self.entries.append((stored, timestamp, index, monotonic, extra, copy))
+        self.nbytes += stored.nbytes
+        self.trim(monotonic)
+
+    def trim(self, now):
+        while self.entries and (self.entries[0][3] < now - self.seconds or self.nbytes > self.max_bytes):
+            stored, _, _, _, _, owned = self.entries.popleft()
+            self.nbytes -= stored.nbytes
+            if owned and len(self.free) < 2:
+                self.free.append(stored)
+
+    def take(self):
+        # everything held, oldest first, as (buffer, timestamp, index, monotonic, extra). the buffers belong to the
+        # caller from now on, so the next push starts a fresh history
+        entries = [entry[:5] for entry in self.entries]
+        self.clear()
+        return entries
+
+    def clear(self):
+        self.entries.clear()
+        self.free = []
+        self.nbytes = 0
+
+    def get_stats(self):
+        span = self.entries[-1][3] - self.entries[0][3] if len(self.entries) > 1 else 0
+        return {'frames': len(self.entries), 'seconds': round(span, 2), 'MB': round(self.nbytes / 2 ** 20, 1)}
+
+
+class ScreenshotWriter(threading.Thread):
+    # encodes stills on its own thread, a full frame takes long enough to tiff or png encode that doing it in the
+    # processing thread holds up the stream. the native frame goes out as a tiff at whatever bit depth the camera gave
+    # us, and optionally an 8 bit png with the overlays drawn over it. if stills come in faster than they can be
+    # written the queue fills up and the extra ones are dropped (and logged), the stream is never held up
+    def __init__(self, queue_size=128):
+        super(ScreenshotWriter, self).__init__(daemon=True)
+        self.jobs = queue.Queue(maxsize=queue_size)
+        self.saved = 0
+        self.dropped = 0
+
+    def submit(self, path, buffer, overlay_base=None, layers=None):
+        # path without an extension. buffer must not be reused by the caller, neither must overlay_base
+        try:
+            self.jobs.put_nowait((path, buffer, overlay_base, layers))
+        except queue.Full:
+            self.dropped += 1
+            logging.warning(f'screenshot writer is behind, dropped: {path}')
+            return False
+        return True
+
+    def save(self, path, buffer, overlay_base, layers):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if not cv2.imwrite(path + '.tif', buffer):
+            raise IOError(f'could not write {path}.tif')
+        if overlay_base is not None:
+            composite = composite_overlays(overlay_base, layers or [])
+            cv2.imwrite(path + '_overlay.png', cv2.cvtColor(composite, cv2.COLOR_RGB2BGR))
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            try:
+                self.save(*job)
+                self.saved += 1
+            except Exception as e:
+                logging.warning(f'failed to save screenshot: {e}')
+
+    def stop(self):
+        # anything already queued is still written
+        self.jobs.put(None)
+        self.join()
+
+
+class RecordingWriter(threading.Thread):
+    # takes frames off the processing thread through a bounded queue and writes them to a sink on its own thread,
+    # so a slow disk or encoder can't hold up the stream. what happens once the queue is full is up to the policy:
+    #   block - wait for the writer, nothing is lost but the stream stalls (the old behaviour)
+    #   drop  - throw the new frame away and count it
+    #   spill - append it raw to a temporary file, the writer works through those once it has caught up
+    # history is a list of (buffer, timestamp, index) written before anything submitted, e.g. from a PreTriggerBuffer.
+    # history_convert is applied to each of those first if they aren't in the format the sink wants
+    policies = ['block', 'drop', 'spill']
+
+    def __init__(self, sink, queue_size=64, policy='block', spill_dir=None, history=None, history_convert=None):
+        super(RecordingWriter, self).__init__(daemon=True)
+        if policy not in self.policies:
+            raise ValueError(f'unknown recording policy: {policy}')
+        self.sink = sink
+        self.policy = policy
+        self.history = collections.deque(history if history is not None else [])
+        self.history_convert = history_convert
+        self.frame_queue = queue.Queue(maxsize=queue_size)
+        self.spill = SpillBuffer(spill_dir) if policy == 'spill' else None
+        self.running = True
+        self.frames_submitted = 0
+        self.frames_written = 0
+        self.frames_failed = 0
+        # camera indices of frames the sink refused, they were submitted but are missing from the recording
+        self.failed_frames = []
+        self.frames_dropped = 0
+        self.frames_spilled = 0
+        self.max_queue_depth = 0
+        self.write_time = 0
+        self.fps_t0 = time.time()
+        self.fps_written_t0 = 0
+        self.throughput = 0
+
+    def submit(self, buffer, timestamp=None, index=None):
+        # the buffer must not be reused by the caller afterwards, copy it first if it is a scratch buffer. returns
+        # False if the frame was dropped, so the caller knows it won't be in the recording
+        if timestamp is None:
+            timestamp = time.time()
+        self.frames_submitted += 1
+        item = (buffer, timestamp, index)
+        if self.policy == 'block':
+            self.frame_queue.put(item)
+        elif self.policy == 'spill' and len(self.spill) > 0:
+            # once we've started spilling everything goes there until it drains, otherwise frames get reordered
+            self.spill.put(*item)
+            self.frames_spilled += 1
+        else:
+            try:
+                self.frame_queue.put_nowait(item)
+            except queue.Full:
+                if self.policy == 'drop':
+                    self.frames_dropped += 1
+                    return False
+                self.spill.put(*item)
+                self.frames_spilled += 1
+        self.max_queue_depth = max(self.max_queue_depth, self.frame_queue.qsize())
+        return True
+
+    def get_next(self):
+        # the history is older than anything queued, queued frames are always older than spilled ones
+        if self.history:
+            buffer, timestamp, index = self.history.popleft()
+            if self.history_convert is not None:
+                buffer = self.history_convert(buffer)
+            return buffer, timestamp, index
+        try:
+            return self.frame_queue.get_nowait()
+        except queue.Empty:
+            pass
+        if self.spill is not None and len(self.spill) > 0:
+            return self.spill.get()
+        try:
+            return self.frame_queue.get(timeout=0.1)
+        except queue.Empty:
+            return None
+
+    def run(self):
+        logging.info(f'recording writer started, policy: {self.policy}')
+        while True:
+            item = self.get_next()
+            if item is None:
+                if not self.running:
+                    break
+                continue
+            t0 = time.perf_counter()
+            try:
+                self.sink.write(*item)
+            except Exception as e:
+                logging.warning(f'failed to write frame {item[2]}: {e}')
+                self.frames_failed += 1
+                self.failed_frames.append(item[2])
+                continue
+            self.write_time += time.perf_counter() - t0
+            self.frames_written += 1
+        self.sink.close()
+        if self.spill is not None:
+            self.spill.close()
+        logging.info(f'recording writer finished: {self.get_stats()}')
+        if self.failed_frames:
+            logging.warning(f'frames missing from the recording after failed writes: {self.failed_frames}')
+
+    def stop(self):
+        # anything still queued or spilled gets written before the sink is closed
+        self.running = False
+        self.join()
+
+    def get_queue_depth(self):
+        return self.frame_queue.qsize() + (len(self.spill) if self.spill is not None else 0) + len(self.history)
+
+    def get_stats(self):
+        t1 = time.time()
+        if t1 - self.fps_t0 >= 1:
+            self.throughput = (self.frames_written - self.fps_written_t0) / (t1 - self.fps_t0)
+            self.fps_t0 = t1
+            self.fps_written_t0 = self.frames_written
+        mean_write = self.write_time / self.frames_written * 1000 if self.frames_written else 0
+        return {'queue depth': self.get_queue_depth(), 'max queue depth': self.max_queue_depth,
+                'written': self.frames_written, 'failed': self.frames_failed, 'dropped': self.frames_dropped,
+                'spilled': self.frames_spilled,
+                'throughput fps': round(self.throughput, 2), 'mean write ms': round(mean_write, 3)}
@@ -0,0 +1,255 @@
+import os
+import time
+import logging
+import argparse
+import numpy as np
+import cv2
+from pipeline import FramePool, FrameProcessor
+from profiler import PipelineProfiler
+
+
+class SyntheticScene():
+    # a fake chip for benchmarking: an unevenly lit, noisy background with a few robots (open rings) drifting
+    # across it and a scattering of cells. frames come out at camera bit depth so they go through the same conversion
+
+    def __init__(self, shape=(2048, 2060), bit_depth=16, robot_count=3, cell_count=40, noise=0.01, seed=0):
+        self.shape = tuple(shape)
+        self.bit_depth = bit_depth
+        self.max_value = 2 ** bit_depth - 1
+        self.dtype = np.uint16 if bit_depth > 8 else np.uint8
+        self.rng = np.random.default_rng(seed)
+        height, width = self.shape
+
+        # vignetted illumination, brightest in the middle
+        ys, xs = np.mgrid[0:height, 0:width].astype(np.float32)
+        r = np.sqrt(((xs - width / 2) / width) ** 2 + ((ys - height / 2) / height) ** 2)
+        self.background = (0.45 - 0.2 * r) * self.max_value
+        # noise is expensive to draw at full resolution, so a handful of fields get cycled through
+        self.noise_fields = [(self.rng.standard_normal(self.shape) * noise * self.max_value).astype(np.float32)
+                             for _ in range(8)]
+
+        scale = min(height, width) / 2048
+        self.robot_radius = max(int(60 * scale), 8)
+        self.robot_thickness = max(int(12 * scale), 2)
+        self.robots = [{'x': self.rng.uniform(0.2, 0.8) * width, 'y': self.rng.uniform(0.2, 0.8) * height,
+                        'vx': self.rng.uniform(-2, 2), 'vy': self.rng.uniform(-2, 2),
+                        'angle': self.rng.uniform(0, 360)} for _ in range(robot_count)]
+        self.cells = [{'x': self.rng.uniform(0, width), 'y': self.rng.uniform(0, height),
+                       'r': max(int(self.rng.uniform(5, 10) * scale), 2)} for _ in range(cell_count)]
+
+    def render(self, frame_index):
+        frame = self.background + self.noise_fields[frame_index % len(self.noise_fields)]
+        height, width = self.shape
+        for cell in self.cells:
+            cv2.circle(frame, (int(cell['x']), int(cell['y'])), cell['r'], 0.8 * self.max_value, -1)
+        for robot in self.robots:
+            x = (robot['x'] + robot['vx'] * frame_index) % width
+            y = (robot['y'] + robot['vy'] * frame_index) % height
+            # a ring with a gap, dark against the background like the real robots under brightfield
+            cv2.ellipse(frame, (int(x), int(y)), (self.robot_radius, self.robot_radius), robot['angle'], 30, 360,
+                        0.1 * self.max_value, self.robot_thickness)
+        return np.clip(frame, 0, self.max_value).astype(self.dtype)
+
+
+def to_camera_depth(img):
+    # recordings are 8 bit, put them back in the top of a 16 bit range like the camera delivers
+    if img.ndim == 3:
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    if img.dtype == np.uint8:
+        img = img.astype(np.uint16) << 8
+    return img
+
+
+def iter_synthetic(scene, count):
+    for i in range(count):
+        yield scene.render(i)
+
+
+def iter_video(path, count=None):
+    capture = cv2.VideoCapture(path)
+    if not capture.isOpened():
+        raise IOError(f'could not open video: {path}')
+    i = 0
+    try:
+        while count is None or i < count:
+            ok, img = capture.read()
+            if not ok:
+                break
+            yield to_camera_depth(img)
+            i += 1
+    finally:
+        capture.release()
+
+
+def iter_tiff_stack(path, count=None):
+    ok, pages = cv2.imreadmulti(path, flags=cv2.IMREAD_ANYDEPTH)
+    if not ok:
+        raise IOError(f'could not read tiff stack: {path}')
+    for img in pages[:count]:
+        yield to_camera_depth(img)
+
+
+def open_source(source, count=None, shape=(2048, 2060), bit_depth=16, seed=0):
+    if source == 'synthetic':
+        return iter_synthetic(SyntheticScene(shape, bit_depth, seed=seed), count or 300)
+    extension = os.path.splitext(source)[1].lower()
+    if extension in ['.tif', '.tiff']:
+        return iter_tiff_stack(source, count)
+    return iter_video(source, count)
+
+
+class ReplayPipeline():
+    # runs frames through the same steps as imageProcessor.process_frames_slot, minus the camera and viewer.
+    # detection is optional since cell detection has to load the tensorflow model first
+
+    def __init__(self, display_size=(686, 682), image_adjustment_params=None, robot_detection=False,
+                 cell_detection=False, objective='10x', detection_interval=5, calibration_dir='.',
+                 camera_name='replay', cell_mode='full', cell_roi=None):
+        self.display_size = display_size
+        self.profiler = PipelineProfiler(window=100000)
+        self.frame_processor = FrameProcessor(calibration_dir, camera_name, self.profiler,
+                                              shape_changed_callback=self.reset_overlays)
+        if image_adjustment_params is not None:
+            params = dict(self.frame_processor.image_adjustment_params)
+            params.update(image_adjustment_params)
+            self.frame_processor.set_params(params)
+        self.robot_detection = robot_detection
+        self.cell_detection = cell_detection
+        self.objective = objective
+        self.detection_interval = detection_interval
+        self.cell_mode = cell_mode
+        self.cell_roi = cell_roi
+        self.detection = None
+        if robot_detection or cell_detection:
+            import detection
+            self.detection = detection
+        if cell_detection:
+            detection.load_model()
+        self.frame_processor.overlay_compositor.set_enabled('robot', robot_detection)
+        self.frame_processor.overlay_compositor.set_enabled('cell', cell_detection)
+        self.display_pools = {}
+        self.frame_count = 0
+        self.robots_found = 0
+
+    def reset_overlays(self, shape):
+        overlay_shape = tuple(shape[:2]) + (3,)
+        self.robot_detection_overlay = np.zeros(overlay_shape, dtype=np.uint8)
+        self.cell_detection_overlay = np.zeros(overlay_shape, dtype=np.uint8)
+        self.frame_processor.overlay_compositor.set_layer('robot', self.robot_detection_overlay)
+        self.frame_processor.overlay_compositor.set_layer('cell', self.cell_detection_overlay)
+
+    def run_robot_detection(self, img):
+        robot_contours, robot_angles = self.detection.get_robot_control(img, self.objective)
+        robots = {i: {'contour': contour, 'angle': angle}
+                  for i, (contour, angle) in enumerate(zip(robot_contours, robot_angles))}
+        self.robots_found += len(robots)
+        self.robot_detection_overlay = self.detection.get_control_mask(img.shape, robots, self.objective)
+        self.frame_processor.overlay_compositor.set_layer('robot', self.robot_detection_overlay)
+
+    def run_cell_detection(self, img):
+        if self.cell_mode == 'full':
+            model_img = cv2.resize(img, (2044, 2060))
+            self.cell_detection_overlay = self.detection.get_cell_overlay(model_img, img.shape[:2])
+        else:
+            self.cell_detection_overlay = self.detection.get_cell_overlay(img, img.shape[:2], self.cell_mode,
+                                                                          self.cell_roi)
+        self.frame_processor.overlay_compositor.set_layer('cell', self.cell_detection_overlay)
+
+    def process(self, raw):
+        img = self.frame_processor.convert(raw)
+        img = self.frame_processor.correct_illumination(img)
+        np_img = self.frame_processor.adjust(img)
+
+        shape = self.frame_processor.get_display_shape(self.display_size)
+        if shape not in self.display_pools:
+            self.display_pools[shape] = FramePool(shape, count=1)
+        pool = self.display_pools[shape]
+        display_img = pool.acquire()
+        self.frame_processor.render_display_frame(np_img, self.display_size, display_img)
+        # nobody is looking, so the buffer comes straight back
+        pool.release(display_img)
+
+        self.frame_count += 1
+        if self.frame_count % self.detection_interval == 0:
+            if self.robot_detection:
+                with self.profiler.time('robot detection'):
+                    self.run_robot_detection(img)
+            if self.cell_detection:
+                with self.profiler.time('cell inference'):
+                    self.run_cell_detection(img)
+        return display_img
+
+    def run(self, frames):
+        source_time = 0
+        t0 = time.perf_counter()
+        t_source = t0
+        for raw in frames:
+            t_frame = time.perf_counter()
+            source_time += t_frame - t_source
+            self.process(raw)
+            t_source = time.perf_counter()
+        elapsed = time.perf_counter() - t0
+        # reading or generating frames isn't part of the pipeline, so report both
+        pipeline_time = elapsed - source_time
+        stats, _ = self.profiler.get_stats()
+        return {'frames': self.frame_count, 'elapsed': elapsed, 'source_time': source_time,
+                'pipeline_time': pipeline_time,
+                'pipeline_fps': self.frame_count / pipeline_time if pipeline_time > 0 else 0,
+                'overall_fps': self.frame_count / elapsed if elapsed > 0 else 0,
+                'robots_found': self.robots_found, 'stages': stats}
+
+
+def format_report(report):
+    lines = [f"frames: {report['frames']}, pipeline: {report['pipeline_fps']:.1f}fps "
+             f"({report['pipeline_time']:.2f}s), including source: {report['overall_fps']:.1f}fps "
+             f"({report['elapsed']:.2f}s)",
+             f"{'stage':<20}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'mean ms':>10}"]
+    for stage, s in report['stages'].items():
+        lines.append(f"{stage:<20}{s['count']:>8}{s['p50']:>10.2f}{s['p95']:>10.2f}{s['p99']:>10.2f}"
+                     f"{s['mean']:>10.2f}")
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='replay recorded or synthetic frames through the image pipeline '
+                                                 'without the camera or gui and report throughput')
+    parser.add_argument('source', nargs='?', default='synthetic', help='mp4, tiff stack, or "synthetic"')
+    parser.add_argument('--frames', type=int, default=None, help='number of frames, synthetic defaults to 300')
+    parser.add_argument('--shape', type=int, nargs=2, default=[2048, 2060], help='synthetic frame height width')
+    parser.add_argument('--bit-depth', type=int, default=16, help='synthetic frame bit depth')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--display-size', type=int, nargs=2, default=[686, 682], help='window width height')
+    parser.add_argument('--clahe', action='store_true')
+    parser.add_argument('--clahe-display-only', action='store_true')
+    parser.add_argument('--threshold', action='store_true')
+    parser.add_argument('--auto-range', action='store_true')
+    parser.add_argument('--background', choices=['mean', 'median'], default=None,
+                        help='turn on background subtraction with this model')
+    parser.add_argument('--robots', action='store_true', help='run robot detection (loads the detection module)')
+    parser.add_argument('--cells', action='store_true', help='run cell inference (loads the detection module)')
+    parser.add_argument('--cell-mode', choices=['full', 'half', 'quarter', 'tiled'], default='full',
+                        help='cell inference resolution, or overlapping tiles over --cell-roi')
+    parser.add_argument('--cell-roi', type=int, nargs=4, default=None, help='tiled roi: x y width height')
+    parser.add_argument('--objective', default='10x')
+    parser.add_argument('--csv', default=None, help='write the stage timings to this directory')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    image_adjustment_params = {'clahe': args.clahe or args.clahe_display_only,
+                               'clahe_display_only': args.clahe_display_only, 'threshold': args.threshold,
+                               'auto_range': args.auto_range, 'background_subtraction': args.background is not None,
+                               'background_mode': args.background or 'mean'}
+    replay = ReplayPipeline(tuple(args.display_size), image_adjustment_params, args.robots, args.cells,
+                            args.objective, cell_mode=args.cell_mode,
+                            cell_roi=tuple(args.cell_roi) if args.cell_roi is not None else None)
+    frames = open_source(args.source, args.frames, tuple(args.shape), args.bit_depth, args.seed)
+    report = replay.run(frames)
+    print(format_report(report))
+    if args.csv is not None:
+        replay.profiler.start_session(args.csv)
+        replay.profiler.write_snapshot()
+        replay.profiler.close()
+
+
+if __name__ == '__main__':
+    main()
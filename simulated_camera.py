@@ -0,0 +1,238 @@
+import time
+import logging
+import threading
+import collections
+import numpy as np
+from replay import SyntheticScene
+
+
+class MetadataTag():
+    def __init__(self, key, value):
+        self.key = key
+        self.value = value
+
+    def GetName(self):
+        return self.key
+
+    def GetValue(self):
+        return self.value
+
+
+class Metadata():
+    # stands in for MMCorePy.Metadata, filled in by the *MD calls. values are strings, like micromanager's
+
+    def __init__(self):
+        self.tags = {}
+
+    def PutTag(self, key, value):
+        self.tags[key] = str(value)
+
+    def GetKeys(self):
+        return tuple(self.tags.keys())
+
+    def GetSingleTag(self, key):
+        return MetadataTag(key, self.tags[key])
+
+
+class SimulatedCore():
+    # stands in for MMCorePy.CMMCore with a fake camera. only the calls imageProcessor makes are implemented, frames
+    # come from a synthetic scene rendered on a background thread at the exposure rate, so the whole gui and pipeline
+    # can be load tested away from the rig
+
+    def __init__(self, shape=(2048, 2060), bit_depth=16, exposure=200, jitter=0.05, robot_count=3, cell_count=40,
+                 seed=0):
+        self.sensor_shape = tuple(shape)
+        self.bit_depth = bit_depth
+        self.scene = SyntheticScene(shape, bit_depth, robot_count, cell_count, seed=seed)
+        self.rng = np.random.default_rng(seed)
+        self.properties = {'Exposure': str(exposure), 'Binning': '1', 'PixelRate': 'fast scan', 'Noisefilter': 'Off',
+                           'PixelType': f'{bit_depth}bit', 'Jitter': str(jitter)}
+        self.allowed_values = {'Binning': ['1', '2', '4'], 'PixelRate': ['slow scan', 'fast scan'],
+                               'Noisefilter': ['On', 'Off'], 'PixelType': [f'{bit_depth}bit']}
+        self.camera_device = None
+        self.roi = None
+        self.lock = threading.Lock()
+        self.buffer_footprint = 500
+        self.buffer = collections.deque()
+        self.last_image = None
+        self.frame_index = 0
+        self.sequence_t0 = time.perf_counter()
+        self.overflowed = False
+        self.sequence_thread = None
+        self.sequence_running = False
+
+    # device setup, nothing to load for a simulated camera
+    def loadDevice(self, label, module, device):
+        logging.info(f'simulated camera standing in for {module} {device}')
+
+    def initializeAllDevices(self):
+        pass
+
+    def setCameraDevice(self, label):
+        self.camera_device = label
+
+    def getCameraDevice(self):
+        return self.camera_device
+
+    def reset(self):
+        self.stopSequenceAcquisition()
+        self.clearCircularBuffer()
+
+    def setCircularBufferMemoryFootprint(self, size_mb):
+        self.buffer_footprint = size_mb
+
+    def getDevicePropertyNames(self, label):
+        return tuple(self.properties.keys())
+
+    def getProperty(self, label, name):
+        return self.properties[name]
+
+    def getAllowedPropertyValues(self, label, name):
+        return tuple(self.allowed_values.get(name, []))
+
+    def setProperty(self, label, name, value):
+        value = str(value)
+        if name in self.allowed_values and value not in self.allowed_values[name]:
+            raise ValueError(f'invalid value for {name}: {value}')
+        self.properties[name] = value
+
+    def setExposure(self, exposure):
+        self.properties['Exposure'] = str(exposure)
+
+    def getExposure(self):
+        return float(self.properties['Exposure'])
+
+    # readout
+    def setROI(self, x, y, width, height):
+        # binned pixels, like micromanager
+        self.roi = (x, y, width, height)
+
+    def clearROI(self):
+        self.roi = None
+
+    def get_binning(self):
+        return int(self.properties['Binning'])
+
+    def getImageWidth(self):
+        return self.roi[2] if self.roi is not None else self.sensor_shape[1] // self.get_binning()
+
+    def getImageHeight(self):
+        return self.roi[3] if self.roi is not None else self.sensor_shape[0] // self.get_binning()
+
+    def getBytesPerPixel(self):
+        return 2 if self.bit_depth > 8 else 1
+
+    def getImageBitDepth(self):
+        return self.bit_depth
+
+    def snap_frame(self):
+        frame = self.scene.render(self.frame_index)
+        self.frame_index += 1
+        binning = self.get_binning()
+        if binning > 1:
+            height, width = frame.shape[0] // binning, frame.shape[1] // binning
+            frame = frame[:height * binning, :width * binning]
+            frame = frame.reshape(height, binning, width, binning).mean(axis=(1, 3)).astype(frame.dtype)
+        if self.roi is not None:
+            x, y, width, height = self.roi
+            frame = np.ascontiguousarray(frame[y:y + height, x:x + width])
+        return frame
+
+    # sequence acquisition
+    def startContinuousSequenceAcquisition(self, interval_ms):
+        if self.sequence_running:
+            return
+        self.sequence_running = True
+        self.sequence_t0 = time.perf_counter()
+        self.sequence_thread = threading.Thread(target=self.run_sequence, daemon=True)
+        self.sequence_thread.start()
+
+    def stopSequenceAcquisition(self):
+        self.sequence_running = False
+        if self.sequence_thread is not None:
+            self.sequence_thread.join()
+            self.sequence_thread = None
+
+    def isSequenceRunning(self):
+        return self.sequence_running
+
+    def run_sequence(self):
+        next_frame = time.perf_counter()
+        while self.sequence_running:
+            exposure = float(self.properties['Exposure']) / 1000
+            jitter = float(self.properties['Jitter'])
+            # frames are due once per exposure, readout jitter moves each one a little but never makes them pile up
+            next_frame += max(exposure * (1 + self.rng.normal(0, jitter)), exposure / 10)
+            delay = next_frame - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                # rendering couldn't keep up, don't try to catch up with a burst
+                next_frame = time.perf_counter()
+            image_number = self.frame_index
+            frame = self.snap_frame()
+            tags = self.get_tags(frame, image_number)
+            capacity = max(int(self.buffer_footprint * 2 ** 20 // frame.nbytes), 1)
+            with self.lock:
+                if len(self.buffer) >= capacity:
+                    # like micromanager, a full circular buffer loses the frame and ends the sequence. what is
+                    # already in the buffer can still be read out
+                    self.overflowed = True
+                    self.sequence_running = False
+                    logging.info('simulated camera circular buffer overflowed, sequence stopped')
+                    break
+                self.buffer.append((frame, tags))
+                self.last_image = (frame, tags)
+
+    def get_tags(self, frame, image_number):
+        # roughly what micromanager attaches to every image of a sequence
+        elapsed_ms = (time.perf_counter() - self.sequence_t0) * 1000
+        pixel_type = 'GRAY16' if self.bit_depth > 8 else 'GRAY8'
+        tags = {'Camera': self.camera_device, 'ElapsedTime-ms': f'{elapsed_ms:.3f}', 'ImageNumber': image_number,
+                'Width': frame.shape[1], 'Height': frame.shape[0], 'PixelType': pixel_type,
+                'Binning': self.properties['Binning'], 'Exposure-ms': self.properties['Exposure']}
+        for name, value in self.properties.items():
+            tags[f'{self.camera_device}-{name}'] = value
+        return tags
+
+    def getRemainingImageCount(self):
+        with self.lock:
+            return len(self.buffer)
+
+    def popNextImage(self):
+        with self.lock:
+            if len(self.buffer) == 0:
+                raise RuntimeError('circular buffer is empty')
+            return self.buffer.popleft()[0]
+
+    def popNextImageMD(self, md):
+        with self.lock:
+            if len(self.buffer) == 0:
+                raise RuntimeError('circular buffer is empty')
+            frame, tags = self.buffer.popleft()
+        for key, value in tags.items():
+            md.PutTag(key, value)
+        return frame
+
+    def getLastImage(self):
+        with self.lock:
+            if self.last_image is None:
+                raise RuntimeError('circular buffer is empty')
+            return self.last_image[0]
+
+    def getLastImageMD(self, md):
+        with self.lock:
+            if self.last_image is None:
+                raise RuntimeError('circular buffer is empty')
+            frame, tags = self.last_image
+        for key, value in tags.items():
+            md.PutTag(key, value)
+        return frame
+
+    def isBufferOverflowed(self):
+        return self.overflowed
+
+    def clearCircularBuffer(self):
+        with self.lock:
+            self.buffer.clear()
+            self.overflowed = False